@@ -0,0 +1,28 @@
+"""Add metadata documents to bundles
+
+Revision ID: 3c2f8e1a9d47
+Revises: eb10bb49c6f
+Create Date: 2026-10-18 12:04:31.512840
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c2f8e1a9d47'
+down_revision = 'eb10bb49c6f'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    print 'Adding metadata documents...'
+    op.add_column('bundle', sa.Column('metadata_document', sa.Text(), nullable=True))
+    op.create_index('metadata_bundle_uuid_index', 'bundle_metadata', ['bundle_uuid'], unique=False)
+    # Existing bundles keep their metadata in bundle_metadata until they are
+    # converted with scripts/convert-metadata-storage.py.
+
+def downgrade():
+    print 'Removing metadata documents...'
+    # Run scripts/convert-metadata-storage.py table first, or the metadata of
+    # bundles stored as documents will be lost.
+    op.drop_index('metadata_bundle_uuid_index', table_name='bundle_metadata')
+    op.drop_column('bundle', 'metadata_document')
@@ -0,0 +1,23 @@
+"""Make worksheet item sort keys floats
+
+Revision ID: 7a41d2c9e0b5
+Revises: 3c2f8e1a9d47
+Create Date: 2026-10-18 15:22:07.318452
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a41d2c9e0b5'
+down_revision = '3c2f8e1a9d47'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    print 'Making worksheet item sort keys floats...'
+    op.alter_column('worksheet_item', 'sort_key', type_=sa.Float(precision=53), existing_type=sa.Integer(), existing_nullable=True)
+
+def downgrade():
+    print 'Making worksheet item sort keys integers...'
+    # Fractional sort keys are rounded, which may change the order of items.
+    op.alter_column('worksheet_item', 'sort_key', type_=sa.Integer(), existing_type=sa.Float(precision=53), existing_nullable=True)
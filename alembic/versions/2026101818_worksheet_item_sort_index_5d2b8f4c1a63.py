@@ -0,0 +1,27 @@
+"""Give every worksheet item a sort key and index items by it
+
+Revision ID: 5d2b8f4c1a63
+Revises: 7a41d2c9e0b5
+Create Date: 2026-10-18 18:04:51.902316
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d2b8f4c1a63'
+down_revision = '7a41d2c9e0b5'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    print 'Setting the sort keys of appended worksheet items...'
+    # Items appended to a worksheet used to have no sort key, which meant that
+    # they sorted by id; now they get their id as their sort key.
+    op.execute('UPDATE worksheet_item SET sort_key = id WHERE sort_key IS NULL')
+    print 'Adding worksheet_item_sort_index...'
+    op.create_index('worksheet_item_sort_index', 'worksheet_item', ['worksheet_uuid', 'sort_key', 'id'], unique=False)
+
+def downgrade():
+    print 'Dropping worksheet_item_sort_index...'
+    # The sort keys are left in place: they're the same as the ids they replace.
+    op.drop_index('worksheet_item_sort_index', table_name='worksheet_item')
@@ -0,0 +1,31 @@
+"""Add the change log
+
+Revision ID: 9e3c6a1f7b28
+Revises: 5d2b8f4c1a63
+Create Date: 2026-10-18 20:11:37.605224
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e3c6a1f7b28'
+down_revision = '5d2b8f4c1a63'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    print 'Adding change_log...'
+    op.create_table('change_log',
+        sa.Column('seq', sa.Integer(), nullable=False),
+        sa.Column('object_type', sa.String(length=63), nullable=False),
+        sa.Column('object_uuid', sa.String(length=63), nullable=False),
+        sa.Column('change', sa.String(length=63), nullable=False),
+        sa.Column('time', sa.Float(precision=53), nullable=False),
+        sa.PrimaryKeyConstraint('seq'),
+    )
+    op.create_index('change_log_time_index', 'change_log', ['time'], unique=False)
+
+def downgrade():
+    print 'Dropping change_log...'
+    op.drop_index('change_log_time_index', table_name='change_log')
+    op.drop_table('change_log')
@@ -0,0 +1,33 @@
+"""Add bundle leases
+
+Revision ID: 3f8d5b2e6c17
+Revises: 9e3c6a1f7b28
+Create Date: 2026-10-18 22:04:51.318842
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f8d5b2e6c17'
+down_revision = '9e3c6a1f7b28'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    print 'Adding bundle_lease...'
+    op.create_table('bundle_lease',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('bundle_uuid', sa.String(length=63), nullable=False),
+        sa.Column('worker_id', sa.String(length=127), nullable=False),
+        sa.Column('expires', sa.Float(precision=53), nullable=False),
+        sa.ForeignKeyConstraint(['bundle_uuid'], ['bundle.uuid'], ),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('bundle_lease_bundle_uuid_index', 'bundle_lease', ['bundle_uuid'], unique=True)
+    op.create_index('bundle_lease_worker_id_index', 'bundle_lease', ['worker_id'], unique=False)
+
+def downgrade():
+    print 'Dropping bundle_lease...'
+    op.drop_index('bundle_lease_worker_id_index', table_name='bundle_lease')
+    op.drop_index('bundle_lease_bundle_uuid_index', table_name='bundle_lease')
+    op.drop_table('bundle_lease')
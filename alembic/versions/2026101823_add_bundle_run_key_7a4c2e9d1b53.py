@@ -0,0 +1,32 @@
+"""Add bundle run keys
+
+Revision ID: 7a4c2e9d1b53
+Revises: 3f8d5b2e6c17
+Create Date: 2026-10-18 23:12:07.508214
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a4c2e9d1b53'
+down_revision = '3f8d5b2e6c17'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    print 'Adding bundle_run_key...'
+    op.create_table('bundle_run_key',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('bundle_uuid', sa.String(length=63), nullable=False),
+        sa.Column('run_key', sa.String(length=63), nullable=False),
+        sa.ForeignKeyConstraint(['bundle_uuid'], ['bundle.uuid'], ),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('bundle_run_key_bundle_uuid_index', 'bundle_run_key', ['bundle_uuid'], unique=True)
+    op.create_index('bundle_run_key_run_key_index', 'bundle_run_key', ['run_key'], unique=False)
+
+def downgrade():
+    print 'Dropping bundle_run_key...'
+    op.drop_index('bundle_run_key_run_key_index', table_name='bundle_run_key')
+    op.drop_index('bundle_run_key_bundle_uuid_index', table_name='bundle_run_key')
+    op.drop_table('bundle_run_key')
@@ -8,6 +8,8 @@ When the bundle is executed, it symlinks the program target in to ./program,
 symlinks the input target in to ./input, and then streams output to ./stdout
 and ./stderr. The ./output directory may also be used to store output files.
 '''
+import hashlib
+import json
 import os
 import subprocess
 import re
@@ -36,6 +38,8 @@ class RunBundle(NamedBundle):
     METADATA_SPECS.append(MetadataSpec('request_cpus', int, 'number of CPUs allowed for this run'))
     METADATA_SPECS.append(MetadataSpec('request_gpus', int, 'number of GPUs allowed for this run'))
     METADATA_SPECS.append(MetadataSpec('request_queue', basestring, 'submit job to this queue'))
+    METADATA_SPECS.append(MetadataSpec('request_priority', int, 'start this run before staged runs with lower priority'))
+    METADATA_SPECS.append(MetadataSpec('no_reuse', int, 'set to 1 to always run this instead of reusing the results of an identical run'))
 
     METADATA_SPECS.append(MetadataSpec('actions', list, 'actions performed on this run', generated=True))
 
@@ -52,6 +56,18 @@ class RunBundle(NamedBundle):
     METADATA_SPECS.append(MetadataSpec('job_handle', basestring, 'identifies the job handle (internal)', generated=True))
     METADATA_SPECS.append(MetadataSpec('remote', basestring, 'where this job was run', generated=True))
     METADATA_SPECS.append(MetadataSpec('temp_dir', basestring, 'temporary directory where job is running (internal)', generated=True))
+    METADATA_SPECS.append(MetadataSpec('reused_from', basestring, 'identical run whose results this run reused', generated=True))
+
+    # Metadata that can change the results of a run, besides its command and
+    # dependencies (see get_run_key).
+    RUN_KEY_METADATA_KEYS = (
+      'request_docker_image',
+      'request_time',
+      'request_memory',
+      'request_disk',
+      'request_cpus',
+      'request_gpus',
+    )
 
     @classmethod
     def construct(cls, targets, command, metadata, owner_id, uuid=None, data_hash=None, state=State.CREATED):
@@ -81,3 +97,23 @@ class RunBundle(NamedBundle):
           'dependencies': dependencies,
           'owner_id': owner_id,
         })
+
+    def get_run_key(self, data_hashes):
+        '''
+        Return a hash of everything that determines the results of this run:
+        the command, the docker image and resource requests, and the data hash
+        and path of each dependency. data_hashes maps the uuids of the parents
+        to their data hashes. Return None if a parent has no data hash.
+        '''
+        dependencies = []
+        for dep in self.dependencies:
+            data_hash = data_hashes.get(dep.parent_uuid)
+            if not data_hash:
+                return None
+            dependencies.append((dep.child_path, data_hash, dep.parent_path))
+        key = [
+          self.command,
+          [getattr(self.metadata, key, None) or None for key in self.RUN_KEY_METADATA_KEYS],
+          sorted(dependencies),
+        ]
+        return hashlib.sha1(json.dumps(key)).hexdigest()
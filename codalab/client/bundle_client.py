@@ -40,6 +40,13 @@ class BundleClient(object):
         '''
         raise NotImplementedError
 
+    def derive_bundles(self, specs, worksheet_uuid):
+        '''
+        Create many new bundles at once. Each spec is a dict with keys bundle_type,
+        targets, command and metadata, as in derive_bundle. Return their uuids.
+        '''
+        raise NotImplementedError
+
     def update_bundle_metadata(self, uuid, metadata):
         '''
         Update the bundle with the given uuid with the new metadata.
@@ -57,6 +64,15 @@ class BundleClient(object):
 
     # Commands for browsing bundles: info, ls, cat, search, and wait.
 
+    def resolve_bundle_specs(self, worksheet_uuid, bundle_specs):
+        '''
+        Resolve a list of bundle specs (uuids, uuid prefixes, names, name
+        patterns and ^N history references) in the context of the given
+        worksheet, and return the list of their uuids, in order. Raise a
+        UsageError if any of them doesn't resolve to exactly one bundle.
+        '''
+        raise NotImplementedError
+
     def get_bundle_info(self, bundle_uuid, parents=False, children=False):
         '''
         Return a dict containing detailed information about a given bundle:
@@ -132,10 +148,27 @@ class BundleClient(object):
                   - a bundle info dict
                   - a dict mapping 'uuid' to a bundle_uuid, if the uuid is orphaned
                   - None (for non-bundle rows)
+          item_ids: the database ids of the items
           last_item_id: the last database id of any item in the list
         '''
         raise NotImplementedError
 
+    def get_worksheet_items(self, uuid, offset, limit):
+        '''
+        Return a dict with the items of the worksheet with the given uuid at
+        positions offset to offset + limit (in the same form as the items of
+        get_worksheet_info), so that a large worksheet can be loaded lazily.
+
+        This dict will have the following keys:
+          num_items: the number of items in the whole worksheet
+          offset: the position of the first item
+          items: the items in the window
+          context_items: the directives before the window that are needed to
+                         interpret its items (pass context_items + items to
+                         worksheet_util.interpret_items)
+        '''
+        raise NotImplementedError
+
     def add_worksheet_item(self, worksheet_spec, bundle_spec):
         '''
         Add the bundle specified by the bundle_spec to the worksheet specified by
@@ -150,6 +183,14 @@ class BundleClient(object):
         '''
         raise NotImplementedError
 
+    def patch_worksheet(self, uuid, last_item_id, length, patch):
+        '''
+        Apply a patch (see worksheet_util.get_worksheet_patch) to the items of the
+        worksheet, as it was when its last item id was last_item_id and it had
+        length items. Raise a UsageError if there was a concurrent update.
+        '''
+        raise NotImplementedError
+
     def rename_worksheet(self, worksheet_spec, name):
         '''
         Update the specified worksheet to have the new name.
@@ -231,3 +272,20 @@ class BundleClient(object):
         Set permission for a group on a worksheet.
         '''
         raise NotImplementedError
+
+    #############################################################################
+    # Commands for following changes.
+    #############################################################################
+
+    def get_changes(self, since_seq, limit):
+        '''
+        Return the (up to limit) changes made to bundles, worksheets and their
+        permissions after the change with sequence number since_seq, so that
+        caches can be invalidated incrementally. Return a dict with keys:
+          changes: list of {seq, object_type, object_uuid, change, time} dicts
+          last_seq: the since_seq to pass to get the next changes
+          truncated: whether some changes after since_seq are no longer
+                     available, so that everything has to be reloaded
+        Start with a since_seq of 0.
+        '''
+        raise NotImplementedError
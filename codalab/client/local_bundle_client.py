@@ -94,6 +94,9 @@ class LocalBundleClient(BundleClient):
     def get_bundle_uuid(self, worksheet_uuid, bundle_spec):
         return canonicalize.get_bundle_uuid(self.model, self._current_user_id(), worksheet_uuid, bundle_spec)
 
+    def resolve_bundle_specs(self, worksheet_uuid, bundle_specs):
+        return canonicalize.get_bundle_uuids(self.model, self._current_user_id(), worksheet_uuid, bundle_specs)
+
     def search_bundle_uuids(self, worksheet_uuid, keywords):
         return self.model.search_bundle_uuids(self._current_user_id(), worksheet_uuid, keywords)
 
@@ -199,26 +202,40 @@ class LocalBundleClient(BundleClient):
         For both make and run bundles.
         Add the resulting bundle to the given worksheet_uuid (optional).
         '''
-        check_worksheet_has_all_permission(self.model, self._current_user(), self.model.get_worksheet(worksheet_uuid, fetch_items=False))
-
-        bundle_subclass = get_bundle_subclass(bundle_type)
-        self.validate_user_metadata(bundle_subclass, metadata)
-        owner_id = self._current_user_id()
-        bundle = bundle_subclass.construct(targets=targets, command=command, metadata=metadata, owner_id=owner_id)
-        self.model.save_bundle(bundle)
+        spec = {'bundle_type': bundle_type, 'targets': targets, 'command': command, 'metadata': metadata}
+        return self.derive_bundles([spec], worksheet_uuid)[0]
 
-        # Inherit properties of worksheet
-        self._bundle_inherit_workheet_permissions(bundle.uuid, worksheet_uuid)
+    @authentication_required
+    def derive_bundles(self, specs, worksheet_uuid):
+        '''
+        Bulk version of derive_bundle: each spec is a dict with keys bundle_type,
+        targets, command and metadata. All the bundles are created in a single
+        transaction and added to the given worksheet in order.
+        Return the list of new bundle uuids.
+        '''
+        check_worksheet_has_all_permission(self.model, self._current_user(), self.model.get_worksheet(worksheet_uuid, fetch_items=False))
+        bundles = [self._construct_derived_bundle(spec) for spec in specs]
+        self._save_derived_bundles(bundles, worksheet_uuid, add_items=True)
+        return [bundle.uuid for bundle in bundles]
 
-        # Add to worksheet
-        self.add_worksheet_item(worksheet_uuid, worksheet_util.bundle_item(bundle.uuid))
+    def _construct_derived_bundle(self, spec):
+        bundle_subclass = get_bundle_subclass(spec['bundle_type'])
+        self.validate_user_metadata(bundle_subclass, spec['metadata'])
+        return bundle_subclass.construct(targets=spec['targets'], command=spec['command'],
+                                         metadata=spec['metadata'], owner_id=self._current_user_id())
 
-        return bundle.uuid
+    def _save_derived_bundles(self, bundles, worksheet_uuid, add_items):
+        '''
+        Save the bundles, letting them inherit the permissions of the worksheet,
+        and optionally append them to the worksheet.
+        '''
+        group_permissions = self.model.get_group_worksheet_permissions(worksheet_uuid)
+        self.model.batch_save_bundles(bundles, group_permissions=group_permissions,
+                                      worksheet_uuid=worksheet_uuid if add_items else None)
 
     def _bundle_inherit_workheet_permissions(self, bundle_uuid, worksheet_uuid):
         group_permissions = self.model.get_group_worksheet_permissions(worksheet_uuid)
-        for permissions in group_permissions:
-            self.set_bundles_perm([bundle_uuid], permissions['group_uuid'], permission_str(permissions['permission']))
+        self.model.set_group_bundle_permissions([bundle_uuid], group_permissions)
 
     @authentication_required
     def kill_bundles(self, bundle_uuids):
@@ -226,8 +243,7 @@ class LocalBundleClient(BundleClient):
         Send a kill command to all the given bundles.
         '''
         check_bundles_have_all_permission(self.model, self._current_user(), bundle_uuids)
-        for bundle_uuid in bundle_uuids:
-            self.model.add_bundle_action(bundle_uuid, Command.KILL)
+        self.model.add_bundle_actions([{'bundle_uuid': bundle_uuid, 'action': Command.KILL} for bundle_uuid in bundle_uuids])
 
     @authentication_required
     def chown_bundles(self, bundle_uuids, user_spec):
@@ -236,10 +252,7 @@ class LocalBundleClient(BundleClient):
         '''
         check_bundles_have_all_permission(self.model, self._current_user(), bundle_uuids)
         user_info = self.user_info(user_spec)
-        # Update bundles
-        for bundle_uuid in bundle_uuids:
-            bundle = self.model.get_bundle(bundle_uuid)
-            self.model.update_bundle(bundle, {'owner_id': user_info['id']})
+        self.model.chown_bundles(bundle_uuids, user_info['id'])
 
     def open_target(self, target):
         check_bundles_have_read_permission(self.model, self._current_user(), [target[0]])
@@ -325,9 +338,12 @@ class LocalBundleClient(BundleClient):
             permissions = self.model.get_user_worksheet_permissions(self._current_user_id(), uuids, self.model.get_worksheet_owner_ids(uuids))
             return [uuid for uuid, permission in permissions.items() if permission < GROUP_OBJECT_PERMISSION_READ]
 
-        # Remove bundles that we can't access
-        for uuid in select_unreadable_bundles(uuids):
-            if uuid in bundle_dict:
+        # Remove bundles that we can't access.  We already have the owners of the
+        # bundles, so look up all the permissions at once and reuse them below.
+        owner_ids = dict((bundle.uuid, bundle.owner_id) for bundle in bundles)
+        permissions = self.model.get_user_bundle_permissions(self._current_user_id(), uuids, owner_ids)
+        for uuid, permission in permissions.items():
+            if permission < GROUP_OBJECT_PERMISSION_READ and uuid in bundle_dict:
                 del bundle_dict[uuid]
 
         # Lookup the user names of all the owners
@@ -369,10 +385,9 @@ class LocalBundleClient(BundleClient):
         if get_permissions:
             # Fill the info
             group_result = self.model.batch_get_group_bundle_permissions(uuids)
-            result = self.model.get_user_bundle_permissions(self._current_user_id(), uuids, self.model.get_bundle_owner_ids(uuids))
             for uuid, info in bundle_dict.items():
                 info['group_permissions'] = group_result[uuid]
-                info['permission'] = result[uuid]
+                info['permission'] = permissions[uuid]
 
         return bundle_dict
 
@@ -432,10 +447,17 @@ class LocalBundleClient(BundleClient):
             bundle_uuids = self.model.get_self_and_descendants(old_inputs, depth=depth)
         all_bundle_uuids = list(bundle_uuids) # should be infos.keys() in order
         for _ in range(depth):
-            new_bundle_uuids = []
+            # Get the infos of each level of the BFS at once.
+            level_uuids = []
             for bundle_uuid in bundle_uuids:
-                if bundle_uuid in infos: continue  # Already visited
-                info = infos[bundle_uuid] = self.get_bundle_info(bundle_uuid)
+                if bundle_uuid not in infos and bundle_uuid not in level_uuids:  # Not visited yet
+                    level_uuids.append(bundle_uuid)
+            # Make sure we have read access to all the bundles involved here.
+            check_bundles_have_read_permission(self.model, self._current_user(), level_uuids)
+            level_infos = self.get_bundle_infos(level_uuids)
+            new_bundle_uuids = []
+            for bundle_uuid in level_uuids:
+                info = infos[bundle_uuid] = level_infos[bundle_uuid]
                 for dep in info['dependencies']:
                     parent_uuid = dep['parent_uuid']
                     if parent_uuid not in infos:
@@ -443,13 +465,11 @@ class LocalBundleClient(BundleClient):
             all_bundle_uuids = new_bundle_uuids + all_bundle_uuids
             bundle_uuids = new_bundle_uuids
 
-        # Make sure we have read access to all the bundles involved here.
-        check_bundles_have_read_permission(self.model, self._current_user(), list(infos.keys()))
-
         # Now go recursively create the bundles.
         old_to_new = {}  # old_uuid -> new_uuid
         downstream = set()  # old_uuid -> whether we're downstream of an input (and actually needs to be mapped onto a new uuid)
         plan = []  # sequence of (old, new) bundle infos to make
+        new_bundles = []  # bundles to create, in dependency order
         for old, new in zip(old_inputs, new_inputs):
             old_to_new[old] = new
             downstream.add(old)
@@ -500,8 +520,15 @@ class LocalBundleClient(BundleClient):
                 if dry_run:
                     new_bundle_uuid = None
                 else:
-                    new_bundle_uuid = self.derive_bundle(new_info['bundle_type'], \
-                        targets, new_info['command'], new_metadata, None)
+                    # Only construct the bundle here; all of them are saved together below.
+                    new_bundle = self._construct_derived_bundle({
+                        'bundle_type': new_info['bundle_type'],
+                        'targets': targets,
+                        'command': new_info['command'],
+                        'metadata': new_metadata,
+                    })
+                    new_bundles.append(new_bundle)
+                    new_bundle_uuid = new_bundle.uuid
 
                 new_info['uuid'] = new_bundle_uuid
                 plan.append((info, new_info))
@@ -520,8 +547,9 @@ class LocalBundleClient(BundleClient):
             for uuid in all_bundle_uuids:
                 recurse(uuid)
 
-        # Add to worksheet
+        # Create the new bundles and add them to the worksheet
         if not dry_run:
+            self._save_derived_bundles(new_bundles, worksheet_uuid, add_items=False)
             if shadow:
                 # Add each new bundle in the "shadow" of the old_bundle (right after it).
                 for old_bundle_uuid, new_bundle_uuid in old_to_new.items():
@@ -532,6 +560,7 @@ class LocalBundleClient(BundleClient):
                 # Add all items on that worksheet that appear in old_to_new along with their preludes.
                 # For items not on this worksheet, add them at the end (instead of orphaning them).
                 host_worksheet_uuids = self.model.get_host_worksheet_uuids([old_inputs[0]])[old_inputs[0]]
+                new_items = []  # Items to append to worksheet_uuid
                 new_bundle_uuids_added = set()
                 skipped = True  # Whether there were items that we didn't include in the prelude (in which case we want to put '')
                 if len(host_worksheet_uuids) > 0:
@@ -544,7 +573,7 @@ class LocalBundleClient(BundleClient):
                         host_worksheet_uuid = host_worksheet_uuids[0]
 
                     # Fetch the worksheet
-                    worksheet_info = self.get_worksheet_info(host_worksheet_uuid, fetch_items=True)
+                    worksheet_info = self.get_worksheet_info(host_worksheet_uuid, fetch_items=True, fetch_permission=False)
 
                     prelude_items = []  # The prelude that we're building up
                     for item in worksheet_info['items']:
@@ -559,12 +588,12 @@ class LocalBundleClient(BundleClient):
                                 if old_bundle_uuid != new_bundle_uuid:  # Only add novel bundles
                                     # Stand in for things skipped (this is important so directives have proper extent).
                                     if skipped:
-                                        self.model.add_worksheet_item(worksheet_uuid, worksheet_util.markup_item(''))
+                                        new_items.append(worksheet_util.markup_item(''))
 
                                     # Add prelude and items
                                     for item2 in prelude_items:
-                                        self.add_worksheet_item(worksheet_uuid, worksheet_util.convert_item_to_db(item2))
-                                    self.add_worksheet_item(worksheet_uuid, worksheet_util.bundle_item(new_bundle_uuid))
+                                        new_items.append(worksheet_util.convert_item_to_db(item2))
+                                    new_items.append(worksheet_util.bundle_item(new_bundle_uuid))
                                     new_bundle_uuids_added.add(new_bundle_uuid)
                                     just_added = True
 
@@ -577,11 +606,12 @@ class LocalBundleClient(BundleClient):
 
                 # Add the bundles that haven't been added yet
                 if skipped:
-                    self.model.add_worksheet_item(worksheet_uuid, worksheet_util.markup_item(''))
+                    new_items.append(worksheet_util.markup_item(''))
                 for info, new_info in plan:
                     new_bundle_uuid = new_info['uuid']
                     if new_bundle_uuid not in new_bundle_uuids_added:
-                        self.add_worksheet_item(worksheet_uuid, worksheet_util.bundle_item(new_bundle_uuid))
+                        new_items.append(worksheet_util.bundle_item(new_bundle_uuid))
+                self.model.add_worksheet_items(worksheet_uuid, new_items)
 
         return plan
 
@@ -665,6 +695,25 @@ class LocalBundleClient(BundleClient):
 
         return result
 
+    def get_worksheet_items(self, uuid, offset, limit):
+        '''
+        Return the items of the worksheet at positions offset to offset + limit,
+        so that large worksheets can be loaded a window at a time. The returned
+        dict has keys num_items (the total number of items), offset, items and
+        context_items, where the items are (bundle_info, subworksheet_info,
+        value_obj, type) as in get_worksheet_info, and interpret_items should be
+        called on context_items + items.
+        '''
+        worksheet = self.model.get_worksheet(uuid, fetch_items=False)
+        check_worksheet_has_read_permission(self.model, self._current_user(), worksheet)
+        window = self.model.get_worksheet_item_window(uuid, offset, limit)
+        return {
+            'num_items': window['num_items'],
+            'offset': offset,
+            'items': self._convert_items_from_db(window['items']),
+            'context_items': self._convert_items_from_db(window['context_items']),
+        }
+
     def _user_id_to_name(self, user_id):
         return self._user_id_to_names([user_id])[0]
 
@@ -688,18 +737,22 @@ class LocalBundleClient(BundleClient):
             if bundle_uuid is not None
         )
         bundle_dict = self.get_bundle_infos(bundle_uuids)
+        # Same for the subworksheets.
+        subworksheet_uuids = set(
+            subworksheet_uuid for (bundle_uuid, subworksheet_uuid, value, type) in items
+            if subworksheet_uuid is not None
+        )
+        subworksheet_dict = self._get_subworksheet_infos(subworksheet_uuids)
 
         # Go through the items and substitute the components
         new_items = []
         for (bundle_uuid, subworksheet_uuid, value, type) in items:
             bundle_info = bundle_dict.get(bundle_uuid, {'uuid': bundle_uuid}) if bundle_uuid else None
             if subworksheet_uuid:
-                try:
-                    subworksheet_info = self.model.get_worksheet(subworksheet_uuid, fetch_items=False).to_dict()
-                except UsageError, e:
+                subworksheet_info = subworksheet_dict.get(subworksheet_uuid)
+                if subworksheet_info is None:
                     # If can't get the subworksheet, it's probably invalid, so just replace it with an error
                     type = worksheet_util.TYPE_MARKUP
-                    subworksheet_info = None
                     value = 'ERROR: non-existent worksheet %s' % subworksheet_uuid
             else:
                 subworksheet_info = None
@@ -707,6 +760,29 @@ class LocalBundleClient(BundleClient):
             new_items.append((bundle_info, subworksheet_info, value_obj, type))
         return new_items
 
+    def _get_subworksheet_infos(self, uuids):
+        '''
+        Helper function: return a map from uuid to info dict for the worksheets
+        with the given uuids that exist, using O(1) database calls. Worksheets
+        that the current user can't read only get their uuid (and a placeholder
+        name), so that the items that link to them are kept.
+        '''
+        if len(uuids) == 0:
+            return {}
+        worksheets = self.model.batch_get_worksheets(fetch_items=False, uuid=list(uuids))
+        if len(worksheets) == 0:
+            return {}
+        owner_ids = dict((worksheet.uuid, worksheet.owner_id) for worksheet in worksheets)
+        permissions = self.model.get_user_worksheet_permissions(self._current_user_id(), owner_ids.keys(), owner_ids)
+        readable = [worksheet for worksheet in worksheets if permissions[worksheet.uuid] >= GROUP_OBJECT_PERMISSION_READ]
+        result = {}
+        for worksheet in worksheets:
+            result[worksheet.uuid] = {'uuid': worksheet.uuid, 'name': '<private>'}
+        for worksheet, owner_name in zip(readable, self._user_id_to_names([worksheet.owner_id for worksheet in readable])):
+            info = result[worksheet.uuid] = worksheet.to_dict()
+            info['owner_name'] = owner_name
+        return result
+
     @authentication_required
     def add_worksheet_item(self, worksheet_uuid, item):
         '''
@@ -721,6 +797,10 @@ class LocalBundleClient(BundleClient):
         '''
         Set the worksheet to have items |new_items|.
         '''
+        if worksheet_info.get('item_ids') is not None:
+            # Only write the items that changed.
+            patch = worksheet_util.get_worksheet_patch(worksheet_info, new_items)
+            return self.patch_worksheet(worksheet_info['uuid'], worksheet_info['last_item_id'], len(worksheet_info['items']), patch)
         worksheet_uuid = worksheet_info['uuid']
         last_item_id = worksheet_info['last_item_id']
         length = len(worksheet_info['items'])
@@ -733,6 +813,21 @@ class LocalBundleClient(BundleClient):
             # Turn the model error into a more readable one using the object.
             raise UsageError('%s was updated concurrently!' % (worksheet,))
 
+    @authentication_required
+    def patch_worksheet(self, uuid, last_item_id, length, patch):
+        '''
+        Apply a patch from worksheet_util.get_worksheet_patch to the worksheet,
+        whose items were fetched when the last item id was last_item_id and it
+        had length items.
+        '''
+        worksheet = self.model.get_worksheet(uuid, fetch_items=False)
+        check_worksheet_has_all_permission(self.model, self._current_user(), worksheet)
+        try:
+            self.model.patch_worksheet(uuid, last_item_id, length, patch)
+        except UsageError:
+            # Turn the model error into a more readable one using the object.
+            raise UsageError('%s was updated concurrently!' % (worksheet,))
+
     @authentication_required
     def rename_worksheet(self, uuid, name):
         worksheet = self.model.get_worksheet(uuid, fetch_items=False)
@@ -970,18 +1065,8 @@ class LocalBundleClient(BundleClient):
         '''
         check_bundles_have_all_permission(self.model, self._current_user(), bundle_uuids)
         group_info = self._get_group_info(group_spec, need_admin=False)
-
-        for bundle_uuid in bundle_uuids:
-            old_permission = self.model.get_group_bundle_permission(group_info['uuid'], bundle_uuid)
-            new_permission = parse_permission(permission_spec)
-            if new_permission > 0:
-                if old_permission > 0:
-                    self.model.update_bundle_permission(group_info['uuid'], bundle_uuid, new_permission)
-                else:
-                    self.model.add_bundle_permission(group_info['uuid'], bundle_uuid, new_permission)
-            else:
-                if old_permission > 0:
-                    self.model.delete_bundle_permission(group_info['uuid'], bundle_uuid)
+        new_permission = parse_permission(permission_spec)
+        self.model.set_group_bundle_permissions(bundle_uuids, [{'group_uuid': group_info['uuid'], 'permission': new_permission}])
         return {'group_info': group_info, 'permission': new_permission}
 
     @authentication_required
@@ -1028,3 +1113,30 @@ class LocalBundleClient(BundleClient):
             raise UsageError('Cannot modify the public group %s.' % group_spec)
 
         return group_info
+
+    #############################################################################
+    # Commands for following changes follow!
+    #############################################################################
+
+    def get_changes(self, since_seq, limit):
+        '''
+        Return the changes after since_seq (see BundleModel.get_changes), except
+        for changes to objects that the current user can't read. Deletions are
+        always returned.
+        '''
+        result = self.model.get_changes(since_seq, limit)
+        user_id = self._current_user_id()
+        readable_uuids = set()
+        for (object_type, get_owner_ids, get_permissions) in (
+            ('bundle', self.model.get_bundle_owner_ids, self.model.get_user_bundle_permissions),
+            ('worksheet', self.model.get_worksheet_owner_ids, self.model.get_user_worksheet_permissions),
+        ):
+            uuids = list(set(change['object_uuid'] for change in result['changes'] if change['object_type'] == object_type))
+            if uuids:
+                permissions = get_permissions(user_id, uuids, get_owner_ids(uuids))
+                readable_uuids.update(uuid for (uuid, permission) in permissions.iteritems() if permission >= GROUP_OBJECT_PERMISSION_READ)
+        result['changes'] = [
+            change for change in result['changes']
+            if change['change'] == 'delete' or change['object_uuid'] in readable_uuids
+        ]
+        return result
@@ -69,11 +69,13 @@ class RemoteBundleClient(BundleClient):
     CLIENT_COMMANDS = (
       'upload_bundle_url',
       'derive_bundle',
+      'derive_bundles',
       'update_bundle_metadata',
       'delete_bundles',
       'kill_bundles',
       'chown_bundles',
       'get_bundle_uuid',
+      'resolve_bundle_specs',
       'search_bundle_uuids',
       'get_bundle_info',
       'get_bundle_infos',
@@ -85,8 +87,10 @@ class RemoteBundleClient(BundleClient):
       'list_worksheets',
       'get_worksheet_uuid',
       'get_worksheet_info',
+      'get_worksheet_items',
       'add_worksheet_item',
       'update_worksheet',
+      'patch_worksheet',
       'rename_worksheet',
       'chown_worksheet',
       'delete_worksheet',
@@ -104,6 +108,8 @@ class RemoteBundleClient(BundleClient):
       'rm_user',
       'set_bundles_perm',
       'set_worksheet_perm',
+      # Commands for following changes.
+      'get_changes',
     )
     # Implemented by the BundleRPCServer.
     SERVER_COMMANDS = (
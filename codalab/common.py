@@ -54,10 +54,11 @@ class State(object):
     CREATED = 'created'
     STAGED = 'staged'
     RUNNING = 'running'
+    FINALIZING = 'finalizing'  # Done running; its results are being uploaded.
     READY = 'ready'
     FAILED = 'failed'
 
-    OPTIONS = set([CREATED, STAGED, RUNNING, READY, FAILED])
+    OPTIONS = set([CREATED, STAGED, RUNNING, FINALIZING, READY, FAILED])
     FINAL_STATES = set([READY, FAILED])
 
 class Command(object):
@@ -40,6 +40,7 @@ from codalab.lib import (
 )
 from codalab.objects.permission import permission_str, group_permissions_str
 from codalab.objects.worksheet import Worksheet
+from codalab.objects.scheduler import get_scheduler
 from codalab.objects.work_manager import Worker
 from codalab.machines.remote_machine import RemoteMachine
 from codalab.machines.local_machine import LocalMachine
@@ -199,14 +200,20 @@ class BundleCLI(object):
                 result.append(bundle_info)
         return result
 
+    def split_target(self, target_spec):
+        '''
+        Helper: split a target_spec, which is a bundle_spec[/subpath], into
+        (bundle_spec, subpath).
+        '''
+        if os.sep in target_spec:
+            return tuple(target_spec.split(os.sep, 1))
+        return (target_spec, '')
+
     def parse_target(self, client, worksheet_uuid, target_spec):
         '''
         Helper: A target_spec is a bundle_spec[/subpath].
         '''
-        if os.sep in target_spec:
-            bundle_spec, subpath = tuple(target_spec.split(os.sep, 1))
-        else:
-            bundle_spec, subpath = target_spec, ''
+        bundle_spec, subpath = self.split_target(target_spec)
         # Resolve the bundle_spec to a particular bundle_uuid.
         bundle_uuid = worksheet_util.get_bundle_uuid(client, worksheet_uuid, bundle_spec)
         return (bundle_uuid, subpath)
@@ -215,6 +222,7 @@ class BundleCLI(object):
         '''
         Helper: items is a list of strings which are [<key>]:<target>
         '''
+        keys = []
         targets = []
         # Turn targets into a dict mapping key -> (uuid, subpath)) tuples.
         for item in items:
@@ -224,13 +232,16 @@ class BundleCLI(object):
             else:
                 # Provide syntactic sugar for a make bundle with a single anonymous target.
                 (key, target) = ('', item)
-            if key in targets:
+            if key in keys:
                 if key:
                     raise UsageError('Duplicate key: %s' % (key,))
                 else:
                     raise UsageError('Must specify keys when packaging multiple targets!')
-            targets.append((key, self.parse_target(client, worksheet_uuid, target)))
-        return targets
+            keys.append(key)
+            targets.append(self.split_target(target))
+        # Resolve all the bundle_specs at once.
+        bundle_uuids = worksheet_util.get_bundle_uuids(client, worksheet_uuid, [bundle_spec for (bundle_spec, _) in targets])
+        return [(key, (bundle_uuid, subpath)) for (key, bundle_uuid, (_, subpath)) in zip(keys, bundle_uuids, targets)]
 
     def print_table(self, columns, row_dicts, post_funcs={}, justify={}, show_header=True, indent=''):
         '''
@@ -273,6 +284,7 @@ class BundleCLI(object):
     PERMISSION_SPEC_FORMAT = '((n)one|(r)ead|(a)ll)'
 
     UUID_POST_FUNC = '[0:8]'  # Only keep first 8 characters
+    WORKSHEET_WINDOW_SIZE = 500  # Number of worksheet items to fetch at a time when printing
 
     def parse_spec(self, spec):
         '''
@@ -519,20 +531,26 @@ class BundleCLI(object):
 
         client, worksheet_uuid = self.manager.get_current_worksheet_uuid()
 
-        # Source bundle
-        source_bundle_uuids = []
+        # Source bundles, resolved in one batch per run of specs on the same client
+        client_specs = []  # [(source_client, [source_spec])]
         for bundle_spec in args.bundle_spec:
             (source_client, source_spec) = self.parse_spec(bundle_spec)
+            if client_specs and client_specs[-1][0] == source_client:
+                client_specs[-1][1].append(source_spec)
+            else:
+                client_specs.append((source_client, [source_spec]))
+        source_bundles = []  # [(source_client, source_bundle_uuid)]
+        for (source_client, source_specs) in client_specs:
             # worksheet_uuid is only applicable if we're on the source client
-            if source_client != client: worksheet_uuid = None
-            source_bundle_uuid = worksheet_util.get_bundle_uuid(source_client, worksheet_uuid, source_spec)
-            source_bundle_uuids.append(source_bundle_uuid)
+            source_worksheet_uuid = worksheet_uuid if source_client == client else None
+            for source_bundle_uuid in worksheet_util.get_bundle_uuids(source_client, source_worksheet_uuid, source_specs):
+                source_bundles.append((source_client, source_bundle_uuid))
 
         # Destination worksheet
         (dest_client, dest_worksheet_uuid) = self.parse_client_worksheet_uuid(args.worksheet_spec)
 
         # Copy!
-        for source_bundle_uuid in source_bundle_uuids:
+        for (source_client, source_bundle_uuid) in source_bundles:
             self.copy_bundle(source_client, source_bundle_uuid, dest_client, dest_worksheet_uuid, copy_dependencies=args.copy_dependencies)
 
     def copy_bundle(self, source_client, source_bundle_uuid, dest_client, dest_worksheet_uuid, copy_dependencies):
@@ -679,7 +697,7 @@ class BundleCLI(object):
         client, worksheet_uuid = self.parse_client_worksheet_uuid(args.worksheet_spec)
         # Resolve all the bundles first, then hide.
         # This is important since some of the bundle specs (^1 ^2) are relative.
-        bundle_uuids = [worksheet_util.get_bundle_uuid(client, worksheet_uuid, bundle_spec) for bundle_spec in args.bundle_spec]
+        bundle_uuids = worksheet_util.get_bundle_uuids(client, worksheet_uuid, args.bundle_spec)
         worksheet_info = client.get_worksheet_info(worksheet_uuid, True)
 
         # Number the bundles: c c a b c => 3 2 1 1 1
@@ -713,7 +731,8 @@ class BundleCLI(object):
             if not hide:
                 new_items.append(item)
 
-        client.update_worksheet(worksheet_info, new_items)
+        client.patch_worksheet(worksheet_info['uuid'], worksheet_info['last_item_id'], len(worksheet_info['items']),
+                               worksheet_util.get_worksheet_patch(worksheet_info, new_items))
 
     def do_rm_command(self, argv, parser):
         parser.add_argument('bundle_spec', help=self.BUNDLE_SPEC_FORMAT, nargs='+')
@@ -728,7 +747,7 @@ class BundleCLI(object):
         client, worksheet_uuid = self.parse_client_worksheet_uuid(args.worksheet_spec)
         # Resolve all the bundles first, then delete.
         # This is important since some of the bundle specs (^1 ^2) are relative.
-        bundle_uuids = [worksheet_util.get_bundle_uuid(client, worksheet_uuid, bundle_spec) for bundle_spec in args.bundle_spec]
+        bundle_uuids = worksheet_util.get_bundle_uuids(client, worksheet_uuid, args.bundle_spec)
         deleted_uuids = client.delete_bundles(bundle_uuids, args.force, args.recursive, args.data_only, args.dry_run)
         if args.dry_run:
             print 'This command would permanently remove the following bundles (not doing so yet):'
@@ -820,8 +839,8 @@ class BundleCLI(object):
         args.bundle_spec = spec_util.expand_specs(args.bundle_spec)
 
         client, worksheet_uuid = self.parse_client_worksheet_uuid(args.worksheet_spec)
-        for i, bundle_spec in enumerate(args.bundle_spec):
-            bundle_uuid = worksheet_util.get_bundle_uuid(client, worksheet_uuid, bundle_spec)
+        bundle_uuids = worksheet_util.get_bundle_uuids(client, worksheet_uuid, args.bundle_spec)
+        for i, bundle_uuid in enumerate(bundle_uuids):
             info = client.get_bundle_info(bundle_uuid, args.verbose, args.verbose, args.verbose)
             if info is None:
                 raise UsageError('Unable to retrieve information about bundle with uuid %s' % bundle_uuid)
@@ -1087,7 +1106,7 @@ class BundleCLI(object):
         '''
         client, worksheet_uuid = self.parse_client_worksheet_uuid(args.worksheet_spec)
 
-        bundle_uuids = [worksheet_util.get_bundle_uuid(client, worksheet_uuid, spec) for spec in args.bundles]
+        bundle_uuids = worksheet_util.get_bundle_uuids(client, worksheet_uuid, args.bundles)
 
         # Two cases for args.bundles
         # (A) old_input_1 ... old_input_n            new_input_1 ... new_input_n [go to all outputs]
@@ -1121,10 +1140,8 @@ class BundleCLI(object):
         args.bundle_spec = spec_util.expand_specs(args.bundle_spec)
 
         client, worksheet_uuid = self.parse_client_worksheet_uuid(args.worksheet_spec)
-        bundle_uuids = []
-        for bundle_spec in args.bundle_spec:
-            bundle_uuid = worksheet_util.get_bundle_uuid(client, worksheet_uuid, bundle_spec)
-            bundle_uuids.append(bundle_uuid)
+        bundle_uuids = worksheet_util.get_bundle_uuids(client, worksheet_uuid, args.bundle_spec)
+        for bundle_uuid in bundle_uuids:
             print bundle_uuid
         client.kill_bundles(bundle_uuids)
 
@@ -1158,8 +1175,9 @@ class BundleCLI(object):
         args.bundle_spec = spec_util.expand_specs(args.bundle_spec)
 
         client, worksheet_uuid = self.parse_client_worksheet_uuid(args.worksheet_spec)
-        for spec in args.bundle_spec:
-            bundle_uuid = worksheet_util.get_bundle_uuid(client, worksheet_uuid, spec)
+        # Resolve all the bundles first, so that relative specs (^1 ^2) refer to
+        # the worksheet as it was before adding any of them.
+        for bundle_uuid in worksheet_util.get_bundle_uuids(client, worksheet_uuid, args.bundle_spec):
             client.add_worksheet_item(worksheet_uuid, worksheet_util.bundle_item(bundle_uuid))
         if args.message != None:
             if args.message.startswith('%'):
@@ -1214,7 +1232,8 @@ class BundleCLI(object):
             new_items, commands = worksheet_util.parse_worksheet_form(lines, client, worksheet_info['uuid'])
 
             # Save the worksheet.
-            client.update_worksheet(worksheet_info, new_items)
+            client.patch_worksheet(worksheet_info['uuid'], worksheet_info['last_item_id'], len(worksheet_info['items']),
+                                   worksheet_util.get_worksheet_patch(worksheet_info, new_items))
             print 'Saved worksheet %s(%s).' % (worksheet_info['name'], worksheet_info['uuid'])
 
             # Batch the rm commands so that we can handle the recursive
@@ -1245,18 +1264,34 @@ class BundleCLI(object):
     def do_print_command(self, argv, parser):
         parser.add_argument('worksheet_spec', help=self.WORKSHEET_SPEC_FORMAT, nargs='?')
         parser.add_argument('-r', '--raw', action='store_true', help='print out the raw contents')
+        parser.add_argument('--offset', type=int, default=0, help='start at the item with this (0-based) position')
+        parser.add_argument('--limit', type=int, help='print at most this many items')
         args = parser.parse_args(argv)
 
         client, worksheet_uuid = self.parse_client_worksheet_uuid(args.worksheet_spec)
-        worksheet_info = client.get_worksheet_info(worksheet_uuid, True)
         if args.raw:
+            worksheet_info = client.get_worksheet_info(worksheet_uuid, True)
             lines = worksheet_util.get_worksheet_lines(worksheet_info)
             for line in lines:
                 print line
         else:
+            worksheet_info = client.get_worksheet_info(worksheet_uuid, False)
             print self._worksheet_description(worksheet_info)
-            interpreted = worksheet_util.interpret_items(worksheet_util.get_default_schemas(), worksheet_info['items'])
-            self.display_interpreted(client, worksheet_info, interpreted)
+            # Fetch and print the items a window at a time, so that large
+            # worksheets start printing right away.
+            offset = args.offset
+            end = offset + args.limit if args.limit is not None else None
+            while end is None or offset < end:
+                limit = self.WORKSHEET_WINDOW_SIZE if end is None else min(self.WORKSHEET_WINDOW_SIZE, end - offset)
+                window = client.get_worksheet_items(worksheet_uuid, offset, limit)
+                interpreted = worksheet_util.interpret_items(worksheet_util.get_default_schemas(),
+                                                             window['context_items'] + window['items'])
+                if offset > args.offset:
+                    interpreted.pop('title', None)  # Already printed
+                self.display_interpreted(client, worksheet_info, interpreted)
+                offset += len(window['items'])
+                if not window['items'] or offset >= window['num_items']:
+                    break
 
     def display_interpreted(self, client, worksheet_info, interpreted):
         title = interpreted.get('title')
@@ -1453,7 +1488,7 @@ class BundleCLI(object):
         args.bundle_spec = spec_util.expand_specs(args.bundle_spec)
 
         client, worksheet_uuid = self.parse_client_worksheet_uuid(args.worksheet_spec)
-        bundle_uuids = [worksheet_util.get_bundle_uuid(client, worksheet_uuid, spec) for spec in args.bundle_spec]
+        bundle_uuids = worksheet_util.get_bundle_uuids(client, worksheet_uuid, args.bundle_spec)
         result = client.set_bundles_perm(bundle_uuids, args.group_spec, args.permission_spec)
         print "Group %s(%s) has %s permission on %d bundles." % \
             (result['group_info']['name'], result['group_info']['uuid'],
@@ -1482,7 +1517,7 @@ class BundleCLI(object):
         args.bundle_spec = spec_util.expand_specs(args.bundle_spec)
         client, worksheet_uuid = self.parse_client_worksheet_uuid(args.worksheet_spec)
 
-        bundle_uuids = [worksheet_util.get_bundle_uuid(client, worksheet_uuid, spec) for spec in args.bundle_spec]
+        bundle_uuids = worksheet_util.get_bundle_uuids(client, worksheet_uuid, args.bundle_spec)
         client.chown_bundles(bundle_uuids, args.user_spec)
         for uuid in bundle_uuids: print uuid
 
@@ -1495,11 +1530,15 @@ class BundleCLI(object):
         parser.add_argument('-t', '--worker-type', type=str, help="worker type (defined in config.json)", default='local')
         parser.add_argument('--num-iterations', help="number of bundles to process before exiting", type=int, default=None)
         parser.add_argument('--sleep-time', type=int, help='Number of seconds to wait between successive polls', default=1)
+        parser.add_argument('--worker-id', help='unique id of this worker, to run several workers against the same database', default=None)
+        parser.add_argument('--lease-time', type=int, help='Number of seconds that the bundles of a worker with a --worker-id stay claimed after it stops', default=300)
+        parser.add_argument('--num-finalizers', type=int, help='Number of threads that upload the results of finished bundles (0 to upload them in the worker loop)', default=2)
+        parser.add_argument('--poll-time', type=int, help='Number of seconds to wait between successive polls when idle, if the server is configured to wake up workers (worker_wakeup)', default=60)
         args = parser.parse_args(argv)
 
         worker_config = self.manager.config['workers']
         if args.worker_type == 'local':
-            machine = LocalMachine()
+            machine = LocalMachine(worker_config.get('local'))
         elif args.worker_type in worker_config:
             machine = RemoteMachine(worker_config[args.worker_type])
         else:
@@ -1508,9 +1547,12 @@ class BundleCLI(object):
             print 'Options are ' + str(map(str, worker_config.keys()))
             return
 
+        machine_config = worker_config.get(args.worker_type) or {}
+        scheduler = get_scheduler(machine_config.get('scheduler'))
         client = self.manager.local_client()  # Always use the local bundle client
-        worker = Worker(client.bundle_store, client.model, machine, client.auth_handler)
-        worker.run_loop(args.num_iterations, args.sleep_time)
+        worker = Worker(client.bundle_store, client.model, machine, client.auth_handler, args.worker_id, args.lease_time, scheduler,
+                        machine_config.get('reuse_runs', False), machine_config.get('start_batch_size', 1), args.num_finalizers)
+        worker.run_loop(args.num_iterations, args.sleep_time, args.poll_time)
 
     def do_cleanup_command(self, argv, parser):
         # This command only works if client is a LocalBundleClient.
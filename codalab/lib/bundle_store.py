@@ -148,8 +148,10 @@ class BundleStore(object):
         If the given data hash is not needed by any bundle (not in
         except_bundle_uuids), delete the data.
         '''
-        bundles = model.batch_get_bundles(data_hash=data_hash)
-        if all(bundle.uuid in except_bundle_uuids for bundle in bundles):
+        # A stale replica might not know about a new bundle that uses this data.
+        with model.read_from_primary():
+            bundles = model.batch_get_bundle_fields(['uuid'], data_hash=data_hash)
+        if all(bundle['uuid'] in except_bundle_uuids for bundle in bundles):
             absolute_path = self.get_location(data_hash)
             print >>sys.stderr, "cleanup: data %s" % absolute_path
             if not dry_run:
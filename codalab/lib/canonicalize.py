@@ -1,6 +1,7 @@
 '''
 canonicalize provides helpers that convert ambiguous inputs to canonical forms:
   get_bundle_uuid: bundle_spec (which is <uuid>|<name>) -> uuid
+  get_bundle_uuids: list of bundle_specs -> list of uuids, in one batch
   get_worksheet_uuid: worksheet_spec -> uuid
   get_target_path: target (bundle_spec, subpath) -> filesystem path
 
@@ -9,6 +10,8 @@ Converting a bundle spec to a uuid requires access to the bundle databases,
 while getting the on-disk location of a target requires access to both the
 database and the bundle store.
 '''
+import collections
+
 from codalab.common import (
   precondition,
   State,
@@ -20,6 +23,65 @@ from codalab.lib import (
 )
 from codalab.model.util import LikeQuery
 
+def _get_bundle_uuids_query(user_id, worksheet_uuid, bundle_spec):
+    '''
+    Return the (conditions, max_results) arguments of the model.get_bundle_uuids
+    query that resolves bundle_spec, which is not a uuid.
+    '''
+    if spec_util.UUID_PREFIX_REGEX.match(bundle_spec):
+        return ({'uuid': LikeQuery(bundle_spec + '%'), 'user_id': user_id}, 2)
+
+    def match(bundle_spec):
+        m = spec_util.NAME_PATTERN_REGEX.match(bundle_spec)  # run: bundle whose name starts with foo
+        if m:
+            bundle_spec = m.group(1)
+            last_index = 1
+            return (bundle_spec, last_index)
+        m = spec_util.NAME_PATTERN_HISTORY_REGEX.match(bundle_spec)  # foo^3: 3rd to last bundle whose name starts with foo
+        if m:
+            bundle_spec = m.group(1)
+            last_index = int(m.group(2)) if m.group(2) != '' else 1
+            return (bundle_spec, last_index)
+        m = spec_util.HISTORY_REGEX.match(bundle_spec)  # ^3: 3rd to last bundle whose name starts with foo in this worksheet
+        if m:
+            bundle_spec = None
+            last_index = int(m.group(1)) if m.group(1) != '' else 1
+            return (bundle_spec, last_index)
+        raise UsageError('Invalid bundle_spec: %s' % bundle_spec)
+    bundle_spec, last_index = match(bundle_spec)
+
+    if bundle_spec:
+        bundle_spec = bundle_spec.replace('.*', '%')  # Convert regular expression syntax to SQL syntax
+        if '%' in bundle_spec:
+            bundle_spec_query = LikeQuery(bundle_spec) 
+        else:
+            bundle_spec_query = bundle_spec
+    else:
+        bundle_spec_query = None
+    return ({
+        'name': bundle_spec_query,
+        'worksheet_uuid': worksheet_uuid,
+        'user_id': user_id
+    }, last_index)
+
+def _select_bundle_uuid(bundle_spec, conditions, max_results, bundle_uuids):
+    '''
+    Return the bundle uuid that bundle_spec refers to, given the results of
+    the query returned by _get_bundle_uuids_query.
+    '''
+    if 'uuid' in conditions:
+        if len(bundle_uuids) == 0:
+            raise UsageError('uuid prefix %s doesn\'t match any bundles' % bundle_spec)
+        elif len(bundle_uuids) == 1:
+            return bundle_uuids[0]
+        else:
+            raise UsageError('uuid prefix %s more than one bundle' % bundle_spec)
+    # Take the last bundle
+    last_index = max_results
+    if last_index <= 0 or last_index > len(bundle_uuids):
+        raise UsageError('bundle spec %s doesn\'t match (want index %d out of %d bundles)' % (conditions['name'], last_index, len(bundle_uuids)))
+    return bundle_uuids[last_index - 1]
+
 def get_bundle_uuid(model, user_id, worksheet_uuid, bundle_spec):
     '''
     Resolve a string bundle_spec to a bundle uuid.
@@ -28,59 +90,31 @@ def get_bundle_uuid(model, user_id, worksheet_uuid, bundle_spec):
     - name[^[<index>]: there might be many uuids with this name.
     - ^[<index>], where index is the i-th (1-based) most recent element on the current worksheet.
     '''
-    orig_bundle_spec = bundle_spec
     if not bundle_spec:
         raise UsageError('Tried to expand empty bundle_spec!')
     if spec_util.UUID_REGEX.match(bundle_spec):
         return bundle_spec
-    elif spec_util.UUID_PREFIX_REGEX.match(bundle_spec):
-        bundle_uuids = model.get_bundle_uuids({'uuid': LikeQuery(bundle_spec + '%'), 'user_id': user_id}, max_results=2)
-        if len(bundle_uuids) == 0:
-            raise UsageError('uuid prefix %s doesn\'t match any bundles' % bundle_spec)
-        elif len(bundle_uuids) == 1:
-            return bundle_uuids[0]
-        else:
-            raise UsageError('uuid prefix %s more than one bundle' % bundle_spec)
-    else:
-        def match(bundle_spec):
-            m = spec_util.NAME_PATTERN_REGEX.match(bundle_spec)  # run: bundle whose name starts with foo
-            if m:
-                bundle_spec = m.group(1)
-                last_index = 1
-                return (bundle_spec, last_index)
-            m = spec_util.NAME_PATTERN_HISTORY_REGEX.match(bundle_spec)  # foo^3: 3rd to last bundle whose name starts with foo
-            if m:
-                bundle_spec = m.group(1)
-                last_index = int(m.group(2)) if m.group(2) != '' else 1
-                return (bundle_spec, last_index)
-            m = spec_util.HISTORY_REGEX.match(bundle_spec)  # ^3: 3rd to last bundle whose name starts with foo in this worksheet
-            if m:
-                bundle_spec = None
-                last_index = int(m.group(1)) if m.group(1) != '' else 1
-                return (bundle_spec, last_index)
-            raise UsageError('Invalid bundle_spec: %s' % bundle_spec)
-        bundle_spec, last_index = match(bundle_spec)
-
-        if bundle_spec:
-            bundle_spec = bundle_spec.replace('.*', '%')  # Convert regular expression syntax to SQL syntax
-            if '%' in bundle_spec:
-                bundle_spec_query = LikeQuery(bundle_spec) 
-            else:
-                bundle_spec_query = bundle_spec
-        else:
-            bundle_spec_query = None
-        #print bundle_spec_query, last_index
+    (conditions, max_results) = _get_bundle_uuids_query(user_id, worksheet_uuid, bundle_spec)
+    bundle_uuids = model.get_bundle_uuids(conditions, max_results=max_results)
+    return _select_bundle_uuid(bundle_spec, conditions, max_results, bundle_uuids)
 
-        bundle_uuids = model.get_bundle_uuids({
-            'name': bundle_spec_query,
-            'worksheet_uuid': worksheet_uuid,
-            'user_id': user_id
-        }, max_results=last_index)
-        message = "name pattern '%s'" % (bundle_spec,)
-    # Take the last bundle
-    if last_index <= 0 or last_index > len(bundle_uuids):
-        raise UsageError('bundle spec %s doesn\'t match (want index %d out of %d bundles)' % (bundle_spec, last_index, len(bundle_uuids)))
-    return bundle_uuids[last_index - 1]
+def get_bundle_uuids(model, user_id, worksheet_uuid, bundle_specs):
+    '''
+    Resolve a list of bundle_specs (see get_bundle_uuid) to a list of bundle
+    uuids, looking up all the specs that aren't uuids with one
+    model.batch_get_bundle_uuids call.
+    '''
+    queries = collections.OrderedDict()  # bundle_spec -> (conditions, max_results)
+    for bundle_spec in bundle_specs:
+        if not bundle_spec:
+            raise UsageError('Tried to expand empty bundle_spec!')
+        if not spec_util.UUID_REGEX.match(bundle_spec) and bundle_spec not in queries:
+            queries[bundle_spec] = _get_bundle_uuids_query(user_id, worksheet_uuid, bundle_spec)
+    results = model.batch_get_bundle_uuids(queries.values()) if queries else []
+    bundle_uuids = {}
+    for ((bundle_spec, (conditions, max_results)), result) in zip(queries.iteritems(), results):
+        bundle_uuids[bundle_spec] = _select_bundle_uuid(bundle_spec, conditions, max_results, result)
+    return [bundle_uuids.get(bundle_spec, bundle_spec) for bundle_spec in bundle_specs]
 
 def get_current_location(bundle_store, uuid):
     '''
@@ -93,12 +127,15 @@ def get_target_path(bundle_store, model, target):
     Return the on-disk location of the target (bundle_uuid, subpath) pair.
     '''
     (uuid, path) = target
-    bundle = model.get_bundle(uuid)
-    if not bundle.data_hash:
+    bundles = model.batch_get_bundle_fields(['data_hash'], uuid=uuid)
+    if not bundles:
+        raise UsageError('Could not find bundle with uuid %s' % (uuid,))
+    data_hash = bundles[0]['data_hash']
+    if not data_hash:
         # Note that the bundle might not be done, but return the location anyway to the temporary directory
         bundle_root = get_current_location(bundle_store, uuid)
     else:
-        bundle_root = bundle_store.get_location(bundle.data_hash)
+        bundle_root = bundle_store.get_location(data_hash)
     final_path = path_util.safe_join(bundle_root, path)
 
     # This is too restrictive because it means we can't follow any of the
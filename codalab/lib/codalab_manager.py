@@ -181,14 +181,27 @@ class CodaLabManager(object):
         model = None
         if model_class == 'MySQLModel':
             from codalab.model.mysql_model import MySQLModel
-            model = MySQLModel(engine_url=self.config['server']['engine_url'])
+            model = MySQLModel(engine_url=self.config['server']['engine_url'],
+                               replica_urls=self.config['server'].get('replica_engine_urls', []),
+                               replica_lag=self.config['server'].get('replica_lag', 10))
         elif model_class == 'SQLiteModel':
             codalab_home = self.codalab_home()
             from codalab.model.sqlite_model import SQLiteModel
-            model = SQLiteModel(codalab_home)
+            model = SQLiteModel(codalab_home, self.config['server'].get('sqlite', {}))
         else:
             raise UsageError('Unexpected model class: %s, expected MySQLModel or SQLiteModel' % (model_class,))
         model.root_user_id = self.root_user_id()
+        model.query_log.slow_threshold = self.config['server'].get('slow_query_threshold')
+        model.query_log.slow_log_path = self.config['server'].get('slow_query_log')
+        model.metadata_storage = self.config['server'].get('metadata_storage', 'table')
+        from codalab.model.statement_cache import StatementCache
+        statement_cache_size = self.config['server'].get('statement_cache_size', 1000)
+        model.statement_cache = StatementCache(statement_cache_size, model.query_log) if statement_cache_size else None
+        # {port: ..., hosts: [...]}: wake up the worker(s) listening on this UDP port on these hosts.
+        worker_wakeup = self.config['server'].get('worker_wakeup')
+        if worker_wakeup:
+            from codalab.model.worker_wakeup import WorkerWakeup
+            model.worker_wakeup = WorkerWakeup(worker_wakeup['port'], worker_wakeup.get('hosts', ['localhost']))
         return model
 
     def auth_handler(self, mock=False):
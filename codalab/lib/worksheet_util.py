@@ -3,6 +3,7 @@ worksheet_util contains the following public functions:
 - request_lines: pops up an editor to allow for full-text editing of a worksheet.
 - parse_worksheet_form: takes those lines and generates a set of items (triples)
 - interpret_items: takes those triples and returns a structure that interprets all the directives in the worksheet item.
+- get_context_items: returns the directives that a window of items starting after the given ones needs to be interpreted.
 
 A worksheet contains a list of (worksheet) items, where each item includes
 - bundle_uuid (only used if type == bundle)
@@ -26,7 +27,10 @@ A genpath (generalized path) is either:
 
 See get_worksheet_lines for documentation on the specification of the directives.
 '''
+import collections
 import copy
+import difflib
+import itertools
 import os
 import re
 import subprocess
@@ -110,6 +114,64 @@ def convert_item_to_db(item):
     if not value: value = ''  # TODO: change tables.py so that None's are allowed
     return (bundle_uuid, subworksheet_uuid, value, type)
 
+def diff_items(old_items, old_item_ids, new_items):
+    '''
+    Return a patch that turns old_items (with database ids old_item_ids) into
+    new_items, to pass to patch_worksheet. Items are in the database form (see
+    convert_item_to_db). Items that are unchanged aren't in the patch at all,
+    and items that only changed position are moved instead of deleted and
+    inserted again.
+    '''
+    old_items = [tuple(item) for item in old_items]
+    new_items = [tuple(item) for item in new_items]
+    matcher = difflib.SequenceMatcher(None, old_items, new_items, autojunk=False)
+    kept = {}  # new index => old index of the items that stay in place
+    for (i, j, n) in matcher.get_matching_blocks():
+        for k in range(n):
+            kept[j + k] = i + k
+    kept_old = set(kept.itervalues())
+    removed = collections.defaultdict(list)  # item => old indices that aren't kept
+    for (i, item) in enumerate(old_items):
+        if i not in kept_old:
+            removed[item].append(i)
+    moved = {}  # new index => old index of the items that are moved
+    for (j, item) in enumerate(new_items):
+        if j not in kept and removed.get(item):
+            moved[j] = removed[item].pop(0)
+
+    patch = []
+    deleted_ids = sorted(old_item_ids[i] for indices in removed.itervalues() for i in indices)
+    if deleted_ids:
+        patch.append(('delete', deleted_ids))
+    # Place each run of moved and new items before the next item that stays in place.
+    run = []
+    def flush(before_item_id):
+        for (is_move, group) in itertools.groupby(run, lambda j: j in moved):
+            group = list(group)
+            if is_move:
+                patch.append(('move', [old_item_ids[moved[j]] for j in group], before_item_id))
+            else:
+                patch.append(('insert', before_item_id, [new_items[j] for j in group]))
+        del run[:]
+    for j in range(len(new_items)):
+        if j in kept:
+            flush(old_item_ids[kept[j]])
+        else:
+            run.append(j)
+    flush(None)
+    return patch
+
+def get_worksheet_patch(worksheet_info, new_items):
+    '''
+    Return the patch that replaces the items of worksheet_info (fetched with
+    its items) with new_items, both in the full form used in the code.
+    '''
+    return diff_items(
+        [convert_item_to_db(item) for item in worksheet_info['items']],
+        worksheet_info['item_ids'],
+        [convert_item_to_db(item) for item in new_items],
+    )
+
 def get_worksheet_lines(worksheet_info):
     '''
     Generator that returns pretty-printed lines of text for the given worksheet.
@@ -213,6 +275,30 @@ def get_bundle_uuid(client, worksheet_uuid, bundle_spec):
         bundle_uuid = client.get_bundle_uuid(worksheet_uuid, bundle_spec)
     return bundle_uuid
 
+def get_bundle_uuids(client, worksheet_uuid, bundle_specs):
+    '''
+    Return the bundle_uuids corresponding to bundle_specs, like get_bundle_uuid,
+    but with one client.resolve_bundle_specs call per worksheet that the specs
+    refer to (none if they are all uuids).
+    '''
+    bundle_uuids = [None] * len(bundle_specs)
+    worksheet_specs = collections.defaultdict(list)  # worksheet_uuid -> [(index, bundle_spec)]
+    for (i, bundle_spec) in enumerate(bundle_specs):
+        bundle_spec = bundle_spec.strip()
+        if spec_util.UUID_REGEX.match(bundle_spec):
+            bundle_uuids[i] = bundle_spec  # Already uuid, don't need to look up specification
+            continue
+        spec_worksheet_uuid = worksheet_uuid
+        if '/' in bundle_spec:  # <worksheet_spec>/<bundle_spec>
+            worksheet_spec, bundle_spec = bundle_spec.split('/', 1)
+            spec_worksheet_uuid = get_worksheet_uuid(client, worksheet_uuid, worksheet_spec)
+        worksheet_specs[spec_worksheet_uuid].append((i, bundle_spec))
+    for (spec_worksheet_uuid, specs) in worksheet_specs.iteritems():
+        uuids = client.resolve_bundle_specs(spec_worksheet_uuid, [bundle_spec for (_, bundle_spec) in specs])
+        for ((i, _), bundle_uuid) in zip(specs, uuids):
+            bundle_uuids[i] = bundle_uuid
+    return bundle_uuids
+
 def get_worksheet_uuid(client, base_worksheet_uuid, worksheet_spec):
     '''
     Same thing as get_bundle_uuid, but for worksheets.
@@ -494,6 +580,37 @@ def get_default_schemas():
     schemas['run'] = canonicalize_schema_items([['name'], created, ['dependencies'], ['command'], ['state'], time])
     return schemas
 
+def get_context_items(items):
+    '''
+    items: list of worksheet items (in the database form) that come before a
+    window of items.
+    Return the directive items that have to be prepended to the window so that
+    interpret_items interprets it as it would in the full list: the title and
+    schema definitions, and the display directive that is still in effect.
+    '''
+    context_items = []
+    display_item = None
+    in_group = False  # Whether bundles have been shown with display_item
+    for item in items:
+        (bundle_uuid, subworksheet_uuid, value, type) = item
+        if type == TYPE_BUNDLE:
+            in_group = True
+            continue
+        # Any other item ends a group of bundles, which resets the display.
+        if in_group:
+            display_item = None
+            in_group = False
+        if type == TYPE_DIRECTIVE:
+            tokens = string_to_tokens(value)
+            command = tokens[0] if len(tokens) > 0 else None
+            if command in ('title', 'schema', 'addschema', 'add'):
+                context_items.append(item)
+            elif command == 'display':
+                display_item = item
+    if display_item:
+        context_items.append(display_item)
+    return context_items
+
 def interpret_items(schemas, items):
     '''
     schemas: initial mapping from name to list of schema items (columns of a table)
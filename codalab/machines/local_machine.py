@@ -1,9 +1,12 @@
+import multiprocessing
 import os
 import sys
 import subprocess
+import traceback
 
 from codalab.lib import (
   canonicalize,
+  formatting,
   path_util,
 )
 
@@ -13,17 +16,59 @@ class LocalMachine(Machine):
     '''
     Run commands on the local machine.  This is for simple testing or personal
     use only, since there is no security.
+
+    Several bundles can run at once, as long as the CPUs and memory they request
+    (request_cpus, default 1, and request_memory) fit in what the machine has
+    (see __init__). A bundle that requests more than the whole machine runs
+    when nothing else is running. A bundle stops counting once its process has
+    exited, even if it isn't finalized yet (e.g., while the worker uploads its
+    results in the background).
     '''
-    def __init__(self):
-        self.bundle = None
-        self.process = None
-        self.temp_dir = None
+    def __init__(self, config=None):
+        '''
+        config (the 'local' entry of 'workers' in config.json) can contain:
+          cpus: number of CPUs that the running bundles can use in total (default 1).
+          memory: amount of memory (e.g., 16g) that they can use in total (default: no limit).
+          pin_cpus: whether to pin each bundle to its own CPUs with taskset.
+        '''
+        config = config or {}
+        self.cpus = config.get('cpus', 1)
+        self.memory = formatting.parse_size(config['memory']) if config.get('memory') else None
+        self.pin_cpus = config.get('pin_cpus', False)
+        self.jobs = {}  # job_handle => {bundle, process, temp_dir, cpus, memory, cpu_ids}
+
+    def _get_request(self, bundle):
+        cpus = getattr(bundle.metadata, 'request_cpus', None) or 1
+        memory = getattr(bundle.metadata, 'request_memory', None)
+        return (cpus, formatting.parse_size(memory) if memory else 0)
+
+    def _running_jobs(self):
+        return [job for job in self.jobs.itervalues() if job['process'].poll() is None]
+
+    def _free_cpu_ids(self):
+        used_cpu_ids = set(cpu_id for job in self._running_jobs() for cpu_id in job['cpu_ids'])
+        return [cpu_id for cpu_id in range(multiprocessing.cpu_count()) if cpu_id not in used_cpu_ids]
+
+    def can_start(self, cpus, memory):
+        '''
+        Return whether a bundle requesting the given CPUs and memory (in bytes)
+        can start now.
+        '''
+        jobs = self._running_jobs()
+        if not jobs:
+            return True
+        if sum(job['cpus'] for job in jobs) + cpus > self.cpus:
+            return False
+        if self.memory is not None and sum(job['memory'] for job in jobs) + memory > self.memory:
+            return False
+        return True
 
     def start_bundle(self, bundle, bundle_store, parent_dict, username):
         '''
-        Start a bundle in the background.
+        Start a bundle in the background, if there is room for it.
         '''
-        if self.bundle != None: return None
+        (cpus, memory) = self._get_request(bundle)
+        if not self.can_start(cpus, memory): return None
         temp_dir = canonicalize.get_current_location(bundle_store, bundle.uuid)
         path_util.make_directory(temp_dir)
 
@@ -43,43 +88,67 @@ class LocalMachine(Machine):
         with open(script_file, 'w') as f:
             f.write("cd %s &&\n" % temp_dir)
             f.write('(%s) > stdout 2>stderr\n' % bundle.command)
+        command = "bash " + script_file
         # Use stdbuf (if it exists) to turn off buffering so we get real-time feedback.
         if os.path.exists('/usr/bin/stdbuf'):
-            process = subprocess.Popen("/usr/bin/stdbuf -o0 bash " + script_file, shell=True)
-        else:
-            process = subprocess.Popen("bash " + script_file, shell=True)
+            command = "/usr/bin/stdbuf -o0 " + command
+        cpu_ids = []
+        if self.pin_cpus and os.path.exists('/usr/bin/taskset'):
+            free_cpu_ids = self._free_cpu_ids()
+            cpu_ids = free_cpu_ids[:cpus] if len(free_cpu_ids) >= cpus else range(multiprocessing.cpu_count())
+            command = "/usr/bin/taskset -c %s %s" % (','.join(map(str, cpu_ids)), command)
+        process = subprocess.Popen(command, shell=True)
 
-        self.bundle = bundle
-        self.temp_dir = temp_dir
-        self.process = process
+        job_handle = str(process.pid)
+        self.jobs[job_handle] = {
+            'bundle': bundle,
+            'process': process,
+            'temp_dir': temp_dir,
+            'cpus': cpus,
+            'memory': memory,
+            'cpu_ids': cpu_ids,
+        }
         return {
             'bundle': bundle,
             'temp_dir': temp_dir,
-            'job_handle': str(process.pid)
+            'job_handle': job_handle,
         }
 
+    def _get_job_handle(self, bundle):
+        job_handle = getattr(bundle.metadata, 'job_handle', None)
+        if job_handle in self.jobs:
+            return job_handle
+        for (job_handle, job) in self.jobs.iteritems():
+            if job['bundle'].uuid == bundle.uuid:
+                return job_handle
+        return None
+
     def kill_bundle(self, bundle):
-        if not self.bundle or self.bundle.uuid != bundle.uuid: return False
-        self.process.kill()
+        job_handle = self._get_job_handle(bundle)
+        if job_handle is None: return False
+        self.jobs[job_handle]['process'].kill()
         return True
 
-    def get_bundle_statuses(self):
-        if self.process == None: return []
-
-        self.process.poll()
-        # TODO: include time and memory
-        status = {
-            'job_handle': str(self.process.pid),
-            'exitcode': self.process.returncode,
-        }
-        status['success'] = status['exitcode'] == 0 if status['exitcode'] != None else None
-        return [status]
+    def get_bundle_statuses(self, job_handles=None):
+        statuses = []
+        for (job_handle, job) in self.jobs.iteritems():
+            process = job['process']
+            process.poll()
+            # TODO: include time and memory
+            status = {
+                'job_handle': job_handle,
+                'exitcode': process.returncode,
+            }
+            status['success'] = status['exitcode'] == 0 if status['exitcode'] != None else None
+            statuses.append(status)
+        return statuses
 
     def finalize_bundle(self, bundle):
-        if not self.bundle or self.bundle.uuid != bundle.uuid: return False
+        job_handle = self._get_job_handle(bundle)
+        if job_handle is None: return False
 
         try:
-            script_file = self.temp_dir + '.sh'
+            script_file = self.jobs[job_handle]['temp_dir'] + '.sh'
             for f in [script_file]:
                 if os.path.exists(f):
                     path_util.remove(f)
@@ -89,7 +158,5 @@ class LocalMachine(Machine):
             traceback.print_exc()
             ok = False
 
-        self.bundle = None
-        self.temp_dir = None
-        self.process = None
+        del self.jobs[job_handle]
         return ok
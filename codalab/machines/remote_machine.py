@@ -12,6 +12,7 @@ from codalab.lib import (
   formatting,
 )
 
+from codalab.common import UsageError
 from codalab.objects.machine import Machine
 
 '''
@@ -30,14 +31,189 @@ kill that job with the handle.
 4) When constantly poll to see if the job has finished.
 
 The above steps depend on a dispatch_command, which is set in the config.json.
+By default, dispatch_command is run once per step. If persistent_dispatcher is
+set in the config, 'dispatch_command serve' is started once instead, and each
+step is a request to it (see DispatcherProcess and scripts/dispatch_util.py);
+this also lets the dispatcher submit several bundles at once (start_bundles).
+
+If the config also lists the nodes that the dispatcher runs jobs on, with their
+resources, e.g.
+  "nodes": [{"name": "node1", "cpus": 16, "memory": "64g", "gpus": 2}, ...]
+then we keep track of the CPUs, memory and GPUs that the running jobs use on
+each node, and place each bundle on the node where it fits most tightly (best
+fit), passing the node to the dispatcher with --request_node. Bundles that
+don't fit anywhere right now are not dispatched, so they stay STAGED; bundles
+that request more than any node has fail.
 
 Convention: command is a string, args is a list of arguments
 '''
+RESOURCES = ('cpus', 'memory', 'gpus')
+
+def fits(request, available):
+    '''
+    Return whether the request ({cpus, memory, gpus}) fits in the available
+    resources (where None means no limit).
+    '''
+    return all(available[resource] is None or request[resource] <= available[resource] for resource in RESOURCES)
+
+class DispatcherProcess(object):
+    '''
+    A dispatcher that keeps running and answers each request (a JSON object
+    on one line of its stdin) with a JSON object on one line of its stdout.
+    '''
+    def __init__(self, args, verbose=1):
+        self.args = args
+        self.verbose = verbose
+        self.process = None
+
+    def request(self, request):
+        # (Re)start the dispatcher if it isn't running. A request that was
+        # already sent isn't retried, since it could have been carried out.
+        if self.process is None or self.process.poll() is not None:
+            if self.verbose >= 1: print '=== DispatcherProcess: starting %s' % (self.args,)
+            self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        if self.verbose >= 3: print '=== DispatcherProcess.request: %s' % (request,)
+        try:
+            self.process.stdin.write(json.dumps(request) + '\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except IOError:
+            line = ''
+        if not line:
+            self.close()
+            raise SystemError('Dispatcher stopped: %s' % (self.args,))
+        response = json.loads(line)
+        if 'error' in response:
+            raise SystemError('Dispatcher failed on %s: %s' % (request.get('command'), response['error']))
+        return response
+
+    def close(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.stdin.close()
+                self.process.wait()
+            self.process = None
+
 class RemoteMachine(Machine):
     def __init__(self, config):
         self.verbose = config.get('verbose', 1)
         self.dispatch_command = config['dispatch_command']
         self.default_docker_image = config.get('docker_image')
+        self.nodes = {}  # name => {cpus, memory, gpus}; memory is None if there is no limit
+        for node in config.get('nodes', []):
+            self.nodes[node['name']] = {
+                'cpus': node.get('cpus', 1),
+                'memory': formatting.parse_size(node['memory']) if node.get('memory') else None,
+                'gpus': node.get('gpus', 0),
+            }
+        self.allocations = {}  # job_handle => {node, cpus, memory, gpus} of the jobs running on the nodes
+        self.dispatcher = None
+        if config.get('persistent_dispatcher'):
+            self.dispatcher = DispatcherProcess(self.dispatch_command.split() + ['serve'], self.verbose)
+
+    def get_request(self, bundle):
+        '''
+        Return the resources that the bundle requests ({cpus, memory, gpus}).
+        '''
+        memory = getattr(bundle.metadata, 'request_memory', None)
+        return {
+            'cpus': getattr(bundle.metadata, 'request_cpus', None) or 1,
+            'memory': formatting.parse_size(memory) if memory else 0,
+            'gpus': getattr(bundle.metadata, 'request_gpus', None) or 0,
+        }
+
+    def get_free_resources(self, name):
+        free = dict(self.nodes[name])
+        for allocation in self.allocations.itervalues():
+            if allocation['node'] == name:
+                for resource in RESOURCES:
+                    if free[resource] is not None:
+                        free[resource] -= allocation[resource]
+        return free
+
+    def place_bundle(self, request):
+        '''
+        Return the name of the node with the least resources left over after
+        running a job with the given request ({cpus, memory, gpus}), or None if
+        the job doesn't fit on any node right now.
+        '''
+        best = None
+        for name in sorted(self.nodes):
+            capacity = self.nodes[name]
+            free = self.get_free_resources(name)
+            if not fits(request, free):
+                continue
+            # Leftover fraction of each resource, summed so that no resource dominates.
+            leftover = sum(
+                float(free[resource] - request[resource]) / capacity[resource]
+                for resource in RESOURCES if capacity[resource]
+            )
+            if best is None or leftover < best[0]:
+                best = (leftover, name)
+        return best[1] if best else None
+
+    def can_ever_place_bundle(self, request):
+        '''
+        Return whether a job with the given request fits on some node when
+        nothing else runs there.
+        '''
+        return any(fits(request, capacity) for capacity in self.nodes.itervalues())
+
+    def get_utilization(self):
+        '''
+        Return the resources used by the running jobs and the resources of the
+        nodes, as {'total': usage, 'nodes': {name: usage}}, where usage is
+        {resource: {'used': ..., 'total': ...}} (memory in bytes; a total of
+        None means no limit).
+        '''
+        nodes = {}
+        for (name, capacity) in self.nodes.iteritems():
+            nodes[name] = dict((resource, {'used': 0, 'total': capacity[resource]}) for resource in RESOURCES)
+        for allocation in self.allocations.itervalues():
+            for resource in RESOURCES:
+                nodes[allocation['node']][resource]['used'] += allocation[resource]
+        total = {}
+        for resource in RESOURCES:
+            capacities = [usage[resource]['total'] for usage in nodes.itervalues()]
+            total[resource] = {
+                'used': sum(usage[resource]['used'] for usage in nodes.itervalues()),
+                'total': None if None in capacities else sum(capacities),
+            }
+        return {'total': total, 'nodes': nodes}
+
+    def print_utilization(self):
+        total = self.get_utilization()['total']
+        items = []
+        for resource in RESOURCES:
+            used = total[resource]['used']
+            capacity = total[resource]['total']
+            if resource == 'memory':
+                item = 'memory %s/%s' % (formatting.size_str(used), formatting.size_str(capacity) if capacity is not None else 'inf')
+            else:
+                item = '%s %s/%s' % (resource, used, capacity)
+            if capacity:
+                item += ' (%d%%)' % (100 * used / capacity)
+            items.append(item)
+        print '=== utilization: %s jobs on %s nodes, %s' % (len(self.allocations), len(self.nodes), ', '.join(items))
+
+    def update_allocations(self, statuses):
+        '''
+        Forget the allocations of the jobs that are done according to the
+        statuses, and account for running jobs that we didn't start (e.g.,
+        before the worker restarted) with the smallest request.
+        '''
+        running = dict((status['job_handle'], status) for status in statuses if status['exitcode'] is None)
+        changed = False
+        for job_handle in self.allocations.keys():
+            if job_handle not in running:
+                del self.allocations[job_handle]
+                changed = True
+        for (job_handle, status) in running.iteritems():
+            if job_handle not in self.allocations and status.get('remote') in self.nodes:
+                self.allocations[job_handle] = {'node': status['remote'], 'cpus': 1, 'memory': 0, 'gpus': 0}
+                changed = True
+        if changed and self.verbose >= 1:
+            self.print_utilization()
 
     def run_command_get_stdout(self, args):
         if self.verbose >= 3: print "=== run_command_get_stdout: %s" % (args,)
@@ -63,8 +239,73 @@ class RemoteMachine(Machine):
         '''
         Sets up all the temporary files and then dispatches the job.
         username: the username of the owner of the bundle
-        Returns the bundle information.
+        Returns the bundle information, or None if there are nodes and the
+        bundle doesn't fit on any of them right now.
+        '''
+        result = self.start_bundles([(bundle, bundle_store, parent_dict, username)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def start_bundles(self, requests):
+        '''
+        Set up the temporary files of each bundle and dispatch all the jobs at
+        once (with a persistent dispatcher; otherwise one by one).
+        '''
+        results = []
+        jobs = []  # (index in results, job to dispatch)
+        for request in requests:
+            try:
+                prepared = self._prepare_bundle(*request)
+            except Exception, e:
+                traceback.print_exc()
+                prepared = e
+            if isinstance(prepared, tuple):
+                jobs.append((len(results), prepared[1]))
+                prepared = prepared[0]
+            results.append(prepared)
+        if not jobs:
+            return results
+
+        try:
+            handles = self.dispatch_start([job for (i, job) in jobs])
+        except Exception, e:
+            traceback.print_exc()
+            handles = [e] * len(jobs)
+        if len(handles) != len(jobs):
+            print '=== start_bundles(): got %s handles for %s jobs' % (len(handles), len(jobs))
+            handles = handles[:len(jobs)] + [None] * (len(jobs) - len(handles))
+        for ((i, job), handle) in zip(jobs, handles):
+            status = results[i]
+            allocation = self.allocations.pop(('pending', status['bundle'].uuid), None)
+            if handle is None:
+                handle = SystemError('Dispatcher returned no handle for %s' % (job['script'],))
+            if isinstance(handle, Exception):
+                results[i] = handle
+                continue
+            status['job_handle'] = handle
+            if allocation:
+                self.allocations[handle] = allocation
+        if self.nodes and self.verbose >= 1: self.print_utilization()
+        return results
+
+    def _prepare_bundle(self, bundle, bundle_store, parent_dict, username):
         '''
+        Set up the temporary files of a bundle and return its status (without
+        the job handle) and the job to dispatch, or None if there are nodes and
+        the bundle doesn't fit on any of them right now. Raise UsageError if it
+        never will.
+        '''
+        node = None
+        if self.nodes:
+            request = self.get_request(bundle)
+            if not self.can_ever_place_bundle(request):
+                raise UsageError('No node has the resources that %s requests (%s)' % (bundle.uuid, request))
+            node = self.place_bundle(request)
+            if node is None:
+                if self.verbose >= 2: print '=== start_bundle(): no node has room for %s (%s)' % (bundle.uuid, request)
+                return None
+
         # Create a temporary directory
         temp_dir = canonicalize.get_current_location(bundle_store, bundle.uuid)
         temp_dir = os.path.realpath(temp_dir)  # Follow symlinks
@@ -146,42 +387,81 @@ class RemoteMachine(Machine):
                 f.write('(%s) > stdout 2>stderr\n' % bundle.command)
 
         # Determine resources to request
-        resource_args = []
+        job = {'script': script_file}
         if bundle.metadata.request_time:
-            resource_args.extend(['--request_time', formatting.parse_duration(bundle.metadata.request_time)])
+            job['request_time'] = formatting.parse_duration(bundle.metadata.request_time)
         if bundle.metadata.request_memory:
-            resource_args.extend(['--request_memory', formatting.parse_size(bundle.metadata.request_memory)])
+            job['request_memory'] = formatting.parse_size(bundle.metadata.request_memory)
         if bundle.metadata.request_cpus:
-            resource_args.extend(['--request_cpus', bundle.metadata.request_cpus])
+            job['request_cpus'] = bundle.metadata.request_cpus
         if bundle.metadata.request_gpus:
-            resource_args.extend(['--request_gpus', bundle.metadata.request_gpus])
+            job['request_gpus'] = bundle.metadata.request_gpus
         if bundle.metadata.request_queue:
-            resource_args.extend(['--request_queue', bundle.metadata.request_queue])
+            job['request_queue'] = bundle.metadata.request_queue
+        if node:
+            job['request_node'] = node
         if username:
-            resource_args.extend(['--username', username])
-
-        # Start the command
-        args = self.dispatch_command.split() + ['start'] + map(str, resource_args) + [script_file]
-        if self.verbose >= 1: print '=== start_bundle(): running %s' % args
-        result = json.loads(self.run_command_get_stdout(args))
-        if self.verbose >= 1: print '=== start_bundle(): got %s' % result
+            job['username'] = username
 
         # Return the information about the job.
-        return {
+        status = {
             'bundle': bundle,
             'temp_dir': temp_dir,
-            'job_handle': result['handle'],
             'docker_image': docker_image,
         }
+        if node:
+            # Until the job is dispatched (see start_bundles).
+            self.allocations[('pending', bundle.uuid)] = dict(request, node=node)
+            status['remote'] = node
+        return (status, job)
+
+    # Order of the arguments of 'dispatch_command start'.
+    JOB_ARGS = ('request_time', 'request_memory', 'request_cpus', 'request_gpus', 'request_queue', 'request_node', 'username')
+
+    def dispatch_start(self, jobs):
+        '''
+        Start the given jobs and return their handles.
+        '''
+        if self.dispatcher:
+            if self.verbose >= 1: print '=== dispatch_start(): starting %s jobs' % (len(jobs),)
+            handles = self.dispatcher.request({'command': 'start', 'jobs': jobs})['handles']
+            if self.verbose >= 1: print '=== dispatch_start(): got %s' % (handles,)
+            return handles
+        handles = []
+        for job in jobs:
+            resource_args = []
+            for key in self.JOB_ARGS:
+                if key in job:
+                    resource_args.extend(['--' + key, job[key]])
+            args = self.dispatch_command.split() + ['start'] + map(str, resource_args) + [job['script']]
+            if self.verbose >= 1: print '=== start_bundle(): running %s' % args
+            result = json.loads(self.run_command_get_stdout(args))
+            if self.verbose >= 1: print '=== start_bundle(): got %s' % result
+            handles.append(result['handle'])
+        return handles
+
+    def dispatch(self, command, handles):
+        '''
+        Run the info command on the given handles, or the kill or cleanup
+        command on the given handle, and return the response.
+        '''
+        if self.dispatcher:
+            key = 'handles' if command == 'info' else 'handle'
+            return self.dispatcher.request({'command': command, key: handles})
+        args = self.dispatch_command.split() + [command] + (handles if command == 'info' else [handles])
+        return self.run_command_get_stdout_json(args)
 
-    def get_bundle_statuses(self):
+    def get_bundle_statuses(self, job_handles=None):
         '''
-        Return a list of bundle metadata information.
+        Return a list of bundle metadata information (only about the given
+        jobs, if job_handles is given), or None if the dispatcher failed.
         '''
         try:
             # Get status
-            args = self.dispatch_command.split() + ['info']
-            response = self.run_command_get_stdout_json(args)
+            if job_handles is not None and not job_handles:
+                response = {'infos': []}
+            else:
+                response = self.dispatch('info', sorted(job_handles or []))
             if self.verbose >= 2: print '=== get_bundle_statuses: %s' % response
             statuses = []
             for info in response['infos']:
@@ -234,11 +514,13 @@ class RemoteMachine(Machine):
                     
                 status['success'] = status['exitcode'] == 0 if status['exitcode'] != None else None
                 statuses.append(status)
+            if self.nodes:
+                self.update_allocations(statuses)
             return statuses
         except Exception, e:
             print '=== INTERNAL ERROR: %s' % e
             traceback.print_exc()
-            return []
+            return None
 
     def kill_bundle(self, bundle):
         if self.verbose >= 1: print '=== kill_bundle(%s)' % (bundle.uuid)
@@ -249,8 +531,7 @@ class RemoteMachine(Machine):
                 with open(action_file, 'w') as f:
                     print >>f, 'kill'
             else:
-                args = self.dispatch_command.split() + ['kill', bundle.metadata.job_handle]
-                result = self.run_command_get_stdout_json(args)
+                result = self.dispatch('kill', bundle.metadata.job_handle)
             return True
         except Exception, e:
             print '=== INTERNAL ERROR: %s' % e
@@ -260,8 +541,8 @@ class RemoteMachine(Machine):
     def finalize_bundle(self, bundle):
         if self.verbose >= 1: print '=== finalize_bundle(%s)' % bundle.uuid
         try:
-            args = self.dispatch_command.split() + ['cleanup', bundle.metadata.job_handle]
-            result = self.run_command_get_stdout_json(args)
+            result = self.dispatch('cleanup', bundle.metadata.job_handle)
+            self.allocations.pop(bundle.metadata.job_handle, None)
             # Sync this with files created in start_bundle
             temp_dir = bundle.metadata.temp_dir
             if bundle.metadata.docker_image:
@@ -7,16 +7,22 @@ from sqlalchemy import (
     not_,
     select,
     union,
+    union_all,
     desc,
     func,
+    event,
+    bindparam,
 )
 from sqlalchemy.exc import (
     OperationalError,
     ProgrammingError,
 )
 from sqlalchemy.sql.expression import (
+    case,
     literal,
+    literal_column,
     true,
+    false,
 )
 
 from codalab.bundles import get_bundle_subclass
@@ -30,12 +36,17 @@ from codalab.lib import (
     spec_util,
     worksheet_util,
 )
+from codalab.model.query_log import QueryLog
+from codalab.model.statement_cache import StatementCache
 from codalab.model.util import LikeQuery
 from codalab.model.tables import (
     bundle as cl_bundle,
     bundle_dependency as cl_bundle_dependency,
     bundle_metadata as cl_bundle_metadata,
     bundle_action as cl_bundle_action,
+    bundle_lease as cl_bundle_lease,
+    bundle_run_key as cl_bundle_run_key,
+    change_log as cl_change_log,
     group as cl_group,
     group_bundle_permission as cl_group_bundle_permission,
     group_object_permission as cl_group_worksheet_permission,
@@ -51,21 +62,114 @@ from codalab.objects.worksheet import (
     item_sort_key,
     Worksheet,
 )
+from codalab.objects.metadata import Metadata
 from codalab.objects.permission import parse_permission
 
-import re, collections
+import re, collections, contextlib, json, random, threading, time
 
 CONDITION_REGEX = re.compile('^([\.\w/]+)=(.*)$')
 
 class BundleModel(object):
-    def __init__(self, engine):
+    # Maximum number of values in a single IN clause; larger sets of keys are
+    # split into chunks of this size whose results are merged. SQLite allows at
+    # most 999 bound parameters per statement.
+    MAX_IN_CLAUSE_SIZE = 500
+
+    # Maximum number of queries combined into one UNION ALL (see
+    # batch_get_bundle_uuids). Each takes up to three bound parameters, and
+    # SQLite allows at most 500 terms in a compound SELECT.
+    MAX_UNION_SIZE = 100
+
+    # Fields of a bundle that are columns of the bundle table (see batch_get_bundle_fields).
+    BUNDLE_FIELDS = set(column.name for column in cl_bundle.c if column.name != 'metadata_document')
+
+    # Metadata keys that are kept in bundle_metadata, where they can be
+    # searched, when the rest of the metadata is stored as documents.
+    SEARCH_METADATA_KEYS = ('name', 'description', 'tags', 'created', 'data_size', 'time', 'exitcode')
+
+    def __init__(self, engine, replica_engines=(), replica_lag=10):
         '''
         Initialize a BundleModel with the given SQLAlchemy engine.
+
+        Read-only queries may be sent to one of the replica_engines instead,
+        except for reads made within replica_lag seconds of a write by the
+        same client (see read_your_writes) and reads within read_from_primary.
         '''
         self.engine = engine
+        self.replica_engines = list(replica_engines)
+        self.replica_lag = replica_lag
         self.public_group_uuid = ''
+        # How new metadata is written: 'table' (one bundle_metadata row per value)
+        # or 'document' (a JSON document in bundle.metadata_document, plus rows
+        # for the SEARCH_METADATA_KEYS). Both layouts are always readable.
+        self.metadata_storage = 'table'
+        # Per-thread cache of user_id => group uuids, active within cache_user_groups.
+        self._user_groups_cache = threading.local()
+        # Per-thread routing state: whether reads are pinned to the primary, and
+        # which client the current writes belong to.
+        self._routing = threading.local()
+        self._last_write_times = {}  # writer key => time of its last write to the primary
+        if self.replica_engines:
+            event.listen(self.engine, 'after_cursor_execute', self._record_write)
+        # Statistics about the statements run on all of the engines.
+        self.query_log = QueryLog()
+        for e in [self.engine] + self.replica_engines:
+            self.query_log.attach(e)
+        # Compiled forms of the fixed-shape statements (see _execute_cached);
+        # set to None to compile every statement on each call.
+        self.statement_cache = StatementCache(query_log=self.query_log)
+        # WorkerWakeup to notify when there is new work for the worker, if any.
+        self.worker_wakeup = None
         self.create_tables()
 
+    def _record_write(self, connection, cursor, statement, parameters, context, executemany):
+        if context.isinsert or context.isupdate or context.isdelete:
+            self._last_write_times[getattr(self._routing, 'writer_key', None)] = time.time()
+
+    def _wake_worker(self, reason):
+        '''
+        Tell the worker that there is new work for it (see WorkerWakeup). Call
+        this after the transaction that made the change has committed.
+        '''
+        if self.worker_wakeup is not None:
+            self.worker_wakeup.notify(reason)
+
+    def _read_engine(self):
+        '''
+        Return the engine to use for a read-only query.
+        '''
+        if not self.replica_engines or getattr(self._routing, 'primary_depth', 0) > 0:
+            return self.engine
+        last_write_time = self._last_write_times.get(getattr(self._routing, 'writer_key', None))
+        if last_write_time is not None and time.time() - last_write_time < self.replica_lag:
+            return self.engine
+        return random.choice(self.replica_engines)
+
+    @contextlib.contextmanager
+    def read_from_primary(self):
+        '''
+        Send all reads within this context to the primary, e.g., when the
+        result of a read decides what to write.
+        '''
+        self._routing.primary_depth = getattr(self._routing, 'primary_depth', 0) + 1
+        try:
+            yield
+        finally:
+            self._routing.primary_depth -= 1
+
+    @contextlib.contextmanager
+    def read_your_writes(self, writer_key):
+        '''
+        Attribute writes within this context to writer_key (e.g., a user id), so
+        that reads by the same writer_key see them even if replicas lag behind.
+        '''
+        old_writer_key = getattr(self._routing, 'writer_key', None)
+        self._routing.writer_key = writer_key
+        try:
+            yield
+        finally:
+            self._routing.writer_key = old_writer_key
+
     def _reset(self):
         '''
         Do a drop / create table to clear and reset the schema of all tables.
@@ -95,6 +199,125 @@ class BundleModel(object):
         if values:
             connection.execute(table.insert(), values)
 
+    def _chunks(self, values):
+        '''
+        Split values into lists that are small enough for an IN clause.
+        '''
+        values = list(values)
+        for i in xrange(0, len(values), self.MAX_IN_CLAUSE_SIZE):
+            yield values[i:i + self.MAX_IN_CLAUSE_SIZE]
+
+    def _select_in_chunks(self, connection, make_query, values, name=None, params=None):
+        '''
+        Run make_query(chunk) on each chunk of values and return all the rows.
+
+        If a name is given, the query is compiled once per name and chunk shape
+        (see _execute_cached): make_query is passed bind parameters instead of
+        the values in the chunk, and must not depend on anything other than the
+        name, except for bind parameters whose values are in params.
+        '''
+        rows = []
+        for chunk in self._chunks(values):
+            if name is None:
+                rows.extend(connection.execute(make_query(chunk)).fetchall())
+                continue
+            chunk_params = dict(params or {})
+            shape = self._bind_values('chunk', chunk, chunk_params)
+            make_statement = lambda: make_query(self._bind_list('chunk', shape))
+            rows.extend(self._execute_cached(connection, (name, shape), make_statement, chunk_params).fetchall())
+        return rows
+
+    def _execute_in_chunks(self, connection, make_statement, values):
+        '''
+        Run the update or delete make_statement(chunk) on each chunk of values
+        and return the total number of affected rows.
+        '''
+        rowcount = 0
+        for chunk in self._chunks(values):
+            rowcount += connection.execute(make_statement(chunk)).rowcount
+        return rowcount
+
+    def _split_kwargs(self, kwargs):
+        '''
+        If a list-valued filter in kwargs is too large for an IN clause, return
+        (key, chunks of its distinct values); otherwise return (None, None).
+        '''
+        for (key, value) in kwargs.iteritems():
+            if isinstance(value, (list, set, tuple)) and len(value) > self.MAX_IN_CLAUSE_SIZE:
+                return (key, self._chunks(set(value)))
+        return (None, None)
+
+    def _execute_cached(self, connection, key, make_statement, params):
+        '''
+        Execute the statement built by make_statement() with the given bind
+        parameters, and return the result. The statement is only built and
+        compiled the first time that it's executed with a given key, so the key
+        must determine everything about the statement except its parameters.
+        '''
+        if self.statement_cache is None:
+            return connection.execute(make_statement(), params)
+        compiled = self.statement_cache.get(connection.dialect, key, make_statement)
+        return connection.execute(compiled, params)
+
+    def _pad_in_values(self, values):
+        '''
+        Return the distinct values, padded by repeating the last one to the next
+        power of two (up to MAX_IN_CLAUSE_SIZE), so that IN clauses on them only
+        come in a few lengths.
+        '''
+        values = list(set(values))
+        size = 1
+        while size < len(values):
+            size *= 2
+        size = max(len(values), min(size, self.MAX_IN_CLAUSE_SIZE))
+        return values + values[-1:] * (size - len(values))
+
+    def _bind_values(self, name, value, params):
+        '''
+        Add the value of a filter, as interpreted by make_clause, to params as
+        bind parameters named after name. Return the shape of the clause to pass
+        to _bound_clause: the length of a list, or 'null', 'like' or '='.
+        '''
+        if isinstance(value, (list, set, tuple)):
+            values = self._pad_in_values(value) if value else []
+            for (i, v) in enumerate(values):
+                params['%s_%d' % (name, i)] = v
+            return len(values)
+        elif value is None:
+            return 'null'
+        params[name] = value
+        return 'like' if isinstance(value, LikeQuery) else '='
+
+    def _bind_list(self, name, length):
+        return [bindparam('%s_%d' % (name, i)) for i in xrange(length)]
+
+    def _bound_clause(self, column, name, shape):
+        '''
+        Like make_clause, but with the bind parameters given by _bind_values.
+        '''
+        if shape == 'null':
+            return column == None
+        elif shape == 'like':
+            return column.like(bindparam(name))
+        elif shape == '=':
+            return column == bindparam(name)
+        elif shape == 0:
+            return false()
+        return column.in_(self._bind_list(name, shape))
+
+    def _bind_kwargs(self, kwargs, params):
+        '''
+        Add the values of kwargs to params (see _bind_values), and return the
+        shape to pass to _bound_kwargs_clause.
+        '''
+        return tuple((key, self._bind_values('kw_' + key, value, params)) for (key, value) in sorted(kwargs.iteritems()))
+
+    def _bound_kwargs_clause(self, table, shape):
+        '''
+        Like make_kwargs_clause, but with the bind parameters given by _bind_kwargs.
+        '''
+        return and_(true(), *[self._bound_clause(getattr(table.c, key), 'kw_' + key, key_shape) for (key, key_shape) in shape])
+
     def make_clause(self, key, value):
         if isinstance(value, (list, set, tuple)):
             if not value:
@@ -135,14 +358,14 @@ class BundleModel(object):
         '''
         if len(uuids) == 0:
             return []
-        with self.engine.begin() as connection:
-            rows = connection.execute(select([
+        with self._read_engine().begin() as connection:
+            rows = self._select_in_chunks(connection, lambda chunk: select([
                 cl_bundle_metadata.c.bundle_uuid,
                 cl_bundle_metadata.c.metadata_value
             ]).where(
                 and_(cl_bundle_metadata.c.metadata_key == 'name',
-                     cl_bundle_metadata.c.bundle_uuid.in_(uuids))
-            )).fetchall()
+                     cl_bundle_metadata.c.bundle_uuid.in_(chunk))
+            ), uuids, name='get_bundle_names')
             return dict((row.bundle_uuid, row.metadata_value) for row in rows)
 
     def get_owner_ids(self, table, uuids):
@@ -152,11 +375,11 @@ class BundleModel(object):
         '''
         if len(uuids) == 0:
             return []
-        with self.engine.begin() as connection:
-            rows = connection.execute(select([
+        with self._read_engine().begin() as connection:
+            rows = self._select_in_chunks(connection, lambda chunk: select([
                 table.c.uuid,
                 table.c.owner_id,
-            ]).where(table.c.uuid.in_(uuids))).fetchall()
+            ]).where(table.c.uuid.in_(chunk)), uuids, name=('get_owner_ids', table.name))
             return dict((row.uuid, row.owner_id) for row in rows)
     def get_bundle_owner_ids(self, uuids):
         return self.get_owner_ids(cl_bundle, uuids)
@@ -168,11 +391,11 @@ class BundleModel(object):
         Get all bundles that depend on the bundle with the given uuids.
         Return {parent_uuid: [child_uuid, ...], ...}
         '''
-        with self.engine.begin() as connection:
-            rows = connection.execute(select([
+        with self._read_engine().begin() as connection:
+            rows = self._select_in_chunks(connection, lambda chunk: select([
               cl_bundle_dependency.c.parent_uuid,
               cl_bundle_dependency.c.child_uuid,
-            ]).where(cl_bundle_dependency.c.parent_uuid.in_(uuids))).fetchall()
+            ]).where(cl_bundle_dependency.c.parent_uuid.in_(chunk)), uuids, name='get_children_uuids')
         result = dict((uuid, []) for uuid in uuids)
         for row in rows:
             result[row.parent_uuid].append(row.child_uuid)
@@ -184,11 +407,11 @@ class BundleModel(object):
         bundle_uuids = ['0x12435']
         Return {'0x12435': [host_worksheet_uuid, ...], ...}
         '''
-        with self.engine.begin() as connection:
-            rows = connection.execute(select([
+        with self._read_engine().begin() as connection:
+            rows = self._select_in_chunks(connection, lambda chunk: select([
               cl_worksheet_item.c.worksheet_uuid,
               cl_worksheet_item.c.bundle_uuid,
-            ]).where(cl_worksheet_item.c.bundle_uuid.in_(bundle_uuids))).fetchall()
+            ]).where(cl_worksheet_item.c.bundle_uuid.in_(chunk)), bundle_uuids, name='get_host_worksheet_uuids')
         result = dict((uuid, []) for uuid in bundle_uuids)
         for row in rows:
             result[row.bundle_uuid].append(row.worksheet_uuid)
@@ -330,6 +553,8 @@ class BundleModel(object):
                     limit = int(value)
                 # Otherwise, assume metadata.
                 else:
+                    if self.metadata_storage == 'document' and key not in self.SEARCH_METADATA_KEYS:
+                        raise UsageError('Can\'t search on metadata key %s, only on: %s' % (key, ' '.join(self.SEARCH_METADATA_KEYS)))
                     condition = make_condition(cl_bundle_metadata.c.metadata_value, value)
                     if condition == true():  # top-level
                         clause = and_(
@@ -390,46 +615,105 @@ class BundleModel(object):
         if count:
             query = query.count()
 
-        #print 'QUERY', self._render_query(query)
+        # Set slow_query_threshold in the server config to see slow queries.
         result = self._execute_query(query)
         if count or sum_key[0] is not None:  # Just returning a single number
             return result[0]
-        #print 'RESULT', result
         return result
 
+    def _bundle_uuids_shape(self, prefix, conditions, max_results, params):
+        '''
+        Add the bind parameters of a get_bundle_uuids query to params, named
+        with the given prefix, and return its shape for _make_bundle_uuids_query.
+        '''
+        if 'uuid' in conditions:
+            # Match the uuid only
+            return ('uuid', self._bind_values(prefix + 'uuid', conditions['uuid'], params))
+        if not conditions['name'] and not conditions['worksheet_uuid']:
+            raise UsageError('Nothing is specified')
+        if max_results is not None:
+            params[prefix + 'max_results'] = max_results
+        return (
+            'name',
+            self._bind_values(prefix + 'name', conditions['name'], params) if conditions['name'] else None,
+            self._bind_values(prefix + 'worksheet_uuid', conditions['worksheet_uuid'], params) if conditions['worksheet_uuid'] else None,
+            max_results is not None,
+        )
+
+    def _make_bundle_uuids_query(self, prefix, shape):
+        '''
+        Build the get_bundle_uuids query with the given shape. It selects
+        (bundle_uuid, rank), where the bundles are ordered by decreasing rank.
+        '''
+        if shape[0] == 'uuid':
+            clause = self._bound_clause(cl_bundle.c.uuid, prefix + 'uuid', shape[1])
+            return select([cl_bundle.c.uuid, cl_bundle.c.id]).where(clause)
+        (_, name_shape, worksheet_shape, has_limit) = shape
+        # Select name
+        if name_shape is not None:
+            clause = and_(
+              cl_bundle_metadata.c.metadata_key == 'name',
+              self._bound_clause(cl_bundle_metadata.c.metadata_value, prefix + 'name', name_shape)
+            )
+        else:
+            clause = true()
+        if worksheet_shape is not None:
+            # Select things on the given worksheet
+            clause = and_(clause, self._bound_clause(cl_worksheet_item.c.worksheet_uuid, prefix + 'worksheet_uuid', worksheet_shape))
+            clause = and_(clause, cl_worksheet_item.c.bundle_uuid == cl_bundle_metadata.c.bundle_uuid)  # Join
+            query = select([cl_bundle_metadata.c.bundle_uuid, cl_worksheet_item.c.id]).distinct().where(clause)
+            query = query.order_by(cl_worksheet_item.c.id.desc())
+        else:
+            # Select from all bundles
+            clause = and_(clause, cl_bundle.c.uuid == cl_bundle_metadata.c.bundle_uuid)  # Join
+            query = select([cl_bundle.c.uuid, cl_bundle.c.id]).where(clause)
+            query = query.order_by(cl_bundle.c.id.desc())
+        if has_limit:
+            query = query.limit(bindparam(prefix + 'max_results'))
+        return query
+
     def get_bundle_uuids(self, conditions, max_results):
         '''
         Returns a list of bundle_uuids that have match the conditions.
         Possible conditions on bundles: uuid, name, worksheet_uuid
         '''
-        if 'uuid' in conditions:
-            # Match the uuid only
-            clause = self.make_clause(cl_bundle.c.uuid, conditions['uuid'])
-            query = select([cl_bundle.c.uuid]).where(clause)
-        elif 'name' in conditions:
-            # Select name
-            if conditions['name']:
-                clause = and_(
-                  cl_bundle_metadata.c.metadata_key == 'name',
-                  self.make_clause(cl_bundle_metadata.c.metadata_value, conditions['name'])
-                )
-            else:
-                clause = true()
-            if conditions['worksheet_uuid']:
-                # Select things on the given worksheet
-                clause = and_(clause, self.make_clause(cl_worksheet_item.c.worksheet_uuid, conditions['worksheet_uuid']))
-                clause = and_(clause, cl_worksheet_item.c.bundle_uuid == cl_bundle_metadata.c.bundle_uuid)  # Join
-                query = select([cl_bundle_metadata.c.bundle_uuid, cl_worksheet_item.c.id]).distinct().where(clause)
-                query = query.order_by(cl_worksheet_item.c.id.desc()).limit(max_results)
-            else:
-                if not conditions['name']:
-                    raise UsageError('Nothing is specified')
-                # Select from all bundles
-                clause = and_(clause, cl_bundle.c.uuid == cl_bundle_metadata.c.bundle_uuid)  # Join
-                query = select([cl_bundle.c.uuid]).where(clause)
-                query = query.order_by(cl_bundle.c.id.desc()).limit(max_results)
+        # The conditions are bind parameters, so that each query is only
+        # compiled once per shape (see _execute_cached).
+        params = {}
+        shape = self._bundle_uuids_shape('', conditions, max_results, params)
+        make_query = lambda: self._make_bundle_uuids_query('', shape)
+        with self._read_engine().begin() as connection:
+            rows = self._execute_cached(connection, ('get_bundle_uuids', shape), make_query, params).fetchall()
+        return [row[0] for row in rows]
 
-        return self._execute_query(query)
+    def batch_get_bundle_uuids(self, queries):
+        '''
+        Run several get_bundle_uuids queries, given as a list of
+        (conditions, max_results) pairs, and return the list of their results.
+        The queries are combined with UNION ALL, so this takes one round trip
+        per MAX_UNION_SIZE queries instead of one per query.
+        '''
+        results = [[] for _ in queries]
+        with self._read_engine().begin() as connection:
+            for start in xrange(0, len(queries), self.MAX_UNION_SIZE):
+                params = {}
+                shapes = tuple(
+                    self._bundle_uuids_shape('q%d_' % i, conditions, max_results, params)
+                    for (i, (conditions, max_results)) in enumerate(queries[start:start + self.MAX_UNION_SIZE])
+                )
+                def make_query():
+                    # Wrap each query in a subquery so that it can have its own
+                    # ORDER BY and LIMIT, and tag its rows with its index.
+                    subqueries = []
+                    for (i, shape) in enumerate(shapes):
+                        subquery = self._make_bundle_uuids_query('q%d_' % i, shape).alias('q%d' % i)
+                        subqueries.append(select([literal_column(str(i)).label('query_index')] + list(subquery.c)))
+                    return union_all(*subqueries) if len(subqueries) > 1 else subqueries[0]
+                rows = self._execute_cached(connection, ('batch_get_bundle_uuids', shapes), make_query, params).fetchall()
+                # The order of the rows of a UNION isn't defined, so sort by rank.
+                for row in sorted(rows, key=lambda row: -row[2]):
+                    results[start + row[0]].append(row[1])
+        return results
 
     # Helper function: return string representing SQL query.
     def _render_query(self, query):
@@ -440,7 +724,7 @@ class BundleModel(object):
         return s
 
     def _execute_query(self, query):
-        with self.engine.begin() as connection:
+        with self._read_engine().begin() as connection:
             rows = connection.execute(query).fetchall()
         return [row[0] for row in rows]
 
@@ -448,26 +732,42 @@ class BundleModel(object):
         '''
         Return a list of bundles given a SQLAlchemy clause on the cl_bundle table.
         '''
-        clause = self.make_kwargs_clause(cl_bundle, kwargs)
-        with self.engine.begin() as connection:
-            bundle_rows = connection.execute(
-              cl_bundle.select().where(clause)
-            ).fetchall()
+        (key, chunks) = self._split_kwargs(kwargs)
+        if key:
+            bundles = []
+            for chunk in chunks:
+                bundles.extend(self.batch_get_bundles(**dict(kwargs, **{key: chunk})))
+            return sorted(bundles, key=lambda bundle: bundle.id)
+
+        params = {}
+        shape = self._bind_kwargs(kwargs, params)
+        with self._read_engine().begin() as connection:
+            bundle_rows = self._execute_cached(connection, ('batch_get_bundles', shape), lambda: (
+              cl_bundle.select().where(self._bound_kwargs_clause(cl_bundle, shape))
+            ), params).fetchall()
             if not bundle_rows:
                 return []
             uuids = set(bundle_row.uuid for bundle_row in bundle_rows)
-            dependency_rows = connection.execute(cl_bundle_dependency.select().where(
-              cl_bundle_dependency.c.child_uuid.in_(uuids)
-            )).fetchall()
-            metadata_rows = connection.execute(cl_bundle_metadata.select().where(
-              cl_bundle_metadata.c.bundle_uuid.in_(uuids)
-            )).fetchall()
+            dependency_rows = self._select_in_chunks(connection, lambda chunk: cl_bundle_dependency.select().where(
+              cl_bundle_dependency.c.child_uuid.in_(chunk)
+            ), uuids, name='batch_get_bundles.dependencies')
+            # Only bundles without a metadata document have all of their
+            # metadata in bundle_metadata.
+            row_uuids = set(bundle_row.uuid for bundle_row in bundle_rows if bundle_row.metadata_document is None)
+            metadata_rows = self._select_in_chunks(connection, lambda chunk: cl_bundle_metadata.select().where(
+              cl_bundle_metadata.c.bundle_uuid.in_(chunk)
+            ), row_uuids, name='batch_get_bundles.metadata')
 
         # Make a dictionary for each bundle with both data and metadata.
         bundle_values = {row.uuid: dict(row) for row in bundle_rows}
         for bundle_value in bundle_values.itervalues():
             bundle_value['dependencies'] = []
-            bundle_value['metadata'] = []
+            document = bundle_value.pop('metadata_document')
+            if document is None:
+                bundle_value['metadata'] = []
+            else:
+                bundle_subclass = get_bundle_subclass(bundle_value['bundle_type'])
+                bundle_value['metadata'] = Metadata.load_document(bundle_subclass.METADATA_SPECS, document)
         for dep_row in dependency_rows:
             if dep_row.child_uuid not in bundle_values:
                 raise IntegrityError('Got dependency %s without bundle' % (dep_row,))
@@ -487,6 +787,89 @@ class BundleModel(object):
             bundle.validate()
         return bundles
 
+    def batch_get_bundle_fields(self, fields, **kwargs):
+        '''
+        Return a list of dicts with the id and the given fields of the bundles
+        that satisfy the clause given by kwargs, sorted by id. Each field is either:
+        - a column of the bundle table (e.g., uuid, state, data_hash)
+        - parent_uuids: the list of uuids of the bundle's dependencies
+        - a metadata key (e.g., name): the value, or None if it isn't set ([]
+          for list-valued keys)
+        Unlike batch_get_bundles, this only reads the tables that the fields
+        need and doesn't construct or validate Bundle objects.
+        '''
+        (key, chunks) = self._split_kwargs(kwargs)
+        if key:
+            results = []
+            for chunk in chunks:
+                results.extend(self.batch_get_bundle_fields(fields, **dict(kwargs, **{key: chunk})))
+            return sorted(results, key=lambda result: result['id'])
+
+        column_names = set(field for field in fields if field in self.BUNDLE_FIELDS) | set(['id'])
+        metadata_keys = [field for field in fields if field not in self.BUNDLE_FIELDS and field != 'parent_uuids']
+        selected_names = column_names | set(['uuid'])
+        if metadata_keys:
+            selected_names |= set(['bundle_type', 'metadata_document'])
+        selected_names = tuple(sorted(selected_names))
+        params = {}
+        shape = self._bind_kwargs(kwargs, params)
+        with self._read_engine().begin() as connection:
+            bundle_rows = self._execute_cached(connection, ('batch_get_bundle_fields', selected_names, shape), lambda: (
+              select([cl_bundle.c[name] for name in selected_names])
+                .where(self._bound_kwargs_clause(cl_bundle, shape))
+                .order_by(cl_bundle.c.id)
+            ), params).fetchall()
+            if not bundle_rows:
+                return []
+            if 'parent_uuids' in fields:
+                dependency_rows = self._select_in_chunks(connection, lambda chunk: select([
+                  cl_bundle_dependency.c.child_uuid,
+                  cl_bundle_dependency.c.parent_uuid,
+                ]).where(cl_bundle_dependency.c.child_uuid.in_(chunk)), [row.uuid for row in bundle_rows],
+                name='batch_get_bundle_fields.dependencies')
+            if metadata_keys:
+                row_uuids = [row.uuid for row in bundle_rows if row.metadata_document is None]
+                metadata_rows = self._select_in_chunks(connection, lambda chunk: select([
+                  cl_bundle_metadata.c.bundle_uuid,
+                  cl_bundle_metadata.c.metadata_key,
+                  cl_bundle_metadata.c.metadata_value,
+                ]).where(and_(
+                  cl_bundle_metadata.c.bundle_uuid.in_(chunk),
+                  cl_bundle_metadata.c.metadata_key.in_(metadata_keys),
+                )), row_uuids, name=('batch_get_bundle_fields.metadata', tuple(metadata_keys)))
+
+        results = collections.OrderedDict()
+        for row in bundle_rows:
+            results[row.uuid] = dict((name, row[name]) for name in column_names)
+        if 'parent_uuids' in fields:
+            for result in results.itervalues():
+                result['parent_uuids'] = []
+            for row in dependency_rows:
+                results[row.child_uuid]['parent_uuids'].append(row.parent_uuid)
+        if metadata_keys:
+            values = collections.defaultdict(dict)  # uuid => metadata key => list of values
+            for row in metadata_rows:
+                values[row.bundle_uuid].setdefault(row.metadata_key, []).append(row.metadata_value)
+            for row in bundle_rows:
+                if row.metadata_document is not None:
+                    document = json.loads(row.metadata_document)
+                    for key in metadata_keys:
+                        if key in document:
+                            value = document[key]
+                            values[row.uuid][key] = value if isinstance(value, list) else [value]
+                specs = dict((spec.key, spec) for spec in get_bundle_subclass(row.bundle_type).METADATA_SPECS)
+                result = results[row.uuid]
+                for key in metadata_keys:
+                    spec = specs.get(key)
+                    value = values[row.uuid].get(key, [])
+                    if spec and spec.type == list:
+                        result[key] = value
+                    elif value:
+                        result[key] = spec.get_constructor()(value[0]) if spec else value[0]
+                    else:
+                        result[key] = None
+        return results.values()
+
     def batch_update_bundles(self, bundles, update, condition=None):
         '''
         Update a list of bundles given a dict mapping columns to new values and
@@ -502,14 +885,16 @@ class BundleModel(object):
         precondition('id' not in update and 'uuid' not in update, message)
         if bundles:
             bundle_ids = set(bundle.id for bundle in bundles)
-            clause = cl_bundle.c.id.in_(bundle_ids)
-            if condition:
-                clause = and_(clause, self.make_kwargs_clause(cl_bundle, condition))
+            def make_statement(chunk):
+                clause = cl_bundle.c.id.in_(chunk)
+                if condition:
+                    clause = and_(clause, self.make_kwargs_clause(cl_bundle, condition))
+                return cl_bundle.update().where(clause).values(update)
             with self.engine.begin() as connection:
-                result = connection.execute(
-                  cl_bundle.update().where(clause).values(update)
-                )
-                success = result.rowcount == len(bundle_ids)
+                rowcount = self._execute_in_chunks(connection, make_statement, bundle_ids)
+                if rowcount > 0:
+                    self._log_changes(connection, 'bundle', [bundle.uuid for bundle in bundles], 'update')
+                success = rowcount == len(bundle_ids)
                 if success:
                     for bundle in bundles:
                         bundle.update_in_memory(update)
@@ -519,33 +904,246 @@ class BundleModel(object):
     def add_bundle_action(self, uuid, action):
         with self.engine.begin() as connection:
             connection.execute(cl_bundle_action.insert().values({"bundle_uuid": uuid, "action": action}))
+        self._wake_worker('action')
 
     def add_bundle_actions(self, bundle_actions):
         with self.engine.begin() as connection:
             self.do_multirow_insert(connection, cl_bundle_action, bundle_actions)
+        if bundle_actions:
+            self._wake_worker('action')
+
+    def pop_bundle_actions(self, worker_id=None):
+        '''
+        Remove and return the pending bundle actions.
 
-    def pop_bundle_actions(self):
+        When several workers share the database, each passes its worker_id, and
+        only gets the actions on bundles that it holds the lease of (see
+        claim_bundle) or that nobody holds the lease of.
+        '''
+        with self.engine.begin() as connection:
+            if worker_id is None:
+                results = connection.execute(cl_bundle_action.select()).fetchall()  # Get the actions
+                connection.execute(cl_bundle_action.delete())  # Delete all actions
+                return [x for x in results]
+            query = select([cl_bundle_action]).select_from(cl_bundle_action.outerjoin(
+                cl_bundle_lease, cl_bundle_lease.c.bundle_uuid == cl_bundle_action.c.bundle_uuid
+            )).where(or_(cl_bundle_lease.c.worker_id == worker_id, cl_bundle_lease.c.worker_id == None))
+            results = []
+            for row in connection.execute(query).fetchall():
+                # Another worker might have taken an action on an unleased bundle first.
+                if connection.execute(cl_bundle_action.delete().where(cl_bundle_action.c.id == row.id)).rowcount == 1:
+                    results.append(row)
+            return results
+
+    def claim_bundle(self, bundle, worker_id, lease_time):
+        '''
+        Move a STAGED bundle to RUNNING and give worker_id a lease on it for
+        lease_time seconds, in one transaction. Return whether the claim
+        succeeded (it fails if another worker claimed the bundle first).
+        '''
         with self.engine.begin() as connection:
-            results = connection.execute(cl_bundle_action.select()).fetchall()  # Get the actions
-            connection.execute(cl_bundle_action.delete())  # Delete all actions
-            return [x for x in results]
+            rowcount = connection.execute(cl_bundle.update().where(and_(
+                cl_bundle.c.id == bundle.id,
+                cl_bundle.c.state == State.STAGED,
+            )).values({'state': State.RUNNING})).rowcount
+            if rowcount != 1:
+                return False
+            # Drop any lease left over from an earlier run of the bundle.
+            connection.execute(cl_bundle_lease.delete().where(cl_bundle_lease.c.bundle_uuid == bundle.uuid))
+            connection.execute(cl_bundle_lease.insert().values({
+                'bundle_uuid': bundle.uuid,
+                'worker_id': worker_id,
+                'expires': time.time() + lease_time,
+            }))
+            self._log_changes(connection, 'bundle', [bundle.uuid], 'update')
+        bundle.update_in_memory({'state': State.RUNNING})
+        return True
 
-    def save_bundle(self, bundle):
+    def renew_bundle_leases(self, worker_id, lease_time):
         '''
-        Save a bundle. On success, sets the Bundle object's id from the result.
+        Extend all the leases of worker_id to lease_time seconds from now (the
+        worker's heartbeat), and return the uuids of their bundles.
+        '''
+        with self.engine.begin() as connection:
+            connection.execute(cl_bundle_lease.update().where(
+                cl_bundle_lease.c.worker_id == worker_id
+            ).values({'expires': time.time() + lease_time}))
+            rows = connection.execute(select([cl_bundle_lease.c.bundle_uuid]).where(
+                cl_bundle_lease.c.worker_id == worker_id
+            )).fetchall()
+        return [row.bundle_uuid for row in rows]
+
+    def take_over_expired_bundle_leases(self, worker_id, lease_time):
+        '''
+        Give worker_id the leases that have expired, because their workers
+        stopped renewing them, and return the uuids of their bundles.
+        '''
+        now = time.time()
+        uuids = []
+        with self.engine.begin() as connection:
+            rows = connection.execute(select([cl_bundle_lease.c.id, cl_bundle_lease.c.bundle_uuid]).where(
+                cl_bundle_lease.c.expires < now
+            )).fetchall()
+            for row in rows:
+                # Another worker might have taken over the lease first.
+                rowcount = connection.execute(cl_bundle_lease.update().where(and_(
+                    cl_bundle_lease.c.id == row.id,
+                    cl_bundle_lease.c.expires < now,
+                )).values({'worker_id': worker_id, 'expires': now + lease_time})).rowcount
+                if rowcount == 1:
+                    uuids.append(row.bundle_uuid)
+        return uuids
+
+    def get_bundle_leases(self, uuids):
+        '''
+        Return a dict mapping each of the bundle uuids that is leased to
+        {worker_id: ..., expires: ...}.
+        '''
+        with self._read_engine().begin() as connection:
+            rows = self._select_in_chunks(connection, lambda chunk: select([
+                cl_bundle_lease.c.bundle_uuid,
+                cl_bundle_lease.c.worker_id,
+                cl_bundle_lease.c.expires,
+            ]).where(cl_bundle_lease.c.bundle_uuid.in_(chunk)), uuids)
+        return {row.bundle_uuid: {'worker_id': row.worker_id, 'expires': row.expires} for row in rows}
+
+    def release_bundle_leases(self, uuids):
+        '''
+        Delete the leases on the given bundles (once they are done running).
+        '''
+        with self.engine.begin() as connection:
+            self._execute_in_chunks(connection, lambda chunk: cl_bundle_lease.delete().where(
+                cl_bundle_lease.c.bundle_uuid.in_(chunk)
+            ), uuids)
+
+    def add_run_keys(self, run_keys):
+        '''
+        Record the run keys of bundles, given as a dict mapping uuids to keys
+        (see RunBundle.get_run_key), so that identical runs can reuse their
+        results once they are READY.
+        '''
+        with self.engine.begin() as connection:
+            self._execute_in_chunks(connection, lambda chunk: cl_bundle_run_key.delete().where(
+                cl_bundle_run_key.c.bundle_uuid.in_(chunk)
+            ), run_keys.keys())
+            self.do_multirow_insert(connection, cl_bundle_run_key, [
+                {'bundle_uuid': uuid, 'run_key': run_key} for (uuid, run_key) in run_keys.iteritems()
+            ])
+
+    def get_reusable_bundles(self, run_keys):
+        '''
+        Return a dict mapping each of the given run keys that a READY bundle with
+        data has to the uuid of the oldest such bundle.
+        '''
+        with self._read_engine().begin() as connection:
+            rows = self._select_in_chunks(connection, lambda chunk: select([
+                cl_bundle_run_key.c.run_key,
+                cl_bundle.c.id,
+                cl_bundle.c.uuid,
+            ]).select_from(cl_bundle_run_key.join(
+                cl_bundle, cl_bundle.c.uuid == cl_bundle_run_key.c.bundle_uuid
+            )).where(and_(
+                cl_bundle_run_key.c.run_key.in_(chunk),
+                cl_bundle.c.state == State.READY,
+                cl_bundle.c.data_hash != None,
+            )), list(run_keys))
+        result = {}
+        for row in sorted(rows, key=lambda row: row.id, reverse=True):
+            result[row.run_key] = row.uuid
+        return result
+
+    def _bundle_to_values(self, bundle):
+        '''
+        Return the bundle row, dependency rows and metadata rows to save for the
+        given bundle, according to self.metadata_storage.
         '''
-        bundle.validate()
         bundle_value = bundle.to_dict()
         dependency_values = bundle_value.pop('dependencies')
         metadata_values = bundle_value.pop('metadata')
+        if self.metadata_storage == 'document':
+            bundle_value['metadata_document'] = bundle.metadata.to_document(bundle.METADATA_SPECS)
+            metadata_values = [
+              row_dict for row_dict in metadata_values
+              if row_dict['metadata_key'] in self.SEARCH_METADATA_KEYS
+            ]
+        return (bundle_value, dependency_values, metadata_values)
+
+    def save_bundle(self, bundle):
+        '''
+        Save a bundle. On success, sets the Bundle object's id from the result.
+        '''
+        bundle.validate()
+        (bundle_value, dependency_values, metadata_values) = self._bundle_to_values(bundle)
 
         # Check to see if bundle is already present, as in a local 'cl cp'
-        if not self.batch_get_bundles(uuid=bundle.uuid):
+        with self.read_from_primary():
+            exists = self.batch_get_bundles(uuid=bundle.uuid)
+        if not exists:
             with self.engine.begin() as connection:
                 result = connection.execute(cl_bundle.insert().values(bundle_value))
                 self.do_multirow_insert(connection, cl_bundle_dependency, dependency_values)
                 self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
+                self._log_changes(connection, 'bundle', [bundle.uuid], 'create')
                 bundle.id = result.lastrowid
+            self._wake_worker('created')
+
+    def batch_save_bundles(self, bundles, group_permissions=(), worksheet_uuid=None):
+        '''
+        Save many bundles in a single transaction, using multi-row inserts for
+        the bundle, dependency, metadata, permission and worksheet item rows.
+
+        group_permissions: list of {group_uuid: ..., permission: ...} entries
+        that are granted on each of the new bundles.
+        worksheet_uuid: if given, append a bundle item for each of the new bundles
+        to the end of this worksheet, in order.
+
+        Bundles that are already present are skipped, as in save_bundle. On
+        success, sets the id of each saved Bundle object.
+        '''
+        for bundle in bundles:
+            bundle.validate()
+        uuids = [bundle.uuid for bundle in bundles]
+        with self.engine.begin() as connection:
+            rows = self._select_in_chunks(connection, lambda chunk: select([cl_bundle.c.uuid]).where(
+                cl_bundle.c.uuid.in_(chunk)
+            ), uuids)
+            existing_uuids = set(row.uuid for row in rows)
+            new_bundles = [bundle for bundle in bundles if bundle.uuid not in existing_uuids]
+            if not new_bundles:
+                return
+
+            bundle_values = []
+            dependency_values = []
+            metadata_values = []
+            for bundle in new_bundles:
+                (bundle_value, bundle_dependency_values, bundle_metadata_values) = self._bundle_to_values(bundle)
+                dependency_values.extend(bundle_dependency_values)
+                metadata_values.extend(bundle_metadata_values)
+                bundle_values.append(bundle_value)
+            permission_values = [{
+                'group_uuid': row['group_uuid'],
+                'object_uuid': bundle.uuid,
+                'permission': row['permission'],
+            } for bundle in new_bundles for row in group_permissions]
+
+            self.do_multirow_insert(connection, cl_bundle, bundle_values)
+            self.do_multirow_insert(connection, cl_bundle_dependency, dependency_values)
+            self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
+            self.do_multirow_insert(connection, cl_group_bundle_permission, permission_values)
+            self._log_changes(connection, 'bundle', [bundle.uuid for bundle in new_bundles], 'create')
+            if worksheet_uuid:
+                self._insert_worksheet_items(connection, worksheet_uuid, [
+                    worksheet_util.bundle_item(bundle.uuid) for bundle in new_bundles
+                ])
+
+            # Multi-row inserts don't report ids, so read them back.
+            rows = self._select_in_chunks(connection, lambda chunk: select([cl_bundle.c.id, cl_bundle.c.uuid]).where(
+                cl_bundle.c.uuid.in_(chunk)
+            ), [bundle.uuid for bundle in new_bundles])
+            ids = dict((row.uuid, row.id) for row in rows)
+            for bundle in new_bundles:
+                bundle.id = ids[bundle.uuid]
+        self._wake_worker('created')
 
 
     def update_bundle(self, bundle, update):
@@ -560,36 +1158,60 @@ class BundleModel(object):
         message = 'Illegal update: %s' % (update,)
         precondition('id' not in update and 'uuid' not in update, message)
         # Apply the column and metadata updates in memory and validate the result.
+        update = dict(update)  # Don't modify the caller's dict, so that the update can be retried.
         metadata_update = update.pop('metadata', {})
         bundle.update_in_memory(update)
         for (key, value) in metadata_update.iteritems():
             bundle.metadata.set_metadata_key(key, value)
         bundle.validate()
         # Construct clauses and update lists for updating certain bundle columns.
-        if update:
-            clause = cl_bundle.c.uuid == bundle.uuid
+        clause = cl_bundle.c.uuid == bundle.uuid
         if metadata_update:
             metadata_clause = and_(
               cl_bundle_metadata.c.bundle_uuid == bundle.uuid,
               cl_bundle_metadata.c.metadata_key.in_(metadata_update)
             )
+            (_, _, metadata_values) = self._bundle_to_values(bundle)
             metadata_values = [
-              row_dict for row_dict in bundle.to_dict().pop('metadata')
+              row_dict for row_dict in metadata_values
               if row_dict['metadata_key'] in metadata_update
             ]
+            document = bundle.metadata.to_document(bundle.METADATA_SPECS)
+            if self.metadata_storage == 'document':
+                update['metadata_document'] = document
         # Perform the actual updates.
         with self.engine.begin() as connection:
+            self._log_changes(connection, 'bundle', [bundle.uuid], 'update')
             if update:
                 connection.execute(cl_bundle.update().where(clause).values(update))
             if metadata_update:
+                if self.metadata_storage != 'document':
+                    # Keep the document of a bundle that was saved as one up to date.
+                    connection.execute(cl_bundle.update().where(and_(
+                        clause,
+                        cl_bundle.c.metadata_document != None,
+                    )).values({'metadata_document': document}))
                 connection.execute(cl_bundle_metadata.delete().where(metadata_clause))
                 self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
+        if update.get('state') in (State.READY, State.FAILED):
+            # The children of the bundle might be able to run now.
+            self._wake_worker('finished')
+
+    def chown_bundles(self, uuids, owner_id):
+        '''
+        Set the owner_id of the bundles with the given uuids in one transaction.
+        '''
+        with self.engine.begin() as connection:
+            self._execute_in_chunks(connection, lambda chunk: cl_bundle.update().where(
+                cl_bundle.c.uuid.in_(chunk)
+            ).values({'owner_id': owner_id}), uuids)
+            self._log_changes(connection, 'bundle', uuids, 'update')
 
     def _check_not_running(self, uuids):
         # Make sure we don't delete running bundles.
         with self.engine.begin() as connection:
-            rows = connection.execute(select([cl_bundle.c.uuid, cl_bundle.c.state]).where(cl_bundle.c.uuid.in_(uuids))).fetchall()
-            running_uuids = [r.uuid for r in rows if r.state == State.RUNNING]
+            rows = self._select_in_chunks(connection, lambda chunk: select([cl_bundle.c.uuid, cl_bundle.c.state]).where(cl_bundle.c.uuid.in_(chunk)), uuids)
+            running_uuids = [r.uuid for r in rows if r.state in (State.RUNNING, State.FINALIZING)]
             if len(running_uuids) > 0:
                 raise UsageError('Can\'t delete running bundles: %s' % ' '.join(running_uuids))
 
@@ -601,26 +1223,87 @@ class BundleModel(object):
         with self.engine.begin() as connection:
             # We must delete bundles rows in the opposite order that we create them
             # to avoid foreign-key constraint failures.
-            connection.execute(cl_group_bundle_permission.delete().where(
-                cl_group_bundle_permission.c.object_uuid.in_(uuids)
-            ))
-            connection.execute(cl_worksheet_item.delete().where(
-                cl_worksheet_item.c.bundle_uuid.in_(uuids)
-            ))
-            connection.execute(cl_bundle_metadata.delete().where(
-                cl_bundle_metadata.c.bundle_uuid.in_(uuids)
-            ))
-            connection.execute(cl_bundle_dependency.delete().where(
-                cl_bundle_dependency.c.child_uuid.in_(uuids)
-            ))
-            connection.execute(cl_bundle.delete().where(
-                cl_bundle.c.uuid.in_(uuids)
-            ))
+            host_rows = self._select_in_chunks(connection, lambda chunk: select([cl_worksheet_item.c.worksheet_uuid]).where(
+                cl_worksheet_item.c.bundle_uuid.in_(chunk)
+            ), uuids)
+            self._log_changes(connection, 'bundle', uuids, 'delete')
+            self._log_changes(connection, 'worksheet', [row.worksheet_uuid for row in host_rows], 'items')
+            self._execute_in_chunks(connection, lambda chunk: cl_bundle_lease.delete().where(
+                cl_bundle_lease.c.bundle_uuid.in_(chunk)
+            ), uuids)
+            self._execute_in_chunks(connection, lambda chunk: cl_bundle_run_key.delete().where(
+                cl_bundle_run_key.c.bundle_uuid.in_(chunk)
+            ), uuids)
+            self._execute_in_chunks(connection, lambda chunk: cl_group_bundle_permission.delete().where(
+                cl_group_bundle_permission.c.object_uuid.in_(chunk)
+            ), uuids)
+            self._execute_in_chunks(connection, lambda chunk: cl_worksheet_item.delete().where(
+                cl_worksheet_item.c.bundle_uuid.in_(chunk)
+            ), uuids)
+            self._execute_in_chunks(connection, lambda chunk: cl_bundle_metadata.delete().where(
+                cl_bundle_metadata.c.bundle_uuid.in_(chunk)
+            ), uuids)
+            self._execute_in_chunks(connection, lambda chunk: cl_bundle_dependency.delete().where(
+                cl_bundle_dependency.c.child_uuid.in_(chunk)
+            ), uuids)
+            self._execute_in_chunks(connection, lambda chunk: cl_bundle.delete().where(
+                cl_bundle.c.uuid.in_(chunk)
+            ), uuids)
 
     def remove_data_hash_references(self, uuids):
         self._check_not_running(uuids)
         with self.engine.begin() as connection:
-            connection.execute(cl_bundle.update().where(cl_bundle.c.uuid.in_(uuids)).values({'data_hash': None}))
+            self._log_changes(connection, 'bundle', uuids, 'update')
+            self._execute_in_chunks(connection, lambda chunk: cl_bundle.update().where(cl_bundle.c.uuid.in_(chunk)).values({'data_hash': None}), uuids)
+            # Without their data, these bundles can't be reused.
+            self._execute_in_chunks(connection, lambda chunk: cl_bundle_run_key.delete().where(
+                cl_bundle_run_key.c.bundle_uuid.in_(chunk)
+            ), uuids)
+
+    def convert_metadata_storage(self, storage, batch_size=1000):
+        '''
+        Move the metadata of all bundles to the given layout ('table' or
+        'document', see self.metadata_storage), batch_size bundles per
+        transaction, and return the number of bundles converted. Bundles can be
+        read while this runs, but it should not run concurrently with writes.
+        '''
+        precondition(storage in ('table', 'document'), 'Unexpected metadata storage: %s' % (storage,))
+        if storage == 'document':
+            clause = cl_bundle.c.metadata_document == None
+        else:
+            clause = cl_bundle.c.metadata_document != None
+        num_converted = 0
+        while True:
+            with self.engine.begin() as connection:
+                uuids = [row.uuid for row in connection.execute(
+                    select([cl_bundle.c.uuid]).where(clause).limit(batch_size)
+                ).fetchall()]
+            if not uuids:
+                return num_converted
+            with self.read_from_primary():
+                bundles = self.batch_get_bundles(uuid=uuids)
+            with self.engine.begin() as connection:
+                for bundle in bundles:
+                    if storage == 'document':
+                        document = bundle.metadata.to_document(bundle.METADATA_SPECS)
+                    else:
+                        document = None
+                    connection.execute(cl_bundle.update().where(cl_bundle.c.uuid == bundle.uuid).values({'metadata_document': document}))
+                if storage == 'document':
+                    # The metadata that isn't searched is now only in the documents.
+                    self._execute_in_chunks(connection, lambda chunk: cl_bundle_metadata.delete().where(and_(
+                        cl_bundle_metadata.c.bundle_uuid.in_(chunk),
+                        not_(cl_bundle_metadata.c.metadata_key.in_(self.SEARCH_METADATA_KEYS)),
+                    )), uuids)
+                else:
+                    self._execute_in_chunks(connection, lambda chunk: cl_bundle_metadata.delete().where(
+                        cl_bundle_metadata.c.bundle_uuid.in_(chunk)
+                    ), uuids)
+                    metadata_values = []
+                    for bundle in bundles:
+                        metadata_values.extend(bundle.to_dict().pop('metadata'))
+                    self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
+            num_converted += len(uuids)
 
     #############################################################################
     # Worksheet-related model methods follow!
@@ -641,6 +1324,13 @@ class BundleModel(object):
         '''
         Get a list of worksheets, all of which satisfy the clause given by kwargs.
         '''
+        (key, chunks) = self._split_kwargs(kwargs)
+        if key:
+            worksheets = []
+            for chunk in chunks:
+                worksheets.extend(self.batch_get_worksheets(fetch_items, **dict(kwargs, **{key: chunk})))
+            return worksheets
+
         base_worksheet_uuid = kwargs.pop('base_worksheet_uuid', None)
         clause = self.make_kwargs_clause(cl_worksheet, kwargs)
         # Handle base_worksheet_uuid specially
@@ -649,7 +1339,7 @@ class BundleModel(object):
                 cl_worksheet_item.c.subworksheet_uuid == cl_worksheet.c.uuid,
                 cl_worksheet_item.c.worksheet_uuid == base_worksheet_uuid)
 
-        with self.engine.begin() as connection:
+        with self._read_engine().begin() as connection:
             worksheet_rows = connection.execute(
               cl_worksheet.select().distinct().where(clause)
             ).fetchall()
@@ -662,9 +1352,9 @@ class BundleModel(object):
             # Fetch the items of all the worksheets
             if fetch_items:
                 uuids = set(row.uuid for row in worksheet_rows)
-                item_rows = connection.execute(cl_worksheet_item.select().where(
-                  cl_worksheet_item.c.worksheet_uuid.in_(uuids)
-                )).fetchall()
+                item_rows = self._select_in_chunks(connection, lambda chunk: cl_worksheet_item.select().where(
+                  cl_worksheet_item.c.worksheet_uuid.in_(chunk)
+                ), uuids)
         # Make a dictionary for each worksheet with both its main row and its items.
         worksheet_values = {row.uuid: dict(row) for row in worksheet_rows}
         if fetch_items:
@@ -676,6 +1366,40 @@ class BundleModel(object):
                 worksheet_values[item_row.worksheet_uuid]['items'].append(item_row)
         return [Worksheet(value) for value in worksheet_values.itervalues()]
 
+    def get_worksheet_item_window(self, worksheet_uuid, offset, limit):
+        '''
+        Get the items of the worksheet with the given uuid at positions offset
+        to offset + limit, without loading the others. Return a dict with keys:
+          num_items: the number of items in the worksheet
+          items: the items in the window, in the database form
+          item_ids: the database ids of those items
+          context_items: the directives before the window that are needed to
+            interpret it (see worksheet_util.get_context_items)
+        '''
+        order = (cl_worksheet_item.c.sort_key, cl_worksheet_item.c.id)
+        clause = cl_worksheet_item.c.worksheet_uuid == worksheet_uuid
+        with self._read_engine().begin() as connection:
+            num_items = connection.execute(select([func.count()]).where(clause)).scalar()
+            item_rows = connection.execute(
+              cl_worksheet_item.select().where(clause).order_by(*order).offset(offset).limit(limit)
+            ).fetchall()
+            context_items = []
+            if offset > 0 and item_rows:
+                # Only directives are needed in full to work out the context.
+                is_directive = cl_worksheet_item.c.type == worksheet_util.TYPE_DIRECTIVE
+                prefix_rows = connection.execute(select([
+                    cl_worksheet_item.c.type,
+                    case([(is_directive, cl_worksheet_item.c.value)]).label('value'),
+                ]).where(clause).order_by(*order).limit(offset)).fetchall()
+                context_items = worksheet_util.get_context_items(
+                    [(None, None, row.value, row.type) for row in prefix_rows])
+        return {
+            'num_items': num_items,
+            'items': [(row.bundle_uuid, row.subworksheet_uuid, row.value, row.type) for row in item_rows],
+            'item_ids': [row.id for row in item_rows],
+            'context_items': context_items,
+        }
+
     def list_worksheets(self, user_id=None):
         '''
         Return a list of row dicts, one per worksheet. These dicts do NOT contain
@@ -714,7 +1438,7 @@ class BundleModel(object):
 
             stmt = union(stmt1, stmt2)
 
-        with self.engine.begin() as connection:
+        with self._read_engine().begin() as connection:
             rows = connection.execute(stmt).fetchall()
             if not rows:
                 return []
@@ -742,6 +1466,7 @@ class BundleModel(object):
         worksheet_value = worksheet.to_dict()
         with self.engine.begin() as connection:
             result = connection.execute(cl_worksheet.insert().values(worksheet_value))
+            self._log_changes(connection, 'worksheet', [worksheet.uuid], 'create')
             worksheet.id = result.lastrowid
 
     def add_worksheet_item(self, worksheet_uuid, item):
@@ -750,18 +1475,36 @@ class BundleModel(object):
         a (bundle_uuid, value, type) pair, where the bundle_uuid may be None and the
         value must be a string.
         '''
-        (bundle_uuid, subworksheet_uuid, value, type) = item
-        if value == None: value = ''  # TODO: change tables.py to allow nulls
-        item_value = {
-          'worksheet_uuid': worksheet_uuid,
-          'bundle_uuid': bundle_uuid,
-          'subworksheet_uuid': subworksheet_uuid,
-          'value': value,
-          'type': type,
-          'sort_key': None,
-        }
+        self.add_worksheet_items(worksheet_uuid, [item])
+
+    def add_worksheet_items(self, worksheet_uuid, items):
+        '''
+        Appends new items to the end of the given worksheet, in order, using a
+        single multi-row insert. See add_worksheet_item for the item format.
+        '''
         with self.engine.begin() as connection:
-            connection.execute(cl_worksheet_item.insert().values(item_value))
+            self._insert_worksheet_items(connection, worksheet_uuid, items)
+
+    def _insert_worksheet_items(self, connection, worksheet_uuid, items):
+        item_values = []
+        for (bundle_uuid, subworksheet_uuid, value, type) in items:
+            if value == None: value = ''  # TODO: change tables.py to allow nulls
+            item_values.append({
+              'worksheet_uuid': worksheet_uuid,
+              'bundle_uuid': bundle_uuid,
+              'subworksheet_uuid': subworksheet_uuid,
+              'value': value,
+              'type': type,
+              'sort_key': None,
+            })
+        self.do_multirow_insert(connection, cl_worksheet_item, item_values)
+        # Appended items sort by id (see codalab.objects.worksheet).
+        if item_values:
+            self._log_changes(connection, 'worksheet', [worksheet_uuid], 'items')
+            connection.execute(cl_worksheet_item.update().where(and_(
+                cl_worksheet_item.c.worksheet_uuid == worksheet_uuid,
+                cl_worksheet_item.c.sort_key == None,
+            )).values(sort_key=cl_worksheet_item.c.id))
 
     def add_shadow_worksheet_items(self, old_bundle_uuid, new_bundle_uuid):
         '''
@@ -770,7 +1513,7 @@ class BundleModel(object):
         '''
         with self.engine.begin() as connection:
             # Find all the worksheet_items that old_bundle_uuid appears in
-            query = select([cl_worksheet_item.c.worksheet_uuid, cl_worksheet_item.c.sort_key]).where(cl_worksheet_item.c.bundle_uuid == old_bundle_uuid)
+            query = select([cl_worksheet_item.c.worksheet_uuid, cl_worksheet_item.c.id, cl_worksheet_item.c.sort_key]).where(cl_worksheet_item.c.bundle_uuid == old_bundle_uuid)
             old_items = connection.execute(query)
             #print 'add_shadow_worksheet_items', old_items
 
@@ -783,10 +1526,12 @@ class BundleModel(object):
                   'bundle_uuid': new_bundle_uuid,
                   'type': worksheet_util.TYPE_BUNDLE,
                   'value': '',  # TODO: replace with None once we change tables.py
-                  'sort_key': old_item.sort_key,  # Can't really do after, so use the same value.
+                  # Use the same sort key; the higher id breaks the tie, so the new item comes right after.
+                  'sort_key': item_sort_key(old_item)[0],
                 }
                 new_items.append(new_item)
                 connection.execute(cl_worksheet_item.insert().values(new_item))
+            self._log_changes(connection, 'worksheet', [item['worksheet_uuid'] for item in new_items], 'items')
             # sqlite doesn't support batch insertion
             #connection.execute(cl_worksheet_item.insert().values(new_items))
 
@@ -827,6 +1572,137 @@ class BundleModel(object):
             if result.rowcount < length:
                 raise UsageError('Worksheet %s was updated concurrently!' % (worksheet_uuid,))
             self.do_multirow_insert(connection, cl_worksheet_item, new_item_values)
+            self._log_changes(connection, 'worksheet', [worksheet_uuid], 'items')
+
+    def patch_worksheet(self, worksheet_uuid, last_item_id, length, patch):
+        '''
+        Apply a patch, as computed by worksheet_util.diff_items, to the items of
+        the worksheet with the given uuid. The patch is a list of operations on
+        the items with database id at most last_item_id, applied in order:
+          ('delete', [item_id, ...])
+          ('insert', before_item_id, [(bundle_uuid, subworksheet_uuid, value, type), ...])
+          ('move', [item_id, ...], before_item_id)
+        where a before_item_id of None refers to the end of those items (i.e.,
+        before any items that were appended after last_item_id).
+
+        Only the inserted and moved items are written: they get sort keys in
+        between the sort keys of their new neighbors, so the other items keep
+        theirs. If there are no floats left in between, the worksheet's items
+        are renumbered.
+
+        As in update_worksheet, raise a UsageError if there weren't exactly
+        `length` items with id at most last_item_id (or any of the items in the
+        patch are gone), since the worksheet was then updated concurrently.
+        '''
+        with self.engine.begin() as connection:
+            rows = connection.execute(select([
+                cl_worksheet_item.c.id,
+                cl_worksheet_item.c.sort_key,
+            ]).where(cl_worksheet_item.c.worksheet_uuid == worksheet_uuid)).fetchall()
+            if len([row for row in rows if row.id <= last_item_id]) != length:
+                raise UsageError('Worksheet %s was updated concurrently!' % (worksheet_uuid,))
+            max_id = connection.execute(select([func.max(cl_worksheet_item.c.id)])).scalar() or 0
+
+            # Apply the patch to the list of items in order, where each entry is
+            # [id or None for new items, sort key or None if it needs a new one, new item].
+            entries = [[row.id, item_sort_key(row)[0], None] for row in sorted(rows, key=item_sort_key)]
+            def remove(item_ids):
+                # Remove the entries with the given ids from the list and return them.
+                item_ids = set(item_ids)
+                removed = dict((entry[0], entry) for entry in entries if entry[0] in item_ids)
+                if len(removed) != len(item_ids):
+                    raise UsageError('Worksheet %s was updated concurrently!' % (worksheet_uuid,))
+                precondition(max(item_ids) <= last_item_id, 'Illegal patch: %s' % (patch,))
+                entries[:] = [entry for entry in entries if entry[0] not in item_ids]
+                return removed
+            def find_before(before_item_id):
+                for (i, entry) in enumerate(entries):
+                    if before_item_id is None and entry[0] is not None and entry[0] > last_item_id:
+                        return i
+                    if before_item_id is not None and entry[0] == before_item_id:
+                        return i
+                if before_item_id is not None:
+                    raise UsageError('Worksheet %s was updated concurrently!' % (worksheet_uuid,))
+                return len(entries)
+            deleted_ids = []
+            moved_ids = set()
+            for op in patch:
+                if op[0] == 'delete':
+                    if op[1]:
+                        remove(op[1])
+                        deleted_ids.extend(op[1])
+                elif op[0] == 'insert':
+                    i = find_before(op[1])
+                    entries[i:i] = [[None, None, item] for item in op[2]]
+                elif op[0] == 'move':
+                    if op[1]:
+                        removed = remove(op[1])
+                        moved = [removed[item_id] for item_id in op[1]]
+                        for entry in moved:
+                            entry[1] = None
+                        moved_ids.update(op[1])
+                        i = find_before(op[2])
+                        entries[i:i] = moved
+                else:
+                    raise UsageError('Illegal patch: %s' % (patch,))
+
+            # Give each run of entries without a sort key evenly spaced keys in
+            # between its neighbors. Keys stay below max_id + 1, so that items
+            # appended later (whose sort key is their id) come after them.
+            if not self._assign_item_sort_keys(entries, max_id + 1):
+                # Ran out of precision, so renumber all the items.
+                for (i, entry) in enumerate(entries):
+                    entry[1] = float(i - len(entries))
+                moved_ids = set(entry[0] for entry in entries if entry[0] is not None)
+
+            self._execute_in_chunks(connection, lambda chunk: cl_worksheet_item.delete().where(
+                cl_worksheet_item.c.id.in_(chunk)
+            ), deleted_ids)
+            moved_values = [{'item_id': entry[0], 'new_sort_key': entry[1]} for entry in entries if entry[0] in moved_ids]
+            if moved_values:
+                connection.execute(cl_worksheet_item.update().where(
+                    cl_worksheet_item.c.id == bindparam('item_id')
+                ).values(sort_key=bindparam('new_sort_key')), moved_values)
+            new_item_values = []
+            for (item_id, sort_key, item) in entries:
+                if item_id is None:
+                    (bundle_uuid, subworksheet_uuid, value, type) = item
+                    new_item_values.append({
+                      'worksheet_uuid': worksheet_uuid,
+                      'bundle_uuid': bundle_uuid,
+                      'subworksheet_uuid': subworksheet_uuid,
+                      'value': value or '',  # TODO: change tables.py to allow nulls
+                      'type': type,
+                      'sort_key': sort_key,
+                    })
+            self.do_multirow_insert(connection, cl_worksheet_item, new_item_values)
+            if patch:
+                self._log_changes(connection, 'worksheet', [worksheet_uuid], 'items')
+
+    def _assign_item_sort_keys(self, entries, upper_bound):
+        '''
+        Fill in the missing sort keys of the [id, sort key, item] entries so that
+        they increase, and stay below upper_bound. Return False if some keys
+        can't be represented.
+        '''
+        i = 0
+        while i < len(entries):
+            if entries[i][1] is not None:
+                i += 1
+                continue
+            j = i
+            while j < len(entries) and entries[j][1] is None:
+                j += 1
+            upper = entries[j][1] if j < len(entries) else upper_bound
+            lower = entries[i - 1][1] if i > 0 else upper - (j - i) - 1
+            step = (upper - lower) / float(j - i + 1)
+            for k in xrange(i, j):
+                entries[k][1] = lower + step * (k - i + 1)
+            keys = [lower] + [entries[k][1] for k in xrange(i, j)] + [upper]
+            if any(a >= b for (a, b) in zip(keys, keys[1:])):
+                return False
+            i = j
+        return True
 
     def rename_worksheet(self, worksheet, name):
         '''
@@ -838,6 +1714,7 @@ class BundleModel(object):
             connection.execute(cl_worksheet.update().where(
               cl_worksheet.c.uuid == worksheet.uuid
             ).values({'name': name}))
+            self._log_changes(connection, 'worksheet', [worksheet.uuid], 'update')
 
     def chown_worksheet(self, worksheet, owner_id):
         '''
@@ -849,12 +1726,18 @@ class BundleModel(object):
             connection.execute(cl_worksheet.update().where(
               cl_worksheet.c.uuid == worksheet.uuid
             ).values({'owner_id': owner_id}))
+            self._log_changes(connection, 'worksheet', [worksheet.uuid], 'update')
 
     def delete_worksheet(self, worksheet_uuid):
         '''
         Delete the worksheet with the given uuid.
         '''
         with self.engine.begin() as connection:
+            host_rows = connection.execute(select([cl_worksheet_item.c.worksheet_uuid]).where(
+                cl_worksheet_item.c.subworksheet_uuid == worksheet_uuid
+            )).fetchall()
+            self._log_changes(connection, 'worksheet', [worksheet_uuid], 'delete')
+            self._log_changes(connection, 'worksheet', [row.worksheet_uuid for row in host_rows], 'items')
             connection.execute(cl_group_worksheet_permission.delete().where(
                 cl_group_worksheet_permission.c.object_uuid == worksheet_uuid
             ))
@@ -978,6 +1861,9 @@ class BundleModel(object):
         Delete the group with the given uuid.
         '''
         with self.engine.begin() as connection:
+            for (object_type, table) in (('bundle', cl_group_bundle_permission), ('worksheet', cl_group_worksheet_permission)):
+                rows = connection.execute(select([table.c.object_uuid]).where(table.c.group_uuid == uuid)).fetchall()
+                self._log_changes(connection, object_type, [row.object_uuid for row in rows], 'permission')
             connection.execute(cl_group_bundle_permission.delete().\
                 where(cl_group_bundle_permission.c.group_uuid == uuid)
             )
@@ -990,6 +1876,7 @@ class BundleModel(object):
             connection.execute(cl_group.delete().where(
               cl_group.c.uuid == uuid
             ))
+        self._clear_user_groups_cache()
 
     def add_user_in_group(self, user_id, group_uuid, is_admin):
         '''
@@ -999,6 +1886,7 @@ class BundleModel(object):
         with self.engine.begin() as connection:
             result = connection.execute(cl_user_group.insert().values(row))
             row['id'] = result.lastrowid
+        self._clear_user_groups_cache()
         return row
 
     def delete_user_in_group(self, user_id, group_uuid):
@@ -1010,6 +1898,7 @@ class BundleModel(object):
                 where(cl_user_group.c.user_id == user_id).\
                 where(cl_user_group.c.group_uuid == group_uuid)
             )
+        self._clear_user_groups_cache()
 
     def update_user_in_group(self, user_id, group_uuid, is_admin):
         '''
@@ -1028,7 +1917,7 @@ class BundleModel(object):
         Examples: user_id=..., group_uuid=...
         '''
         clause = self.make_kwargs_clause(cl_user_group, kwargs)
-        with self.engine.begin() as connection:
+        with self._read_engine().begin() as connection:
             rows = connection.execute(
               cl_user_group.select().where(clause)
             ).fetchall()
@@ -1036,11 +1925,36 @@ class BundleModel(object):
                 return []
         return [dict(row) for row in rows]
 
+    @contextlib.contextmanager
+    def cache_user_groups(self):
+        '''
+        Within this context (e.g., a single client request), remember the groups
+        that each user belongs to instead of looking them up on every permission
+        check. Changes to group membership clear the cache.
+        '''
+        outermost = getattr(self._user_groups_cache, 'groups', None) is None
+        if outermost:
+            self._user_groups_cache.groups = {}
+        try:
+            yield
+        finally:
+            if outermost:
+                self._user_groups_cache.groups = None
+
+    def _clear_user_groups_cache(self):
+        if getattr(self._user_groups_cache, 'groups', None) is not None:
+            self._user_groups_cache.groups.clear()
+
     # Helper function: return list of group uuids that |user_id| is in.
     def _get_user_groups(self, user_id):
+        cache = getattr(self._user_groups_cache, 'groups', None)
+        if cache is not None and user_id in cache:
+            return cache[user_id]
         groups = [self.public_group_uuid]  # Everyone is in the public group implicitly.
         if user_id != None:
             groups += [row['group_uuid'] for row in self.batch_get_user_in_group(user_id=user_id)]
+        if cache is not None:
+            cache[user_id] = groups
         return groups
 
     def add_permission(self, table, group_uuid, object_uuid, permission):
@@ -1050,8 +1964,13 @@ class BundleModel(object):
         row = {'group_uuid': group_uuid, 'object_uuid': object_uuid, 'permission': permission}
         with self.engine.begin() as connection:
             result = connection.execute(table.insert().values(row))
+            self._log_permission_change(connection, table, object_uuid)
             row['id'] = result.lastrowid
         return row
+    def _log_permission_change(self, connection, table, object_uuid):
+        object_type = 'bundle' if table == cl_group_bundle_permission else 'worksheet'
+        self._log_changes(connection, object_type, [object_uuid], 'permission')
+
     def add_bundle_permission(self, group_uuid, bundle_uuid, permission):
         self.add_permission(cl_group_bundle_permission, group_uuid, bundle_uuid, permission)
     def add_worksheet_permission(self, group_uuid, worksheet_uuid, permission):
@@ -1066,6 +1985,7 @@ class BundleModel(object):
                 where(table.c.group_uuid == group_uuid). \
                 where(table.c.object_uuid == object_uuid)
             )
+            self._log_permission_change(connection, table, object_uuid)
     def delete_bundle_permission(self, group_uuid, bundle_uuid):
         self.delete_permission(cl_group_bundle_permission, group_uuid, bundle_uuid)
     def delete_worksheet_permission(self, group_uuid, worksheet_uuid):
@@ -1081,20 +2001,59 @@ class BundleModel(object):
                 where(table.c.group_uuid == group_uuid). \
                 where(table.c.object_uuid == object_uuid). \
                 values({'permission': permission}))
+            self._log_permission_change(connection, table, object_uuid)
     def update_bundle_permission(self, group_uuid, bundle_uuid, permission):
         self.update_permission(cl_group_bundle_permission, group_uuid, bundle_uuid, permission)
     def update_worksheet_permission(self, group_uuid, worksheet_uuid, permission):
         self.update_permission(cl_group_worksheet_permission, group_uuid, worksheet_uuid, permission)
 
+    def set_group_permissions(self, table, object_uuids, group_permissions):
+        '''
+        For each {group_uuid: ..., permission: ...} entry of group_permissions,
+        set the permission of the group on all the given objects, adding,
+        updating or (for a permission of none) deleting rows as needed. All the
+        changes are made in one transaction, with a few statements per group.
+        '''
+        object_uuids = list(set(object_uuids))
+        if not object_uuids:
+            return
+        with self.engine.begin() as connection:
+            for row in group_permissions:
+                group_uuid = row['group_uuid']
+                permission = row['permission']
+                make_group_clause = lambda chunk: and_(table.c.group_uuid == group_uuid, table.c.object_uuid.in_(chunk))
+                if permission > GROUP_OBJECT_PERMISSION_NONE:
+                    rows = self._select_in_chunks(connection, lambda chunk: select([table.c.object_uuid]).where(
+                        make_group_clause(chunk)
+                    ), object_uuids)
+                    existing_uuids = set(row.object_uuid for row in rows)
+                    self._execute_in_chunks(connection, lambda chunk: table.update().where(
+                        make_group_clause(chunk)
+                    ).values({'permission': permission}), existing_uuids)
+                    self.do_multirow_insert(connection, table, [
+                        {'group_uuid': group_uuid, 'object_uuid': object_uuid, 'permission': permission}
+                        for object_uuid in object_uuids if object_uuid not in existing_uuids
+                    ])
+                else:
+                    self._execute_in_chunks(connection, lambda chunk: table.delete().where(
+                        make_group_clause(chunk)
+                    ), object_uuids)
+            object_type = 'bundle' if table == cl_group_bundle_permission else 'worksheet'
+            self._log_changes(connection, object_type, object_uuids, 'permission')
+    def set_group_bundle_permissions(self, bundle_uuids, group_permissions):
+        self.set_group_permissions(cl_group_bundle_permission, bundle_uuids, group_permissions)
+    def set_group_worksheet_permissions(self, worksheet_uuids, group_permissions):
+        self.set_group_permissions(cl_group_worksheet_permission, worksheet_uuids, group_permissions)
+
     def batch_get_group_permissions(self, table, object_uuids):
         '''
         Return map from object_uuid to list of {group_uuid: ..., group_name: ..., permission: ...}
         '''
-        with self.engine.begin() as connection:
-            rows = connection.execute(select([table, cl_group.c.name])
+        with self._read_engine().begin() as connection:
+            rows = self._select_in_chunks(connection, lambda chunk: select([table, cl_group.c.name])
                 .where(table.c.group_uuid == cl_group.c.uuid)
-                .where(table.c.object_uuid.in_(object_uuids))
-            ).fetchall()
+                .where(table.c.object_uuid.in_(chunk))
+            , object_uuids)
             result = collections.defaultdict(list)  # object_uuid => list of rows
             for row in rows:
                 result[row.object_uuid].append({'group_uuid': row.group_uuid, 'group_name': row.name, 'permission': row.permission})
@@ -1148,14 +2107,101 @@ class BundleModel(object):
                 remaining_object_uuids.append(object_uuid)
 
         if len(remaining_object_uuids) > 0:
-            result = self.batch_get_group_permissions(table, remaining_object_uuids)
-            user_groups = self._get_user_groups(user_id)
-            for object_uuid, permissions in result.items():
-                for row in permissions:
-                    if row['group_uuid'] in user_groups:
-                        object_permissions[object_uuid] = max(object_permissions[object_uuid], row['permission'])
+            # The groups are bind parameters, so that the query only depends on
+            # the number of groups (see _select_in_chunks).
+            params = {}
+            if getattr(self._user_groups_cache, 'groups', None) is not None or user_id == None:
+                groups_shape = self._bind_values('group', self._get_user_groups(user_id), params)
+                make_group_clause = lambda: self._bound_clause(table.c.group_uuid, 'group', groups_shape)
+            else:
+                groups_shape = 'user_group'
+                params.update({'public_group_uuid': self.public_group_uuid, 'user_id': user_id})
+                # Everyone is in the public group implicitly.
+                make_group_clause = lambda: or_(
+                    table.c.group_uuid == bindparam('public_group_uuid'),
+                    table.c.group_uuid.in_(
+                        select([cl_user_group.c.group_uuid]).where(cl_user_group.c.user_id == bindparam('user_id'))
+                    ),
+                )
+            make_query = lambda chunk: select([table.c.object_uuid, func.max(table.c.permission).label('permission')]) \
+                .where(table.c.object_uuid.in_(chunk)) \
+                .where(make_group_clause()) \
+                .group_by(table.c.object_uuid)
+            with self._read_engine().begin() as connection:
+                rows = self._select_in_chunks(connection, make_query, remaining_object_uuids,
+                                              name=('get_user_permissions', table.name, groups_shape), params=params)
+            for row in rows:
+                object_permissions[row.object_uuid] = max(object_permissions[row.object_uuid], row.permission)
         return object_permissions
     def get_user_bundle_permissions(self, user_id, bundle_uuids, owner_ids):
         return self.get_user_permissions(cl_group_bundle_permission, user_id, bundle_uuids, owner_ids) 
     def get_user_worksheet_permissions(self, user_id, worksheet_uuids, owner_ids):
         return self.get_user_permissions(cl_group_worksheet_permission, user_id, worksheet_uuids, owner_ids) 
+
+    #############################################################################
+    # Change log methods follow!
+    #############################################################################
+
+    def _log_changes(self, connection, object_type, uuids, change):
+        '''
+        Append a change to each of the objects with the given uuids to the change
+        log. This must be called with the connection of the transaction that
+        makes the change, so that the entries are committed with it.
+        '''
+        uuids = list(collections.OrderedDict.fromkeys(uuids))
+        now = time.time()
+        self.do_multirow_insert(connection, cl_change_log, [{
+            'object_type': object_type,
+            'object_uuid': uuid,
+            'change': change,
+            'time': now,
+        } for uuid in uuids])
+
+    def get_changes(self, since_seq, limit):
+        '''
+        Return a dict describing the first (up to) limit changes with sequence
+        number greater than since_seq:
+          changes: list of {seq, object_type, object_uuid, change, time} dicts,
+            in order of sequence number.
+          last_seq: the sequence number to pass as since_seq to get the next changes.
+          truncated: whether changes after since_seq have been compacted away,
+            in which case the caller has to reload everything it has cached.
+
+        Note that sequence numbers are assigned when a change is made and not
+        when it is committed, so with concurrent writers (on MySQL) a change
+        can show up after others with greater sequence numbers.
+        '''
+        with self._read_engine().begin() as connection:
+            min_seq = connection.execute(select([func.min(cl_change_log.c.seq)])).scalar()
+            rows = connection.execute(cl_change_log.select().where(
+                cl_change_log.c.seq > since_seq
+            ).order_by(cl_change_log.c.seq).limit(limit)).fetchall()
+        return {
+            'changes': [dict(row) for row in rows],
+            'last_seq': rows[-1].seq if rows else since_seq,
+            'truncated': min_seq is not None and since_seq < min_seq - 1,
+        }
+
+    def get_last_change_seq(self):
+        '''
+        Return the sequence number of the latest change, to pass as since_seq to
+        get_changes to only get the changes made from now on.
+        '''
+        with self._read_engine().begin() as connection:
+            return connection.execute(select([func.max(cl_change_log.c.seq)])).scalar() or 0
+
+    def compact_changes(self, max_age):
+        '''
+        Delete the change log entries that are older than max_age seconds, and
+        return how many were deleted. The most recent entry is always kept, so
+        that get_changes can tell which changes were deleted.
+        '''
+        with self.engine.begin() as connection:
+            max_seq = connection.execute(select([func.max(cl_change_log.c.seq)])).scalar()
+            if max_seq is None:
+                return 0
+            result = connection.execute(cl_change_log.delete().where(and_(
+                cl_change_log.c.time < time.time() - max_age,
+                cl_change_log.c.seq < max_seq,
+            )))
+            return result.rowcount
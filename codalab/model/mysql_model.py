@@ -10,11 +10,21 @@ from codalab.common import (
 )
 
 class MySQLModel(BundleModel):
-    def __init__(self, engine_url):
-        if not engine_url.startswith('mysql://'):
-            raise UsageError('Engine URL should start with %s' % engine_url)
+    # Larger IN lists save round trips, but very large ones produce bad plans
+    # and can exceed max_allowed_packet.
+    MAX_IN_CLAUSE_SIZE = 5000
+
+    def __init__(self, engine_url, replica_urls=(), replica_lag=10):
+        '''
+        replica_urls: optional engine URLs of read replicas of engine_url,
+        which serve the read-only queries (see BundleModel).
+        '''
+        for url in [engine_url] + list(replica_urls):
+            if not url.startswith('mysql://'):
+                raise UsageError('Engine URL should start with mysql://, but got %s' % url)
         engine = create_engine(engine_url, strategy='threadlocal')
-        super(MySQLModel, self).__init__(engine)
+        replica_engines = [create_engine(url, strategy='threadlocal') for url in replica_urls]
+        super(MySQLModel, self).__init__(engine, replica_engines, replica_lag)
 
     def do_multirow_insert(self, connection, table, values):
         # MySQL allows for more efficient multi-row insertions.
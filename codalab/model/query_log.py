@@ -0,0 +1,120 @@
+'''
+QueryLog hooks into SQLAlchemy engines to record the duration and row count of
+every statement, attributed to the client command that issued it.
+
+Commands are delimited with QueryLog.command, which returns a summary of the
+queries made inside it (BundleRPCServer logs one per request). Statements that
+take longer than slow_threshold seconds are written to the slow log together
+with the database's query plan.
+
+BundleModel's StatementCache also reports to the QueryLog, so that the summary
+of a command includes how much statement compilation it saved.
+'''
+import contextlib
+import datetime
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+
+
+class QueryLog(object):
+    def __init__(self, slow_threshold=None, slow_log_path=None):
+        '''
+        slow_threshold: log statements slower than this many seconds (None to disable).
+        slow_log_path: file to append slow statements to (default: stderr).
+        '''
+        self.slow_threshold = slow_threshold
+        self.slow_log_path = slow_log_path
+        self._local = threading.local()
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    @contextlib.contextmanager
+    def command(self, name):
+        '''
+        Attribute the statements executed within this context to the command
+        with the given name. Yields a dict that summarizes them:
+        {command: ..., num_queries: ..., num_rows: ..., db_time: ...,
+         num_cached: ..., compile_time: ..., compile_time_saved: ...}
+        where num_cached is the number of statements taken from the statement
+        cache, and compile_time is the time spent compiling the others.
+        '''
+        old_stats = getattr(self._local, 'stats', None)
+        stats = self._local.stats = {
+            'command': name, 'num_queries': 0, 'num_rows': 0, 'db_time': 0.0,
+            'num_cached': 0, 'compile_time': 0.0, 'compile_time_saved': 0.0,
+        }
+        try:
+            yield stats
+        finally:
+            self._local.stats = old_stats
+
+    def record_compile(self, cached, compile_time):
+        '''
+        Record that a statement was taken from the statement cache (cached=True),
+        saving compile_time seconds, or compiled in compile_time seconds.
+        '''
+        stats = getattr(self._local, 'stats', None)
+        if stats is not None:
+            if cached:
+                stats['num_cached'] += 1
+                stats['compile_time_saved'] += compile_time
+            else:
+                stats['compile_time'] += compile_time
+
+    def _before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        context._query_start_time = time.time()
+
+    def _after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        duration = time.time() - context._query_start_time
+        # Some drivers (e.g., sqlite3) don't report the row count of a SELECT
+        # until all of its rows have been fetched.
+        num_rows = cursor.rowcount if cursor.rowcount >= 0 else None
+        stats = getattr(self._local, 'stats', None)
+        if stats is not None:
+            stats['num_queries'] += 1
+            stats['num_rows'] += num_rows or 0
+            stats['db_time'] += duration
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            plan = None
+            if not executemany and statement.lstrip().upper().startswith('SELECT'):
+                plan = self._explain(connection, cursor, statement, parameters)
+            self._log_slow_query(stats and stats['command'], statement, parameters, duration, num_rows, plan)
+
+    def _explain(self, connection, cursor, statement, parameters):
+        '''
+        Return the query plan of the statement as a list of rows, using a fresh
+        DBAPI cursor so that it doesn't show up as a query itself.
+        '''
+        if connection.dialect.name == 'sqlite':
+            explain = 'EXPLAIN QUERY PLAN '
+        else:
+            explain = 'EXPLAIN '
+        try:
+            explain_cursor = cursor.connection.cursor()
+            try:
+                explain_cursor.execute(explain + statement, parameters)
+                return explain_cursor.fetchall()
+            finally:
+                explain_cursor.close()
+        except Exception, e:
+            return ['EXPLAIN failed: %s' % (e,)]
+
+    def _log_slow_query(self, command, statement, parameters, duration, num_rows, plan):
+        lines = ['# %s: slow query (%.3fs, %s rows) in %s' % (
+            datetime.datetime.now().isoformat(), duration, '?' if num_rows is None else num_rows, command)]
+        lines.append(statement.strip())
+        lines.append('-- parameters: %s' % (parameters,))
+        if plan is not None:
+            lines.append('-- plan:')
+            lines.extend('--   %s' % (tuple(row) if not isinstance(row, basestring) else row,) for row in plan)
+        text = '\n'.join(lines) + '\n'
+        if self.slow_log_path:
+            with open(self.slow_log_path, 'a') as f:
+                f.write(text)
+        else:
+            sys.stderr.write(text)
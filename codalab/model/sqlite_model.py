@@ -1,18 +1,80 @@
 '''
 SQLiteModel is a subclass of BundleModel that stores metadata in a sqlite3
 database in a local file in the CodaLab home directory.
+
+The database is shared by the server, the worker and local CLI processes, so by
+default it is opened in WAL mode, where readers don't block the writer and vice
+versa. The pragmas can be tuned in the 'sqlite' section of the server config
+(see DEFAULT_OPTIONS).
 '''
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 
 from codalab.model.bundle_model import BundleModel
+from codalab.model.util import retry_if_locked
 
 
 class SQLiteModel(BundleModel):
     SQLITE_DB_FILE_NAME = 'bundle.db'
 
-    def __init__(self, home):
+    DEFAULT_OPTIONS = {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',  # Safe in WAL mode; a power failure can only lose the last commits.
+        'busy_timeout': 30,  # Seconds to wait for a lock before failing with "database is locked".
+        'mmap_size': 0,  # Bytes of the database file to memory-map (0 disables).
+        'cache_size': -2000,  # Pages, or KiB if negative (this is SQLite's default).
+        'lock_retries': 5,  # Times to re-run a write that still failed on a lock.
+    }
+
+    # Methods that do all their writes in one transaction, and can therefore be
+    # re-run from the start if SQLite reports that the database is locked.
+    RETRY_METHODS = (
+        'save_bundle',
+        'batch_save_bundles',
+        'update_bundle',
+        'batch_update_bundles',
+        'chown_bundles',
+        'add_bundle_action',
+        'add_bundle_actions',
+        'pop_bundle_actions',
+        'claim_bundle',
+        'renew_bundle_leases',
+        'take_over_expired_bundle_leases',
+        'release_bundle_leases',
+        'add_run_keys',
+        'delete_bundles',
+        'remove_data_hash_references',
+        'compact_changes',
+        'save_worksheet',
+        'add_worksheet_items',
+        'add_shadow_worksheet_items',
+        'update_worksheet',
+        'patch_worksheet',
+        'rename_worksheet',
+        'chown_worksheet',
+        'delete_worksheet',
+        'add_permission',
+        'update_permission',
+        'delete_permission',
+        'set_group_permissions',
+    )
+
+    def __init__(self, home, options=None):
+        self.options = dict(self.DEFAULT_OPTIONS)
+        self.options.update(options or {})
         sqlite_db_path = os.path.join(home, self.SQLITE_DB_FILE_NAME)
         engine_url = 'sqlite:///%s' % (sqlite_db_path,)
-        engine = create_engine(engine_url, strategy='threadlocal')
+        engine = create_engine(engine_url, strategy='threadlocal',
+                               connect_args={'timeout': self.options['busy_timeout']})
+        event.listen(engine, 'connect', self._set_pragmas)
         super(SQLiteModel, self).__init__(engine)
+        for name in self.RETRY_METHODS:
+            setattr(self, name, retry_if_locked(getattr(self, name), self.options['lock_retries']))
+
+    def _set_pragmas(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=%s' % (self.options['journal_mode'],))
+        cursor.execute('PRAGMA synchronous=%s' % (self.options['synchronous'],))
+        cursor.execute('PRAGMA mmap_size=%d' % (int(self.options['mmap_size']),))
+        cursor.execute('PRAGMA cache_size=%d' % (int(self.options['cache_size']),))
+        cursor.close()
@@ -0,0 +1,52 @@
+'''
+StatementCache holds compiled SQL for the fixed-shape statements that
+BundleModel runs over and over (e.g., in the worker loop), so that building and
+compiling their SQLAlchemy expressions only happens once.
+
+A statement is cached under a key that determines it completely: any value that
+varies between calls must be a bind parameter, passed in when the compiled
+statement is executed. IN clauses are padded to a few fixed lengths (see
+BundleModel._pad_in_values) so that they only have a few shapes.
+'''
+import threading
+import time
+
+from sqlalchemy.util import LRUCache
+
+
+class StatementCache(object):
+    def __init__(self, capacity=1000, query_log=None):
+        '''
+        capacity: approximate maximum number of compiled statements to keep.
+        query_log: QueryLog to report hits and misses to, per command.
+        '''
+        self._cache = LRUCache(capacity)
+        self._lock = threading.Lock()
+        self.query_log = query_log
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.0  # Time spent compiling statements on misses.
+        self.compile_time_saved = 0.0  # Time those compilations would have taken on hits.
+
+    def get(self, dialect, key, make_statement):
+        '''
+        Return the compiled form of the statement built by make_statement() for
+        the given dialect, compiling it only if it's not cached under the key.
+        '''
+        entry = self._cache.get((dialect, key))
+        if entry is not None:
+            (compiled, compile_time) = entry
+            with self._lock:
+                self.hits += 1
+                self.compile_time_saved += compile_time
+        else:
+            start_time = time.time()
+            compiled = make_statement().compile(dialect=dialect)
+            compile_time = time.time() - start_time
+            self._cache[(dialect, key)] = (compiled, compile_time)
+            with self._lock:
+                self.misses += 1
+                self.compile_time += compile_time
+        if self.query_log:
+            self.query_log.record_compile(entry is not None, compile_time)
+        return compiled
@@ -14,6 +14,7 @@ from sqlalchemy.types import (
   String,
   Text,
   Boolean,
+  Float,
 )
 
 db_metadata = MetaData()
@@ -30,12 +31,16 @@ bundle = Table(
   Column('data_hash', String(63), nullable=True),
   Column('state', String(63), nullable=False),
   Column('owner_id', String(255), nullable=True),
+  # JSON document with all of the bundle's metadata, when the model stores
+  # metadata as documents; NULL if the metadata is in bundle_metadata.
+  Column('metadata_document', Text, nullable=True),
   UniqueConstraint('uuid', name='uix_1'),
   Index('bundle_data_hash_index', 'data_hash'),
   sqlite_autoincrement=True,
 )
 
-# Includes things like name, description, etc.
+# Includes things like name, description, etc. When metadata is stored as
+# documents on the bundle table, this only holds the keys used for search.
 bundle_metadata = Table(
   'bundle_metadata',
   db_metadata,
@@ -44,6 +49,7 @@ bundle_metadata = Table(
   Column('metadata_key', String(63), nullable=False),
   Column('metadata_value', Text, nullable=False),
   Index('metadata_kv_index', 'metadata_key', 'metadata_value', mysql_length=63),
+  Index('metadata_bundle_uuid_index', 'bundle_uuid'),
   sqlite_autoincrement=True,
 )
 
@@ -69,6 +75,34 @@ bundle_action = Table(
   sqlite_autoincrement=True,
 )
 
+# Claims of workers on the bundles that they run, when several workers share
+# the database (see Worker). A worker renews the leases on its bundles while it
+# is alive, and another worker takes over the leases that have expired.
+bundle_lease = Table(
+  'bundle_lease',
+  db_metadata,
+  Column('id', Integer, primary_key=True, nullable=False),
+  Column('bundle_uuid', String(63), ForeignKey(bundle.c.uuid), nullable=False),
+  Column('worker_id', String(127), nullable=False),
+  Column('expires', Float(precision=53), nullable=False),  # Time at which the lease lapses.
+  Index('bundle_lease_bundle_uuid_index', 'bundle_uuid', unique=True),
+  Index('bundle_lease_worker_id_index', 'worker_id'),
+  sqlite_autoincrement=True,
+)
+
+# Run keys identify the results of runs (see RunBundle.get_run_key), so that a
+# run can reuse the results of an identical run that is READY (see Worker).
+bundle_run_key = Table(
+  'bundle_run_key',
+  db_metadata,
+  Column('id', Integer, primary_key=True, nullable=False),
+  Column('bundle_uuid', String(63), ForeignKey(bundle.c.uuid), nullable=False),
+  Column('run_key', String(63), nullable=False),
+  Index('bundle_run_key_bundle_uuid_index', 'bundle_uuid', unique=True),
+  Index('bundle_run_key_run_key_index', 'run_key'),
+  sqlite_autoincrement=True,
+)
+
 # The worksheet table does not have many columns now, but it will eventually
 # include columns for owner, group, permissions, etc.
 worksheet = Table(
@@ -100,10 +134,11 @@ worksheet_item = Table(
   Column('value', Text, nullable=False),  # TODO: make this nullable
   Column('type', String(20), nullable=False),
 
-  Column('sort_key', Integer, nullable=True),
+  Column('sort_key', Float(precision=53), nullable=True),
   Index('worksheet_item_worksheet_uuid_index', 'worksheet_uuid'),
   Index('worksheet_item_bundle_uuid_index', 'bundle_uuid'),
   Index('worksheet_item_subworksheet_uuid_index', 'subworksheet_uuid'),
+  Index('worksheet_item_sort_index', 'worksheet_uuid', 'sort_key', 'id'),
   sqlite_autoincrement=True,
 )
 
@@ -160,6 +195,23 @@ group_object_permission = Table(
   sqlite_autoincrement=True,
 )
 
+# Append-only log of the changes made to bundles, worksheets and their
+# permissions, so that clients can ask what changed since the last change they
+# saw (see BundleModel.get_changes). Each entry is written in the same
+# transaction as the change itself; old entries are compacted away.
+change_log = Table(
+  'change_log',
+  db_metadata,
+  Column('seq', Integer, primary_key=True, nullable=False),
+  Column('object_type', String(63), nullable=False),  # bundle or worksheet
+  Column('object_uuid', String(63), nullable=False),
+  # One of create, update, delete, items (of a worksheet) or permission.
+  Column('change', String(63), nullable=False),
+  Column('time', Float(precision=53), nullable=False),
+  Index('change_log_time_index', 'time'),
+  sqlite_autoincrement=True,
+)
+
 # A permission value is one of the following: none (0), read (1), or all (2).
 GROUP_OBJECT_PERMISSION_NONE = 0x00
 GROUP_OBJECT_PERMISSION_READ = 0x01
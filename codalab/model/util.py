@@ -1,8 +1,35 @@
 '''
 Some utility classes and methods used with the CodaLab bundle model.
 '''
+import functools
+import random
+import time
+
+from sqlalchemy.exc import OperationalError
+
 class LikeQuery(str):
     '''
     Used for a string that should be used to construct a LIKE clause instead of
     an equality clause in make_bundle_clause.
     '''
+
+
+def retry_if_locked(func, max_retries, base_delay=0.05):
+    '''
+    Wrap func so that it is re-run from the start if the database reports that
+    it is locked, sleeping for a random (jittered) exponential backoff between
+    attempts so that competing processes don't retry in lockstep.
+    Only wrap functions that do all their writes in a single transaction.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except OperationalError, e:
+                if attempt >= max_retries or 'database is locked' not in str(e):
+                    raise
+                time.sleep(random.uniform(0, base_delay * (2 ** attempt)))
+                attempt += 1
+    return wrapper
@@ -0,0 +1,80 @@
+'''
+WorkerWakeup lets the processes that write to the bundle database wake up the
+worker as soon as there is something for it to do, instead of leaving it to
+find out on its next poll.
+
+Writers call notify after committing a change the worker cares about (new
+bundles, kill actions, bundles that finished), which sends a small UDP datagram
+to the worker's port on each of the configured hosts. The worker calls listen
+once and then wait, which returns as soon as a datagram arrives. Datagrams can
+be lost and nobody might be listening, so notify never fails and the worker
+still polls, only much less often.
+'''
+import errno
+import select
+import socket
+
+
+class WorkerWakeup(object):
+    # Largest datagram that we read; notifications are just a short reason.
+    MAX_MESSAGE_SIZE = 512
+
+    def __init__(self, port, hosts=('localhost',)):
+        '''
+        port: UDP port that the worker listens on.
+        hosts: hosts to send notifications to (the hosts that run a worker).
+        '''
+        self.port = port
+        self.hosts = list(hosts)
+        self._send_socket = None
+        self._listen_socket = None
+
+    def notify(self, reason):
+        '''
+        Wake up the workers, passing along the reason (e.g., 'created').
+        '''
+        if self._send_socket is None:
+            self._send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._send_socket.setblocking(False)
+        for host in self.hosts:
+            try:
+                self._send_socket.sendto(reason, (host, self.port))
+            except socket.error:
+                pass  # The worker will pick up the change on its next poll.
+
+    def listen(self):
+        '''
+        Start receiving notifications (called by the worker).
+        '''
+        self._listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listen_socket.bind(('', self.port))
+        self._listen_socket.setblocking(False)
+        self.port = self._listen_socket.getsockname()[1]  # In case port 0 picked any free port.
+
+    def wait(self, timeout):
+        '''
+        Wait up to timeout seconds for a notification, and return the reasons of
+        all the notifications received (an empty list on timeout).
+        '''
+        try:
+            readable = select.select([self._listen_socket], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        reasons = []
+        while readable:
+            # Drain everything that has arrived, so that a burst of
+            # notifications only wakes the worker up once.
+            try:
+                reasons.append(self._listen_socket.recv(self.MAX_MESSAGE_SIZE))
+            except socket.error:
+                break
+        return reasons
+
+    def close(self):
+        for s in (self._send_socket, self._listen_socket):
+            if s is not None:
+                s.close()
+        self._send_socket = self._listen_socket = None
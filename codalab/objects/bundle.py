@@ -2,7 +2,8 @@
 Bundle is the ORM class for an individual bundle in the bundle system.
 This class overrides the ORMObject serialization methods, because a single
 bundle is stored in the database as one row in in the bundle table, plus
-multiple rows in the metadata and dependency tables.
+multiple rows in the metadata and dependency tables. (The model may store the
+metadata as a document in the bundle row instead; see BundleModel.)
 
 Each bundle type is implemented in a subclass of this class. These subclasses
 must set their BUNDLE_TYPE and METADATA_SPEC class attributes. In addition,
@@ -0,0 +1,109 @@
+'''
+FinalizerPool runs the slow part of finalizing bundles (hashing and moving their
+output into the bundle store) on a few background threads, so that the worker
+loop can keep starting and killing bundles in the meantime (see
+Worker.update_running_bundle).
+
+The tasks must not use the bundle model: the worker collects the results with
+get_results and does the database updates itself.
+'''
+import Queue
+import threading
+import time
+import traceback
+
+
+class FinalizerPool(object):
+    def __init__(self, num_threads, max_queued=100):
+        '''
+        num_threads: number of tasks that run at once.
+        max_queued: number of tasks that can wait for a thread, beyond which
+          submit refuses new tasks.
+        '''
+        self.max_pending = num_threads + max_queued
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+        self.lock = threading.Lock()
+        self.num_queued = 0
+        self.num_running = 0
+        self.num_finished = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.threads = []
+        for i in range(num_threads):
+            thread = threading.Thread(target=self._run, name='finalizer-%d' % (i,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            (key, function) = task
+            with self.lock:
+                self.num_queued -= 1
+                self.num_running += 1
+            start_time = time.time()
+            try:
+                result = function()
+            except Exception, e:
+                traceback.print_exc()
+                result = e
+            elapsed_time = time.time() - start_time
+            with self.lock:
+                self.num_running -= 1
+                self.num_finished += 1
+                self.total_time += elapsed_time
+                self.max_time = max(self.max_time, elapsed_time)
+            self.results.put((key, result, elapsed_time))
+
+    def submit(self, key, function):
+        '''
+        Run function() on a thread, unless too many tasks are waiting already.
+        Return whether the task was accepted.
+        '''
+        with self.lock:
+            if self.num_queued + self.num_running >= self.max_pending:
+                return False
+            self.num_queued += 1
+        self.tasks.put((key, function))
+        return True
+
+    def get_results(self):
+        '''
+        Return a list of (key, result, seconds taken) for the tasks that have
+        finished since the last call, where result is what the function
+        returned or the exception it raised.
+        '''
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except Queue.Empty:
+                return results
+
+    def get_stats(self):
+        '''
+        Return the number of tasks waiting for a thread (queued) and running,
+        and the number and durations (in seconds) of the finished tasks.
+        '''
+        with self.lock:
+            return {
+                'queued': self.num_queued,
+                'running': self.num_running,
+                'finished': self.num_finished,
+                'mean_time': self.total_time / self.num_finished if self.num_finished else None,
+                'max_time': self.max_time,
+            }
+
+    def close(self):
+        '''
+        Stop the threads once they have run the tasks submitted so far.
+        '''
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
@@ -1,6 +1,7 @@
 '''
 Machine is a class that manages execution of bundle(s) that need to be run.
 '''
+import traceback
 
 class Machine(object):
     def start_bundle(self, bundle, bundle_store, parent_dict):
@@ -10,10 +11,28 @@ class Machine(object):
         '''
         raise NotImplementedError
 
-    def get_bundle_statuses(self):
+    def start_bundles(self, requests):
+        '''
+        Attempts to begin the execution of several bundles, given a list of
+        (bundle, bundle_store, parent_dict, username).
+        Returns a list with the result of start_bundle for each bundle, or the
+        exception that it raised.
+        '''
+        results = []
+        for request in requests:
+            try:
+                results.append(self.start_bundle(*request))
+            except Exception, e:
+                traceback.print_exc()
+                results.append(e)
+        return results
+
+    def get_bundle_statuses(self, job_handles=None):
         '''
         Checks the status of bundles.
-        Returns a list of bundle statuses (dicts).
+        Returns a list of bundle statuses (dicts). If job_handles is given, only
+        the statuses of those jobs are needed. Returns None if the statuses
+        could not be retrieved (so that no job is presumed to be gone).
         '''
         raise NotImplementedError
 
@@ -3,6 +3,8 @@ Metadata is a wrapper around all of the metadata rows for a single bundle.
 Its constructor takes both the metadata and the bundle's metadata specs,
 and validates the metadata before returning.
 '''
+import json
+
 from codalab.common import UsageError
 
 
@@ -77,6 +79,38 @@ class Metadata(object):
                 metadata_dict[key] = spec.get_constructor()(value)
         return metadata_dict
 
+    @classmethod
+    def load_document(cls, metadata_specs, document):
+        '''
+        Convert a JSON document, as returned by to_document, into a normalized
+        metadata dict (see collapse_dicts).
+        '''
+        metadata_dict = cls.collapse_dicts(metadata_specs, [])
+        metadata_spec_dict = dict((spec.key, spec) for spec in metadata_specs)
+        for (maybe_unicode_key, value) in json.loads(document).iteritems():
+            key = str(maybe_unicode_key)
+            if key not in metadata_spec_dict:
+                continue  # Same as in collapse_dicts
+            spec = metadata_spec_dict[key]
+            if spec.type == list:
+                metadata_dict[key] = list(value)
+            else:
+                metadata_dict[key] = spec.get_constructor()(value)
+        return metadata_dict
+
+    def to_document(self, metadata_specs):
+        '''
+        Serialize this metadata object into a single JSON document that can be
+        saved to the bundle table. Like to_dicts, skips None values.
+        '''
+        document = {}
+        for spec in metadata_specs:
+            if spec.key in self._metadata_keys:
+                value = getattr(self, spec.key)
+                if value == None: continue
+                document[spec.key] = value
+        return json.dumps(document, sort_keys=True)
+
     def to_dicts(self, metadata_specs):
         '''
         Serialize this metadata object and return a list of dicts that can be saved
@@ -0,0 +1,95 @@
+'''
+Scheduler is a class that decides the order in which the worker tries to start
+STAGED bundles (see Worker.update_staged_bundles).
+
+The worker goes through the bundles in that order, and once a bundle of a queue
+(request_queue) fails to start, it skips the other bundles of that queue until
+its next iteration, so a full queue doesn't hold up the others.
+'''
+import collections
+
+from codalab.common import UsageError
+
+
+def get_priority(bundle):
+    return getattr(bundle.metadata, 'request_priority', None) or 0
+
+
+def get_queue(bundle):
+    return getattr(bundle.metadata, 'request_queue', None) or None
+
+
+def get_created(bundle):
+    return getattr(bundle.metadata, 'created', None) or 0
+
+
+class Scheduler(object):
+    def order(self, bundles, running_owner_ids):
+        '''
+        Return the STAGED bundles in the order in which to start them.
+        running_owner_ids is the list of owners of the RUNNING bundles (one
+        entry per bundle).
+        '''
+        raise NotImplementedError
+
+
+class FifoScheduler(Scheduler):
+    '''
+    Start bundles with higher request_priority first, and then the oldest first.
+    '''
+    def order(self, bundles, running_owner_ids):
+        return sorted(bundles, key=lambda bundle: (-get_priority(bundle), get_created(bundle)))
+
+
+class FairShareScheduler(Scheduler):
+    '''
+    Start bundles with higher request_priority first, and share the rest among
+    the owners in proportion to their weights: each owner's next bundle goes
+    before the bundles of owners that are already running (or about to start)
+    more bundles per unit of weight. A user who stages thousands of bundles
+    therefore doesn't hold up the others.
+    '''
+    def __init__(self, user_weights=None, default_weight=1):
+        '''
+        user_weights: owner id => weight (default_weight for other owners).
+        '''
+        self.user_weights = user_weights or {}
+        self.default_weight = default_weight
+
+    def get_weight(self, owner_id):
+        return self.user_weights.get(owner_id, self.default_weight)
+
+    def order(self, bundles, running_owner_ids):
+        num_running = collections.Counter(running_owner_ids)
+        bundles_by_owner = collections.defaultdict(list)
+        for bundle in bundles:
+            bundles_by_owner[bundle.owner_id].append(bundle)
+        keys = {}
+        for (owner_id, owner_bundles) in bundles_by_owner.iteritems():
+            owner_bundles.sort(key=lambda bundle: (-get_priority(bundle), get_created(bundle)))
+            weight = float(self.get_weight(owner_id))
+            # The i-th bundle of an owner starts when the owner has i more
+            # bundles running, so it is ranked by that share of the worker.
+            for (i, bundle) in enumerate(owner_bundles):
+                share = (num_running[owner_id] + i + 1) / weight
+                keys[bundle.uuid] = (-get_priority(bundle), share, get_created(bundle))
+        return sorted(bundles, key=lambda bundle: keys[bundle.uuid])
+
+
+SCHEDULERS = {
+    'fifo': FifoScheduler,
+    'fair_share': FairShareScheduler,
+}
+
+
+def get_scheduler(config=None):
+    '''
+    Return the scheduler described by config (the 'scheduler' entry of a worker
+    in config.json), for example {"type": "fair_share", "user_weights": {"0": 2}}.
+    The default is a fair share scheduler where all users have the same weight.
+    '''
+    config = dict(config or {})
+    scheduler_type = config.pop('type', 'fair_share')
+    if scheduler_type not in SCHEDULERS:
+        raise UsageError('Unknown scheduler %r; options are %s' % (scheduler_type, ', '.join(sorted(SCHEDULERS))))
+    return SCHEDULERS[scheduler_type](**config)
@@ -6,6 +6,7 @@ provides a few methods once it is initialized:
   update_created_bundles: update bundles that are blocking on others.
   update_ready_bundles: run a single bundle in the ready state.
 '''
+import collections
 import contextlib
 import datetime
 import random
@@ -31,15 +32,67 @@ from codalab.bundles.make_bundle import MakeBundle
 from codalab.machines import (
   remote_machine,
 )
+from codalab.objects.finalizer_pool import FinalizerPool
+from codalab.objects.scheduler import (
+  FairShareScheduler,
+  get_queue,
+)
 
 class Worker(object):
-    def __init__(self, bundle_store, model, machine, auth_handler):
+    # Number of change log entries to read at a time (see update_created_bundles).
+    CHANGE_BATCH_SIZE = 1000
+
+    # Metadata of a run that isn't copied when another run reuses its results.
+    UNREUSED_METADATA_KEYS = ('created', 'actions', 'job_handle', 'temp_dir', 'reused_from')
+
+    def __init__(self, bundle_store, model, machine, auth_handler, worker_id=None, lease_time=300, scheduler=None,
+                 reuse_runs=False, start_batch_size=1, num_finalizers=0):
+        '''
+        The scheduler decides in which order STAGED bundles are started (see
+        codalab.objects.scheduler); by default each user gets a fair share.
+
+        If reuse_runs is set, a STAGED run that is identical to a READY run
+        (same command, resource requests and dependency contents, see
+        RunBundle.get_run_key) gets its results instead of running, unless its
+        no_reuse metadata is set.
+
+        Up to start_batch_size STAGED bundles are handed to the machine at once,
+        so that it can submit them together.
+
+        With num_finalizers > 0, the results of finished bundles are uploaded
+        to the bundle store by that many background threads (see FinalizerPool).
+
+        To run several workers against the same database, give each of them a
+        unique worker_id. Each worker then claims the bundles that it runs
+        with a lease, which it renews every lease_time / 3 seconds while it is
+        alive (see heartbeat), and only handles the actions and statuses of
+        its own bundles. The bundles of a worker whose leases expire are taken
+        over by another worker; if the first worker is still alive, it kills
+        their jobs once it notices (see stop_lost_bundles).
+        '''
         self.bundle_store = bundle_store
         self.model = model
         self.profiling_depth = 0
         self.verbose = 0
         self.machine = machine
         self.auth_handler = auth_handler  # In order to get names of owners
+        self.scheduler = scheduler or FairShareScheduler()
+        self.num_running_jobs = 0  # Number of jobs on the machine, as of the last check_finished_bundles
+        self.worker_id = worker_id
+        self.lease_time = lease_time
+        self.last_heartbeat = None
+        self.leased_uuids = set()  # Bundles that this worker holds the leases of
+        self.taken_over_uuids = set()  # Leased bundles of dead workers that the machine hasn't reported yet
+        # The CREATED bundles and the parents they are waiting on (see update_created_bundles).
+        self.unfinished_parents = {}  # uuid => uuids of its parents that aren't READY yet
+        self.waiting_children = collections.defaultdict(set)  # parent uuid => uuids of CREATED children waiting on it
+        self.change_seq = None  # Sequence number of the last change log entry read
+        self.last_full_scan = None
+        self.full_scan_interval = 60
+        self.reuse_runs = reuse_runs
+        self.start_batch_size = start_batch_size
+        self.finalizer_pool = FinalizerPool(num_finalizers) if num_finalizers else None
+        self.finalizing = {}  # uuid => (bundle, success) of the bundles that the finalizer pool is working on
 
     def pretty_print(self, message):
         time_str = datetime.datetime.utcnow().isoformat()[:19].replace('T', ' ')
@@ -91,51 +144,130 @@ class Worker(object):
         Run the given bundle using an available Machine.
         Return whether something was started.
         '''
-        # Check that we're running a bundle in the RUNNING state.
-        state_message = 'Unexpected bundle state: %s' % (bundle.state,)
-        precondition(bundle.state == State.RUNNING, state_message)
-        data_hash_message = 'Unexpected bundle data_hash: %s' % (bundle.data_hash,)
-        precondition(bundle.data_hash is None, data_hash_message)
+        return self.start_bundles([bundle])[0]
 
-        # Run the bundle.
-        with self.profile('Running bundle...'):
-            started = False
-            if isinstance(bundle, RunBundle):
+    def start_bundles(self, bundles):
+        '''
+        Run the given bundles using an available Machine, which can start
+        several of them at once.
+        Return a list saying whether each bundle was started.
+        '''
+        for bundle in bundles:
+            # Check that we're running a bundle in the RUNNING state.
+            state_message = 'Unexpected bundle state: %s' % (bundle.state,)
+            precondition(bundle.state == State.RUNNING, state_message)
+            data_hash_message = 'Unexpected bundle data_hash: %s' % (bundle.data_hash,)
+            precondition(bundle.data_hash is None, data_hash_message)
+
+        # Run the bundles.
+        with self.profile('Running %s bundles...' % (len(bundles),)):
+            statuses = {}  # uuid => status of the bundles that started
+            run_bundles = [bundle for bundle in bundles if isinstance(bundle, RunBundle)]
+            if run_bundles:
                 try:
-                    # Get the username of the bundle
-                    results = self.auth_handler.get_users('ids', [bundle.owner_id])
-                    if results.get(bundle.owner_id):
-                        username = results[bundle.owner_id].name
-                    else:
-                        username = str(bundle.owner_id)
-
-                    status = self.machine.start_bundle(bundle, self.bundle_store, self.get_parent_dict(bundle), username)
-                    if status != None:
-                        started = True
-
+                    # Get the usernames of the bundles
+                    owner_ids = list(set(bundle.owner_id for bundle in run_bundles))
+                    users = self.auth_handler.get_users('ids', owner_ids)
+                    requests = []
+                    for bundle in run_bundles:
+                        if users.get(bundle.owner_id):
+                            username = users[bundle.owner_id].name
+                        else:
+                            username = str(bundle.owner_id)
+                        requests.append((bundle, self.bundle_store, self.get_parent_dict(bundle), username))
+                    results = self.machine.start_bundles(requests)
                 except Exception as e:
-                    # If there's an exception, we just make the bundle fail
-                    # (even if it's not the bundle's fault).
-                    temp_dir = canonicalize.get_current_location(self.bundle_store, bundle.uuid)
-                    path_util.make_directory(temp_dir)
-                    status = {'bundle': bundle, 'success': False, 'failure_message': str(e), 'temp_dir': temp_dir}
-                    print '=== INTERNAL ERROR: %s' % e
-                    started = True  # Force failing
                     traceback.print_exc()
-            else:  # MakeBundle
-                started = True
-            if started: print '-- START BUNDLE: %s' % (bundle,)
+                    results = [e] * len(run_bundles)
+
+                for (bundle, result) in zip(run_bundles, results):
+                    if isinstance(result, Exception):
+                        # If there's an exception, we just make the bundle fail
+                        # (even if it's not the bundle's fault).
+                        temp_dir = canonicalize.get_current_location(self.bundle_store, bundle.uuid)
+                        path_util.make_directory(temp_dir)
+                        statuses[bundle.uuid] = {'bundle': bundle, 'success': False, 'failure_message': str(result), 'temp_dir': temp_dir}
+                        print '=== INTERNAL ERROR: %s' % result
+                    elif result != None:
+                        statuses[bundle.uuid] = result
 
             # If we have a MakeBundle, then just process it immediately.
-            if isinstance(bundle, MakeBundle):
-                temp_dir = canonicalize.get_current_location(self.bundle_store, bundle.uuid)
-                path_util.make_directory(temp_dir)
-                status = {'bundle': bundle, 'success': True, 'temp_dir': temp_dir}
+            for bundle in bundles:
+                if isinstance(bundle, MakeBundle):
+                    temp_dir = canonicalize.get_current_location(self.bundle_store, bundle.uuid)
+                    path_util.make_directory(temp_dir)
+                    statuses[bundle.uuid] = {'bundle': bundle, 'success': True, 'temp_dir': temp_dir}
+
+            for bundle in bundles:
+                if bundle.uuid not in statuses:
+                    continue
+                created = getattr(bundle.metadata, 'created', None)
+                if created:
+                    print '-- START BUNDLE: %s (%ds after creation)' % (bundle, time.time() - created)
+                else:
+                    print '-- START BUNDLE: %s' % (bundle,)
+                # Update database
+                self.update_running_bundle(statuses[bundle.uuid])
+            return [bundle.uuid in statuses for bundle in bundles]
 
-            # Update database
-            if started:
-                self.update_running_bundle(status)
-            return started
+    def maybe_heartbeat(self):
+        '''
+        Run the heartbeat if it is due (only when there are several workers).
+        Besides once per iteration of run_loop, this is called between the
+        bundles that an iteration starts or finalizes, since those can take
+        longer than lease_time.
+        '''
+        if self.worker_id is not None and \
+           (self.last_heartbeat is None or time.time() - self.last_heartbeat >= self.lease_time / 3.0):
+            self.heartbeat()
+
+    def heartbeat(self):
+        '''
+        Renew the leases of this worker and take over the expired leases of
+        other workers (only when there are several workers).
+        '''
+        previous_uuids = self.leased_uuids
+        self.leased_uuids = set(self.model.renew_bundle_leases(self.worker_id, self.lease_time))
+        lost_uuids = previous_uuids - self.leased_uuids
+        if lost_uuids:
+            self.stop_lost_bundles(lost_uuids)
+        if self.last_heartbeat is None:
+            # This worker was restarted, so its machine might have lost the
+            # jobs that it had started.
+            self.taken_over_uuids.update(self.leased_uuids)
+        taken_over_uuids = self.model.take_over_expired_bundle_leases(self.worker_id, self.lease_time)
+        if taken_over_uuids:
+            self.pretty_print('Took over %s bundles from workers that stopped: %s' % (len(taken_over_uuids), ' '.join(taken_over_uuids)))
+            self.leased_uuids.update(taken_over_uuids)
+            self.taken_over_uuids.update(taken_over_uuids)
+        self.restart_finalizing_bundles(self.taken_over_uuids)
+        self.last_heartbeat = time.time()
+
+    def stop_lost_bundles(self, uuids):
+        '''
+        Kill the jobs of the bundles whose leases this worker lost (because it
+        didn't renew them in time, so another worker took them over), and free
+        their resources on the machine.
+        '''
+        self.pretty_print('Lost the leases of %s bundles: %s' % (len(uuids), ' '.join(uuids)))
+        self.taken_over_uuids -= uuids
+        for bundle in self.model.batch_get_bundles(uuid=list(uuids)):
+            if bundle.uuid in self.finalizing:
+                continue  # The job is done already.
+            if getattr(bundle.metadata, 'job_handle', None) is None:
+                continue
+            if not self.machine.kill_bundle(bundle):
+                print 'Killing %s failed' % bundle.uuid
+            self.machine.finalize_bundle(bundle)
+
+    def release_bundle(self, bundle):
+        '''
+        Give up the lease on a bundle that is no longer running.
+        '''
+        if self.worker_id is not None:
+            self.model.release_bundle_leases([bundle.uuid])
+            self.leased_uuids.discard(bundle.uuid)
+            self.taken_over_uuids.discard(bundle.uuid)
 
     def _safe_get_bundle(self, uuid):
         try:
@@ -147,7 +279,7 @@ class Worker(object):
         '''
         For bundles that need to be killed, tell the machine to kill it.
         '''
-        bundle_actions = self.model.pop_bundle_actions()
+        bundle_actions = self.model.pop_bundle_actions(self.worker_id)
         if self.verbose >= 2: print 'bundle_actions:', bundle_actions
         db_update = {}
         for x in bundle_actions:
@@ -168,19 +300,30 @@ class Worker(object):
     # Poll processes to see if bundles have finished running
     # Either way, update the bundle metadata.
     def check_finished_bundles(self):
-        statuses = self.machine.get_bundle_statuses()
-
-        # Lookup the bundle given the uuid from the status
+        # Lookup the bundle given the job handle from the status, among the
+        # RUNNING bundles (which we need anyway to find zombies below).
+        running_bundles = self.model.batch_get_bundles(state=State.RUNNING)
+        if self.worker_id is not None:
+            running_bundles = [bundle for bundle in running_bundles if bundle.uuid in self.leased_uuids]
+        job_handle_bundles = {}
+        for bundle in running_bundles:
+            job_handle = getattr(bundle.metadata, 'job_handle', None)
+            if job_handle:
+                job_handle_bundles[job_handle] = bundle
+
+        # Only ask about the jobs of these bundles.
+        statuses = self.machine.get_bundle_statuses(job_handles=job_handle_bundles.keys())
+        if statuses is None:
+            # The machine couldn't tell, so don't take the jobs it didn't
+            # report for lost (in particular the taken over ones); try again
+            # next time.
+            return
+        self.num_running_jobs = len(statuses)
         new_statuses = []
         for status in statuses:
-            handle = status['job_handle']
-            # Note: should probably have a more specalized way of getting this.
-            uuids = self.model.search_bundle_uuids(worksheet_uuid=None, user_id=self.model.root_user_id, keywords=['job_handle='+handle])
-            if len(uuids) == 0:
-                continue
-            bundle = self._safe_get_bundle(uuids[0])
+            bundle = job_handle_bundles.get(status['job_handle'])
             if not bundle:
-                continue
+                continue  # Not the job of a running bundle (of this worker)
             status['bundle'] = bundle
             new_statuses.append(status)
         statuses = new_statuses
@@ -196,19 +339,28 @@ class Worker(object):
         # mentioned in statuses.  These are probably zombies, and we want to
         # get rid of them if they have been issued a kill action.
         status_bundle_uuids = set(status['bundle'].uuid for status in statuses)
-        running_bundles = self.model.batch_get_bundles(state=State.RUNNING)
         for bundle in running_bundles:
             if bundle.uuid in status_bundle_uuids: continue
+            if bundle.uuid in self.taken_over_uuids:
+                # The job of a dead worker that this machine doesn't know about
+                # (e.g., a process on another host), so it can't be finished.
+                status = {'state': State.FAILED, 'bundle': bundle, 'failure_message': 'Worker running the bundle stopped'}
+                print 'work_manager: %s (%s): lost with its worker %s' % (bundle.uuid, bundle.state, status)
+                self.update_running_bundle(status)
+                continue
             if Command.KILL not in getattr(bundle.metadata, 'actions', set()): continue
             status = {'state': State.FAILED, 'bundle': bundle}
             print 'work_manager: %s (%s): killing zombie %s' % (bundle.uuid, bundle.state, status)
             self.update_running_bundle(status)
 
+        self.taken_over_uuids.clear()  # The others are running here after all.
+
         # Update the status of these bundles.
         for status in statuses:
             bundle = status['bundle']
-            if bundle.state in [State.READY, State.FAILED]:  # Skip bundles that have already completed.
-                continue
+            self.maybe_heartbeat()
+            if self.worker_id is not None and bundle.uuid not in self.leased_uuids:
+                continue  # Lost to another worker in the meantime
             print 'work_manager: %s (%s): %s' % (bundle.uuid, bundle.state, status)
             self.update_running_bundle(status)
 
@@ -216,6 +368,8 @@ class Worker(object):
         '''
         Update the database with information about the bundle given by |status|.
         If the bundle is completed, then we need to install the bundle and clean up.
+        With a finalizer pool, the bundle is FINALIZING while that happens in the
+        background (see check_finalized_bundles), unless the pool is full.
         '''
         # Update the bundle's data with status (which is the new information).
         bundle = status['bundle']
@@ -240,24 +394,22 @@ class Worker(object):
         # See if the bundle is completed.
         success = status.get('success')
         if success != None:
-            # Re-install dependencies.
-            # - For RunBundle, remove the dependencies.
-            # - For MakeBundle, copy.  This way, we maintain the invariant that
-            # we always only need to look back one-level at the dependencies,
-            # not recurse.
-            try:
-                temp_dir = status.get('temp_dir')
-                if not temp_dir:
-                    temp_dir = bundle.metadata.temp_dir
-                if isinstance(bundle, RunBundle):
-                    print >>sys.stderr, 'Worker.finalize_bundle: removing dependencies from %s (RunBundle)' % temp_dir
-                    bundle.remove_dependencies(self.bundle_store, self.get_parent_dict(bundle), temp_dir)
-                else:
-                    print >>sys.stderr, 'Worker.finalize_bundle: installing (copying) dependencies to %s (MakeBundle)' % temp_dir
-                    bundle.install_dependencies(self.bundle_store, self.get_parent_dict(bundle), temp_dir, copy=True)
+            temp_dir = status.get('temp_dir')
+            if not temp_dir:
+                temp_dir = bundle.metadata.temp_dir
+            parent_dict = self.get_parent_dict(bundle)
+            # The job has exited, so the machine can already start other
+            # bundles in its place; end_bundle only cleans up its files.
+            if self.finalizer_pool is not None and bundle.uuid not in self.finalizing and \
+               self.finalizer_pool.submit(bundle.uuid, lambda: self.upload_bundle(bundle, parent_dict, temp_dir)):
+                db_update['state'] = State.FINALIZING
+                self.model.update_bundle(bundle, db_update)
+                self.finalizing[bundle.uuid] = (bundle, success)
+                print '-- FINALIZE BUNDLE: %s (%s queued)' % (bundle, self.finalizer_pool.get_stats()['queued'])
+                return
 
-                # Note: uploading will move temp_dir to the bundle store.
-                data_hash, new_metadata = self.bundle_store.upload(temp_dir, follow_symlinks=False)
+            try:
+                (data_hash, new_metadata) = self.upload_bundle(bundle, parent_dict, temp_dir)
                 db_update['data_hash'] = data_hash
                 metadata.update(new_metadata)
             except Exception as e:
@@ -265,63 +417,231 @@ class Worker(object):
                 traceback.print_exc()
                 success = False
                 metadata['failure_message'] = e.message
+            self.end_bundle(bundle, db_update, success)
+            return
 
-            # Clean up any state for RunBundles.
-            if isinstance(bundle, RunBundle):
-                try:
-                    self.machine.finalize_bundle(bundle)
-                except Exception as e:
-                    success = False
-                    if 'failure_message' not in metadata:
-                        metadata['failure_message'] = e.message
-                    else:
-                        metadata['failure_message'] += '\n' + e.message
+        # Update database!
+        self.model.update_bundle(bundle, db_update)
+        if db_update.get('state') in (State.READY, State.FAILED):
+            self.release_bundle(bundle)
+
+    def upload_bundle(self, bundle, parent_dict, temp_dir):
+        '''
+        Move the results of a finished bundle from temp_dir to the bundle store,
+        and return their (data_hash, metadata). This doesn't use the model, so
+        that it can run on a finalizer thread.
+        '''
+        # Re-install dependencies.
+        # - For RunBundle, remove the dependencies.
+        # - For MakeBundle, copy.  This way, we maintain the invariant that
+        # we always only need to look back one-level at the dependencies,
+        # not recurse.
+        if isinstance(bundle, RunBundle):
+            print >>sys.stderr, 'Worker.finalize_bundle: removing dependencies from %s (RunBundle)' % temp_dir
+            bundle.remove_dependencies(self.bundle_store, parent_dict, temp_dir)
+        else:
+            print >>sys.stderr, 'Worker.finalize_bundle: installing (copying) dependencies to %s (MakeBundle)' % temp_dir
+            bundle.install_dependencies(self.bundle_store, parent_dict, temp_dir, copy=True)
+
+        # Note: uploading will move temp_dir to the bundle store.
+        return self.bundle_store.upload(temp_dir, follow_symlinks=False)
+
+    def end_bundle(self, bundle, db_update, success):
+        '''
+        Clean up after a bundle whose results have been uploaded (or failed to)
+        and move it to READY or FAILED, along with db_update.
+        '''
+        metadata = db_update.setdefault('metadata', {})
+        # Clean up any state for RunBundles.
+        if isinstance(bundle, RunBundle):
+            try:
+                self.machine.finalize_bundle(bundle)
+            except Exception as e:
+                success = False
+                failure_message = metadata.get('failure_message', getattr(bundle.metadata, 'failure_message', None))
+                if not failure_message:
+                    metadata['failure_message'] = e.message
+                else:
+                    metadata['failure_message'] = failure_message + '\n' + e.message
 
-            state = State.READY if success else State.FAILED
-            db_update['state'] = state
-            print '-- END BUNDLE: %s [%s]' % (bundle, state)
-            print ''
+        state = State.READY if success else State.FAILED
+        db_update['state'] = state
+        print '-- END BUNDLE: %s [%s]' % (bundle, state)
+        print ''
 
         # Update database!
         self.model.update_bundle(bundle, db_update)
+        self.release_bundle(bundle)
+
+    def check_finalized_bundles(self):
+        '''
+        Finish the FINALIZING bundles whose results the finalizer pool has
+        uploaded. Return whether there were any.
+        '''
+        if self.finalizer_pool is None:
+            return False
+        results = self.finalizer_pool.get_results()
+        for (uuid, result, elapsed_time) in results:
+            (bundle, success) = self.finalizing.pop(uuid)
+            db_update = {'metadata': {}}
+            if isinstance(result, Exception):
+                print '=== INTERNAL ERROR: %s' % result
+                success = False
+                db_update['metadata']['failure_message'] = result.message
+            else:
+                (db_update['data_hash'], new_metadata) = result
+                db_update['metadata'].update(new_metadata)
+            stats = self.finalizer_pool.get_stats()
+            print '-- FINALIZED BUNDLE: %s in %.1fs (%s queued, %s running; %.1fs on average, %.1fs at most)' % \
+                (bundle, elapsed_time, stats['queued'], stats['running'], stats['mean_time'], stats['max_time'])
+            self.end_bundle(bundle, db_update, success)
+        return len(results) > 0
+
+    def restart_finalizing_bundles(self, uuids=None):
+        '''
+        Move the FINALIZING bundles (among uuids, if given) that this worker
+        isn't finalizing back to RUNNING, so that they are finalized again from
+        the status of their job. These were left by a worker that stopped.
+        '''
+        if uuids is not None and not uuids:
+            return
+        kwargs = {'state': State.FINALIZING}
+        if uuids is not None:
+            kwargs['uuid'] = list(uuids)
+        bundles = [bundle for bundle in self.model.batch_get_bundles(**kwargs) if bundle.uuid not in self.finalizing]
+        if bundles:
+            self.pretty_print('Restarting the finalization of %s bundles: %s' % (len(bundles), ' '.join(bundle.uuid for bundle in bundles)))
+            self.update_bundle_states(bundles, State.RUNNING)
+
+    def _track_created_bundles(self, bundles):
+        '''
+        Start tracking the given CREATED bundles ({uuid, parent_uuids} dicts):
+        all of their parents count as unfinished until we learn their states.
+        '''
+        for bundle in bundles:
+            self.unfinished_parents[bundle['uuid']] = set(bundle['parent_uuids'])
+            for parent_uuid in bundle['parent_uuids']:
+                self.waiting_children[parent_uuid].add(bundle['uuid'])
+
+    def _untrack_created_bundle(self, uuid):
+        for parent_uuid in self.unfinished_parents.pop(uuid, ()):
+            children = self.waiting_children.get(parent_uuid)
+            if children is not None:
+                children.discard(uuid)
+                if not children:
+                    del self.waiting_children[parent_uuid]
+
+    def _update_parent_states(self, parents, failure_messages):
+        '''
+        Record the states of parents ({uuid, state} dicts) of tracked bundles.
+        Children of READY parents have one fewer unfinished parent, and the
+        children of FAILED parents are added to failure_messages.
+        '''
+        for parent in parents:
+            if parent['state'] not in (State.READY, State.FAILED):
+                continue
+            for child_uuid in self.waiting_children.pop(parent['uuid'], ()):
+                if parent['state'] == State.FAILED:
+                    failed_uuids = failure_messages.setdefault(child_uuid, [])
+                    failed_uuids.append(parent['uuid'])
+                else:
+                    self.unfinished_parents[child_uuid].discard(parent['uuid'])
+
+    def _scan_created_bundles(self, failure_messages):
+        '''
+        Rebuild the tracking of CREATED bundles from scratch.
+        '''
+        # Changes made from now on will be read by _read_created_bundle_changes.
+        self.change_seq = self.model.get_last_change_seq()
+        self.last_full_scan = time.time()
+        with self.profile('Getting CREATED bundles...'):
+            bundles = self.model.batch_get_bundle_fields(['uuid', 'parent_uuids'], state=State.CREATED)
+        self.unfinished_parents = {}
+        self.waiting_children = collections.defaultdict(set)
+        self._track_created_bundles(bundles)
+        with self.profile('Getting parents...'):
+            parents = self.model.batch_get_bundle_fields(['uuid', 'state'], uuid=list(self.waiting_children))
+        self._update_parent_states(parents, failure_messages)
+
+    def _read_created_bundle_changes(self, failure_messages):
+        '''
+        Update the tracking of CREATED bundles with the bundles that changed
+        since the last call, according to the change log. Return False if the
+        change log no longer goes back that far.
+        '''
+        changed_uuids = set()
+        while True:
+            result = self.model.get_changes(self.change_seq, self.CHANGE_BATCH_SIZE)
+            if result['truncated']:
+                return False
+            for change in result['changes']:
+                if change['object_type'] != 'bundle':
+                    continue
+                if change['change'] == 'delete':
+                    self._untrack_created_bundle(change['object_uuid'])
+                    changed_uuids.discard(change['object_uuid'])
+                elif change['change'] == 'create' or change['object_uuid'] in self.unfinished_parents or \
+                     change['object_uuid'] in self.waiting_children:
+                    changed_uuids.add(change['object_uuid'])
+            self.change_seq = result['last_seq']
+            if len(result['changes']) < self.CHANGE_BATCH_SIZE:
+                break
+        if not changed_uuids:
+            return True
+
+        bundles = self.model.batch_get_bundle_fields(['uuid', 'state', 'parent_uuids'], uuid=list(changed_uuids))
+        new_bundles = []
+        for bundle in bundles:
+            if bundle['uuid'] in self.unfinished_parents and bundle['state'] != State.CREATED:
+                self._untrack_created_bundle(bundle['uuid'])  # Staged or failed by someone else
+            elif bundle['uuid'] not in self.unfinished_parents and bundle['state'] == State.CREATED:
+                new_bundles.append(bundle)
+        self._track_created_bundles(new_bundles)
+        # The parents of new bundles that didn't change themselves.
+        parent_uuids = set(
+          parent_uuid for bundle in new_bundles for parent_uuid in bundle['parent_uuids']
+        ) - changed_uuids
+        parents = self.model.batch_get_bundle_fields(['uuid', 'state'], uuid=list(parent_uuids)) if parent_uuids else []
+        self._update_parent_states(bundles + parents, failure_messages)
+        return True
 
     def update_created_bundles(self):
         '''
-        Scan through CREATED bundles check their dependencies' statuses.
+        Keep track of the parents that each CREATED bundle is waiting on.
         If any parent is FAILED, move them to FAILED.
         If all parents are READY, move them to STAGED.
         Return whether something happened
+
+        Only the bundles that changed since the last call (according to the
+        change log) are read, except for a full scan every full_scan_interval
+        seconds, which catches changes that were committed out of order.
         '''
         #print '-- Updating CREATED bundles! --'
-        with self.profile('Getting CREATED bundles...'):
-            bundles = self.model.batch_get_bundles(state=State.CREATED)
-            if self.verbose >= 1 and len(bundles) > 0:
-                self.pretty_print('Updating %s created bundles.' % (len(bundles),))
-        parent_uuids = set(
-          dep.parent_uuid for bundle in bundles for dep in bundle.dependencies
-        )
+        failure_messages = {}  # uuid => uuids of its FAILED parents
+        if self.change_seq is None or time.time() - self.last_full_scan >= self.full_scan_interval or \
+           not self._read_created_bundle_changes(failure_messages):
+            failure_messages = {}
+            self._scan_created_bundles(failure_messages)
+        uuids_to_stage = [
+          uuid for (uuid, parent_uuids) in self.unfinished_parents.iteritems()
+          if not parent_uuids and uuid not in failure_messages
+        ]
 
-        with self.profile('Getting parents...'):
-            parents = self.model.batch_get_bundles(uuid=parent_uuids)
-        all_parent_states = {parent.uuid: parent.state for parent in parents}
-        all_parent_uuids = set(all_parent_states)
         bundles_to_fail = []
         bundles_to_stage = []
-        for bundle in bundles:
-            parent_uuids = set(dep.parent_uuid for dep in bundle.dependencies)
-            missing_uuids = parent_uuids - all_parent_uuids
-            # If uuid doesn't exist, then don't process this bundle yet (the dependency might show up later)
-            if missing_uuids: continue
-            parent_states = {uuid: all_parent_states[uuid] for uuid in parent_uuids}
-            failed_uuids = [
-              uuid for (uuid, state) in parent_states.iteritems()
-              if state == State.FAILED
-            ]
-            if failed_uuids:
-                bundles_to_fail.append(
-                  (bundle, 'Parent bundles failed: %s' % (', '.join(failed_uuids),)))
-            elif all(state == State.READY for state in parent_states.itervalues()):
-                bundles_to_stage.append(bundle)
+        if failure_messages or uuids_to_stage:
+            with self.profile('Getting %s bundles to update...' % (len(failure_messages) + len(uuids_to_stage),)):
+                for bundle in self.model.batch_get_bundles(uuid=failure_messages.keys() + uuids_to_stage):
+                    # Skip bundles that have left the CREATED state in the meantime.
+                    if bundle.state != State.CREATED:
+                        continue
+                    if bundle.uuid in failure_messages:
+                        message = 'Parent bundles failed: %s' % (', '.join(failure_messages[bundle.uuid]),)
+                        bundles_to_fail.append((bundle, message))
+                    else:
+                        bundles_to_stage.append(bundle)
+            for uuid in failure_messages.keys() + uuids_to_stage:
+                self._untrack_created_bundle(uuid)
 
         with self.profile('Failing %s bundles...' % (len(bundles_to_fail),)):
             for (bundle, failure_message) in bundles_to_fail:
@@ -330,7 +650,7 @@ class Worker(object):
                 self.model.update_bundle(bundle, update)
         self.update_bundle_states(bundles_to_stage, State.STAGED)
         num_processed = len(bundles_to_fail) + len(bundles_to_stage)
-        num_blocking  = len(bundles) - num_processed
+        num_blocking  = len(self.unfinished_parents)
         if num_processed > 0:
             self.pretty_print('%s CREATED bundles => %s STAGED, %s FAILED; %s bundles still waiting on dependencies.' % \
                 (num_processed, len(bundles_to_stage), len(bundles_to_fail), num_blocking,))
@@ -339,48 +659,169 @@ class Worker(object):
 
     def update_staged_bundles(self):
         '''
-        If there are any STAGED bundles, pick one and try to lock it.
-        If we get a lock, move the locked bundle to RUNNING and then run it.
+        Go through the STAGED bundles in the order given by the scheduler, and
+        try to lock each one. If we get a lock, move the locked bundle to
+        RUNNING and then run it. Once a bundle fails to start, the other
+        bundles of its queue (request_queue) are left for the next call.
         '''
         #print '-- Updating STAGED bundles! --'
         with self.profile('Getting STAGED bundles...'):
             bundles = self.model.batch_get_bundles(state=State.STAGED)
             if self.verbose >= 1 and len(bundles) > 0:
                 self.pretty_print('Staging %s bundles.' % (len(bundles),))
+        if not bundles:
+            return False
+        num_reused = 0
+        run_keys = {}
+        if self.reuse_runs:
+            with self.profile('Reusing results of identical runs...'):
+                (num_reused, bundles, run_keys) = self.reuse_run_results(bundles)
+        with self.profile('Scheduling %s bundles...' % (len(bundles),)):
+            running_owner_ids = [
+              bundle['owner_id'] for bundle in self.model.batch_get_bundle_fields(['owner_id'], state=State.RUNNING)
+            ]
+            bundles = self.scheduler.order(bundles, running_owner_ids)
         new_running_bundles = 0
+        started_run_keys = {}
+        full_queues = set()
+        batch = []
         for bundle in bundles:
-            if not self.update_bundle_states([bundle], State.RUNNING):
+            if get_queue(bundle) in full_queues:
+                continue
+            if self.worker_id is not None:
+                # Another worker might claim the bundle first.
+                if not self.model.claim_bundle(bundle, self.worker_id, self.lease_time):
+                    continue
+                self.leased_uuids.add(bundle.uuid)
+            elif not self.update_bundle_states([bundle], State.RUNNING):
                 self.pretty_print('WARNING: Bundle running, but state failed to update')
-            else:
-                if self.start_bundle(bundle):
-                    new_running_bundles += 1
-                else:
-                    # Restage: undo state change to RUNNING
-                    self.update_bundle_states([bundle], State.STAGED)
+                continue
+            batch.append(bundle)
+            if len(batch) >= self.start_batch_size:
+                new_running_bundles += self._start_staged_bundles(batch, run_keys, started_run_keys, full_queues)
+                batch = []
+                self.maybe_heartbeat()
         else:
             if self.verbose >= 2: self.pretty_print('Failed to lock a bundle!')
-        return new_running_bundles > 0
+        if batch:
+            new_running_bundles += self._start_staged_bundles(batch, run_keys, started_run_keys, full_queues)
+        if started_run_keys:
+            self.model.add_run_keys(started_run_keys)
+        return new_running_bundles + num_reused > 0
+
+    def _start_staged_bundles(self, bundles, run_keys, started_run_keys, full_queues):
+        '''
+        Start the given bundles (which we moved to RUNNING), restaging those
+        that don't start and noting their queues as full. Return the number of
+        bundles that started.
+        '''
+        num_started = 0
+        for (bundle, started) in zip(bundles, self.start_bundles(bundles)):
+            if started:
+                num_started += 1
+                if bundle.uuid in run_keys:
+                    started_run_keys[bundle.uuid] = run_keys[bundle.uuid]
+            else:
+                # Restage: undo state change to RUNNING
+                self.update_bundle_states([bundle], State.STAGED)
+                self.release_bundle(bundle)
+                full_queues.add(get_queue(bundle))
+        return num_started
 
-    def run_loop(self, num_iterations, sleep_time):
+    def reuse_run_results(self, bundles):
+        '''
+        Move the STAGED runs that are identical to a READY run to READY, with
+        that run's data hash and metadata. Return the number of runs that
+        reused results, the bundles that are left, and the run keys of the runs
+        among them (uuid => key), to record for those that start.
+        '''
+        run_bundles = [bundle for bundle in bundles if isinstance(bundle, RunBundle)]
+        parent_uuids = list(set(dep.parent_uuid for bundle in run_bundles for dep in bundle.dependencies))
+        data_hashes = {}
+        if parent_uuids:
+            for parent in self.model.batch_get_bundle_fields(['uuid', 'data_hash'], uuid=parent_uuids):
+                data_hashes[parent['uuid']] = parent['data_hash']
+        run_keys = {}
+        for bundle in run_bundles:
+            run_key = bundle.get_run_key(data_hashes)
+            if run_key:
+                run_keys[bundle.uuid] = run_key
+        reusable_uuids = self.model.get_reusable_bundles(set(run_keys.values())) if run_keys else {}
+        sources = dict((source.uuid, source) for source in self.model.batch_get_bundles(uuid=reusable_uuids.values())) \
+          if reusable_uuids else {}
+
+        num_reused = 0
+        remaining_bundles = []
+        for bundle in bundles:
+            source = sources.get(reusable_uuids.get(run_keys.get(bundle.uuid)))
+            if source is None or getattr(bundle.metadata, 'no_reuse', None):
+                remaining_bundles.append(bundle)
+                continue
+            if self.worker_id is not None:
+                # Another worker might claim the bundle first.
+                if not self.model.claim_bundle(bundle, self.worker_id, self.lease_time):
+                    continue
+                self.leased_uuids.add(bundle.uuid)
+            metadata = {'reused_from': source.uuid}
+            for spec in source.METADATA_SPECS:
+                if spec.generated and spec.key not in self.UNREUSED_METADATA_KEYS:
+                    value = getattr(source.metadata, spec.key, None)
+                    if value is not None:
+                        metadata[spec.key] = value
+            self.model.update_bundle(bundle, {'state': State.READY, 'data_hash': source.data_hash, 'metadata': metadata})
+            self.release_bundle(bundle)
+            print '-- REUSE BUNDLE: %s (results of %s)' % (bundle, source)
+            num_reused += 1
+        return (num_reused, remaining_bundles, run_keys)
+
+    def run_loop(self, num_iterations, sleep_time, poll_time=60):
         '''
         Repeat forever (if iterations != None) or for a finite number of iterations.
         Moves created bundles to staged and actually executes the staged bundles.
+
+        If the model can wake up the worker (see WorkerWakeup), then the worker
+        waits for a wakeup between iterations instead of sleeping. It still
+        polls every sleep_time seconds while jobs are running (nobody tells it
+        when they finish), and every poll_time seconds otherwise, in case a
+        wakeup got lost.
         '''
         self.pretty_print('Running worker loop (num_iterations = %s, sleep_time = %s)' % (num_iterations, sleep_time))
+        if self.worker_id is not None:
+            self.pretty_print('Running as worker %s (lease_time = %s)' % (self.worker_id, self.lease_time))
+        wakeup = self.model.worker_wakeup
+        if wakeup is not None:
+            wakeup.listen()
+            self.pretty_print('Listening for wakeups on port %s (poll_time = %s)' % (wakeup.port, poll_time))
+        if self.worker_id is None:
+            # Nobody else finalizes bundles (see heartbeat otherwise).
+            self.restart_finalizing_bundles()
         iteration = 0
         while not num_iterations or iteration < num_iterations:
-            # Check to see if any bundles should be killed
-            bool_killed = self.check_killed_bundles()
-            # Try to stage bundles
-            self.update_created_bundles()
-            # Try to run bundles with Ready parents
-            bool_run = self.update_staged_bundles()
-            # Check to see if any bundles are done running
-            bool_done = self.check_finished_bundles()
+            # The worker decides what to write based on what it reads, so it
+            # can't use possibly stale read replicas.
+            with self.model.read_from_primary():
+                self.maybe_heartbeat()
+                # Check to see if any bundles should be killed
+                bool_killed = self.check_killed_bundles()
+                # Try to stage bundles
+                self.update_created_bundles()
+                # Try to run bundles with Ready parents
+                bool_run = self.update_staged_bundles()
+                # Check to see if any bundles are done running
+                bool_done = self.check_finished_bundles()
+                # Check to see if any bundles are done finalizing
+                bool_finalized = self.check_finalized_bundles()
 
             # Sleep only if nothing happened.
-            if not (bool_killed or bool_run or bool_done):
-                time.sleep(sleep_time)
+            if not (bool_killed or bool_run or bool_done or bool_finalized):
+                timeout = sleep_time if wakeup is None or self.num_running_jobs or self.finalizing else poll_time
+                if self.worker_id is not None:
+                    timeout = min(timeout, self.lease_time / 3.0)  # Wake up in time for the next heartbeat.
+                if wakeup is None:
+                    time.sleep(timeout)
+                else:
+                    reasons = wakeup.wait(timeout)
+                    if self.verbose >= 2 and reasons: self.pretty_print('Woken up: %s' % (', '.join(sorted(set(reasons))),))
             else:
                 # Advance counter only if something interesting happened
                 iteration += 1
@@ -12,13 +12,19 @@ from codalab.model.orm_object import ORMObject
 
 
 # We will keep worksheet items sorted in the database by maintining a sort_key
-# for each item that was batch-added to a worksheet by a call to update_worksheet.
-# These sort keys will be strictly upper-bounded by the maximum id at the time
-# at which the edit was BEGUN. This ensures that any worksheet items appended to
-# the sheet between the time the edit was begun and committed will have ids
-# greater than the maximum sort key.
+# for each item that was batch-added to a worksheet by a call to update_worksheet
+# or placed by a call to patch_worksheet. These sort keys will be strictly
+# upper-bounded by the maximum id at the time at which the edit was BEGUN. This
+# ensures that any worksheet items appended to the sheet between the time the
+# edit was begun and committed will have ids greater than the maximum sort key.
+# Sort keys are floats, so that an item can be placed in between two others
+# without changing theirs; ties are broken by id.
+#
+# Items appended to the end get their id as their sort key (older ones may have
+# none, which means the same thing), so that the items of a worksheet can be
+# read in order from the (worksheet_uuid, sort_key, id) index.
 def item_sort_key(item):
-    return item['id'] if item['sort_key'] is None else item['sort_key']
+    return (item['id'] if item['sort_key'] is None else item['sort_key'], item['id'])
 
 class Worksheet(ORMObject):
     COLUMNS = ('uuid', 'name', 'owner_id')
@@ -46,9 +52,11 @@ class Worksheet(ORMObject):
         super(Worksheet, self).update_in_memory(row)
         if items is not None:
             self.items = [(item['bundle_uuid'], item['subworksheet_uuid'], item['value'], item['type']) for item in items]
+            self.item_ids = [item['id'] for item in items]
             self.last_item_id = max(item['id'] for item in items) if items else -1
         else:
             self.items = None
+            self.item_ids = None
             self.last_item_id = None
 
     def get_info_dict(self):
@@ -57,5 +65,6 @@ class Worksheet(ORMObject):
           'owner_id': self.owner_id,
           'name': self.name,
           'items': self.items,
+          'item_ids': self.item_ids,
           'last_item_id': self.last_item_id,
         }
@@ -14,6 +14,7 @@ Important: each call to open_temp_file, open_target, open_target_zip should
 have a matching call to finalize_file.
 '''
 import tempfile
+import time
 import traceback
 
 from codalab.common import (
@@ -40,7 +41,18 @@ class BundleRPCServer(FileServer):
                 if self.verbose >= 1:
                     print "bundle_rpc_server: %s %s" % (command, args if command != 'login' else '...')
                 try:
-                    return func(*args, **kwargs)
+                    # Each request looks up the user's groups at most once, and
+                    # users read their own writes even if replicas lag behind.
+                    model = self.client.model
+                    with model.cache_user_groups(), model.read_your_writes(self.client._current_user_id()), \
+                         model.query_log.command(command) as stats:
+                        start_time = time.time()
+                        result = func(*args, **kwargs)
+                    if self.verbose >= 1:
+                        print "bundle_rpc_server: %s took %.3fs: %d queries, %.3fs in database, %d cached statements (%.3fs compile time saved)" % \
+                            (command, time.time() - start_time, stats['num_queries'], stats['db_time'],
+                             stats['num_cached'], stats['compile_time_saved'])
+                    return result
                 except Exception, e:
                     if not (isinstance(e, UsageError) or isinstance(e, PermissionError)):
                         # This is really bad and shouldn't happen.
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+# Micro-benchmarks for the bundle model, run against a scratch database.
+# Each benchmark prints the time taken by the operations it measures.
+# Usage: benchmark-model.py <benchmark> [options]
+
+import sys, os, time
+import argparse
+import multiprocessing
+import random
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy.exc import OperationalError
+
+from codalab.bundles.run_bundle import RunBundle
+from codalab.client.local_bundle_client import LocalBundleClient
+from codalab.lib import spec_util
+from codalab.common import State
+from codalab.lib.bundle_store import BundleStore
+from codalab.machines.local_machine import LocalMachine
+from codalab.model.sqlite_model import SQLiteModel
+from codalab.model.worker_wakeup import WorkerWakeup
+from codalab.objects.work_manager import Worker
+from codalab.model.tables import GROUP_OBJECT_PERMISSION_READ
+from codalab.server.auth import MockAuthHandler, User
+
+def make_client(home, users):
+    model = SQLiteModel(home)
+    model.root_user_id = '0'
+    auth_handler = MockAuthHandler([User('root', '0')] + users)
+    client = LocalBundleClient('local', BundleStore(home, []), model, auth_handler, verbose=0)
+    return client
+
+def login(client, username):
+    token_info = client.login('credentials', username, '')
+    client.auth_handler.validate_token(token_info['access_token'])
+
+def make_run_bundles(owner_id, num_bundles):
+    metadata = {}
+    for spec in RunBundle.get_user_defined_metadata():
+        metadata[spec.key] = [] if spec.type == list else spec.get_constructor()()
+    return [
+        RunBundle.construct(targets=[], command='echo %d' % i, metadata=dict(metadata, name='run-%d' % i), owner_id=owner_id)
+        for i in range(num_bundles)
+    ]
+
+def timed(label, func, repeat):
+    times = []
+    for _ in range(repeat):
+        start_time = time.time()
+        func()
+        times.append(time.time() - start_time)
+    print '%s: best %.4fs, mean %.4fs over %d runs' % (label, min(times), sum(times) / len(times), repeat)
+
+def benchmark_permissions(home, args):
+    '''
+    get_bundle_infos on bundles owned by someone else, readable through group membership.
+    '''
+    client = make_client(home, [User('owner', '1'), User('reader', '2')])
+    model = client.model
+    groups = []
+    for i in range(args.num_groups):
+        group = model.create_group({'uuid': spec_util.generate_uuid(), 'name': 'group%d' % i, 'owner_id': '1', 'user_defined': True})
+        model.add_user_in_group('2', group['uuid'], False)
+        groups.append(group)
+    bundles = make_run_bundles('1', args.num_bundles)
+    group_permissions = [{'group_uuid': group['uuid'], 'permission': GROUP_OBJECT_PERMISSION_READ} for group in groups]
+    model.batch_save_bundles(bundles, group_permissions=group_permissions)
+
+    login(client, 'reader')
+    uuids = [bundle.uuid for bundle in bundles]
+    timed('get_bundle_infos(%d bundles)' % len(uuids), lambda: client.get_bundle_infos(uuids), args.repeat)
+    timed('get_bundle_infos(%d bundles, get_permissions=True)' % len(uuids),
+          lambda: client.get_bundle_infos(uuids, get_permissions=True), args.repeat)
+
+def _sqlite_concurrency_process(home, options, role, uuids, duration, results):
+    model = SQLiteModel(home, options)
+    model.root_user_id = '0'
+    num_ops, num_errors, latencies = 0, 0, []
+    end_time = time.time() + duration
+    while time.time() < end_time:
+        start_time = time.time()
+        try:
+            if role == 'writer':
+                # Like the worker: update the state and metadata of a running bundle.
+                bundle = model.get_bundle(random.choice(uuids))
+                model.update_bundle(bundle, {'state': State.RUNNING, 'metadata': {'time': time.time() - start_time}})
+            else:
+                # Like the CLI or web frontend: load a page of bundles.
+                model.batch_get_bundles(uuid=random.sample(uuids, 50))
+            num_ops += 1
+            latencies.append(time.time() - start_time)
+        except OperationalError:
+            num_errors += 1
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95)] if latencies else 0
+    results.put((role, num_ops, num_errors, p95))
+
+def benchmark_sqlite_concurrency(home, args):
+    '''
+    One writer (the worker) and several concurrent readers sharing bundle.db.
+    '''
+    options = {'journal_mode': args.journal_mode, 'busy_timeout': args.busy_timeout, 'lock_retries': args.lock_retries}
+    model = SQLiteModel(home, options)
+    bundles = make_run_bundles('0', args.num_bundles)
+    model.batch_save_bundles(bundles)
+    uuids = [bundle.uuid for bundle in bundles]
+
+    results = multiprocessing.Queue()
+    roles = ['writer'] + ['reader'] * args.num_readers
+    processes = [
+        multiprocessing.Process(target=_sqlite_concurrency_process,
+                                args=(home, options, role, uuids, args.duration, results))
+        for role in roles
+    ]
+    for process in processes:
+        process.start()
+    totals = {}
+    for _ in processes:
+        role, num_ops, num_errors, p95 = results.get()
+        total = totals.setdefault(role, [0, 0, 0])
+        total[0] += num_ops
+        total[1] += num_errors
+        total[2] = max(total[2], p95)
+    for process in processes:
+        process.join()
+    print 'journal_mode=%s, %d readers, %.0fs' % (args.journal_mode, args.num_readers, args.duration)
+    for role in ('writer', 'reader'):
+        num_ops, num_errors, p95 = totals[role]
+        print '%s: %.1f ops/s, %d lock errors, p95 latency %.4fs' % (role, num_ops / args.duration, num_errors, p95)
+
+def benchmark_in_clause(home, args):
+    '''
+    batch_get_bundles and get_children_uuids on a large set of uuids (most of
+    which don't exist), for several IN clause chunk sizes.
+    '''
+    model = SQLiteModel(home)
+    bundles = make_run_bundles('0', args.num_bundles)
+    model.batch_save_bundles(bundles)
+    uuids = [bundle.uuid for bundle in bundles]
+    uuids += [spec_util.generate_uuid() for _ in range(args.num_uuids - len(uuids))]
+    for chunk_size in (100, 250, 500, 900):
+        model.MAX_IN_CLAUSE_SIZE = chunk_size
+        timed('batch_get_bundles(%d uuids), chunks of %d' % (len(uuids), chunk_size),
+              lambda: model.batch_get_bundles(uuid=uuids), args.repeat)
+        timed('get_children_uuids(%d uuids), chunks of %d' % (len(uuids), chunk_size),
+              lambda: model.get_children_uuids(uuids), args.repeat)
+
+def benchmark_metadata_storage(home, args):
+    '''
+    batch_get_bundles and update_bundle with metadata stored as bundle_metadata
+    rows and as documents.
+    '''
+    for storage in ('table', 'document'):
+        storage_home = os.path.join(home, storage)
+        os.mkdir(storage_home)
+        model = SQLiteModel(storage_home)
+        model.metadata_storage = storage
+        bundles = make_run_bundles('0', args.num_bundles)
+        model.batch_save_bundles(bundles)
+        uuids = [bundle.uuid for bundle in bundles]
+        timed('%s: batch_get_bundles(%d bundles)' % (storage, len(uuids)),
+              lambda: model.batch_get_bundles(uuid=uuids), args.repeat)
+        timed('%s: update_bundle(metadata)' % (storage,),
+              lambda: model.update_bundle(random.choice(bundles), {'metadata': {'time': time.time(), 'data_size': 1}}), args.repeat)
+
+def benchmark_statement_cache(home, args):
+    '''
+    The queries of one worker loop iteration and of loading a page of bundles,
+    with and without the statement cache.
+    '''
+    client = make_client(home, [User('reader', '2')])
+    model = client.model
+    bundles = make_run_bundles('0', args.num_bundles)
+    model.batch_save_bundles(bundles)
+    uuids = [bundle.uuid for bundle in bundles]
+    login(client, 'reader')
+    def worker_loop():
+        for state in (State.CREATED, State.STAGED, State.RUNNING):
+            model.batch_get_bundle_fields(['uuid', 'parent_uuids'], state=state)
+    def get_page():
+        client.get_bundle_infos(random.sample(uuids, 20), get_permissions=True)
+    statement_cache = model.statement_cache
+    for (label, cache) in (('uncached', None), ('cached', statement_cache)):
+        model.statement_cache = cache
+        timed('%s: worker loop queries x100' % (label,), lambda: [worker_loop() for _ in range(100)], args.repeat)
+        timed('%s: get_bundle_infos(20 bundles) x100' % (label,), lambda: [get_page() for _ in range(100)], args.repeat)
+    print 'statement cache: %d hits, %d misses, %.4fs compiling, %.4fs of compilation saved' % (
+        statement_cache.hits, statement_cache.misses, statement_cache.compile_time, statement_cache.compile_time_saved)
+
+def _worker_process(home, wakeup_port, sleep_time):
+    model = SQLiteModel(home)
+    model.root_user_id = '0'
+    if wakeup_port is not None:
+        model.worker_wakeup = WorkerWakeup(wakeup_port)
+    worker = Worker(BundleStore(home, []), model, LocalMachine(), MockAuthHandler([User('root', '0')]))
+    sys.stdout = open(os.devnull, 'w')
+    sys.stderr = open(os.devnull, 'w')
+    worker.run_loop(None, sleep_time)
+
+def benchmark_worker_wakeup(home, args):
+    '''
+    Latency from saving a run bundle (as in cl run) until the worker has
+    started it, with a polling worker and with a worker that is woken up.
+    '''
+    for mode in ('polling', 'wakeup'):
+        mode_home = os.path.join(home, mode)
+        os.mkdir(mode_home)
+        model = SQLiteModel(mode_home)
+        model.root_user_id = '0'
+        wakeup_port = None
+        if mode == 'wakeup':
+            # Find a free port for the worker to listen on.
+            wakeup = WorkerWakeup(0)
+            wakeup.listen()
+            wakeup_port = wakeup.port
+            wakeup.close()
+            model.worker_wakeup = WorkerWakeup(wakeup_port)
+        process = multiprocessing.Process(target=_worker_process, args=(mode_home, wakeup_port, args.sleep_time))
+        process.start()
+        time.sleep(1)  # Let the worker start listening.
+        latencies = []
+        try:
+            for bundle in make_run_bundles('0', args.repeat):
+                # Wait until the worker is idle, as it would be between runs.
+                time.sleep(random.uniform(0, args.sleep_time))
+                start_time = time.time()
+                model.save_bundle(bundle)
+                while model.batch_get_bundle_fields(['state'], uuid=bundle.uuid)[0]['state'] not in (State.RUNNING, State.READY, State.FAILED):
+                    time.sleep(0.005)
+                latencies.append(time.time() - start_time)
+                while model.batch_get_bundle_fields(['state'], uuid=bundle.uuid)[0]['state'] not in (State.READY, State.FAILED):
+                    time.sleep(0.01)
+        finally:
+            process.terminate()
+            process.join()
+        latencies.sort()
+        print '%s: run to start latency: median %.4fs, max %.4fs over %d runs' % (
+            mode, latencies[len(latencies) / 2], latencies[-1], len(latencies))
+
+BENCHMARKS = {
+    'in-clause': benchmark_in_clause,
+    'metadata-storage': benchmark_metadata_storage,
+    'permissions': benchmark_permissions,
+    'sqlite-concurrency': benchmark_sqlite_concurrency,
+    'statement-cache': benchmark_statement_cache,
+    'worker-wakeup': benchmark_worker_wakeup,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark bundle model operations.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS), help='benchmark to run')
+    parser.add_argument('--num-bundles', type=int, default=1000, help='number of bundles to create')
+    parser.add_argument('--num-uuids', type=int, default=100000, help='number of uuids to look up')
+    parser.add_argument('--num-groups', type=int, default=5, help='number of groups to create')
+    parser.add_argument('--repeat', type=int, default=5, help='number of times to repeat each measurement')
+    parser.add_argument('--num-readers', type=int, default=4, help='number of concurrent reader processes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run concurrent benchmarks for')
+    parser.add_argument('--journal-mode', default='wal', help='SQLite journal mode (e.g., wal or delete)')
+    parser.add_argument('--busy-timeout', type=float, default=30, help='seconds SQLite waits on a lock')
+    parser.add_argument('--lock-retries', type=int, default=5, help='times to retry a write on a locked SQLite database')
+    parser.add_argument('--sleep-time', type=float, default=1, help='seconds a polling worker sleeps between polls')
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='codalab-benchmark-')
+    try:
+        BENCHMARKS[args.benchmark](home, args)
+    finally:
+        shutil.rmtree(home)
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+# Deletes the entries of the change log that are older than the given number of
+# days. Clients that haven't asked for changes since then are told to reload
+# everything (see BundleModel.get_changes). Run this periodically, e.g. daily
+# from cron.
+# Usage: compact-change-log.py [--max-age-days <days>]
+
+import sys, os
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from codalab.lib.codalab_manager import CodaLabManager
+
+parser = argparse.ArgumentParser(description='Delete old change log entries.')
+parser.add_argument('--max-age-days', type=float, default=7, help='keep entries from the last this many days')
+args = parser.parse_args()
+
+model = CodaLabManager().model()
+num_deleted = model.compact_changes(args.max_age_days * 24 * 60 * 60)
+print 'Deleted %d change log entries.' % (num_deleted,)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+# Moves the metadata of all bundles in the server's database to the given layout:
+#   table: one bundle_metadata row per metadata value.
+#   document: a JSON document per bundle, plus bundle_metadata rows for the keys
+#             used in search (BundleModel.SEARCH_METADATA_KEYS).
+# Bundles in either layout can be read at any time, so this can be run after
+# changing "metadata_storage" in the server config. Stop the server and the
+# worker first, since bundles that are updated during a batch may be reverted.
+# Usage: convert-metadata-storage.py <table|document> [--batch-size <n>]
+
+import sys, os
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from codalab.lib.codalab_manager import CodaLabManager
+
+parser = argparse.ArgumentParser(description='Convert the storage layout of bundle metadata.')
+parser.add_argument('storage', choices=['table', 'document'], help='layout to convert to')
+parser.add_argument('--batch-size', type=int, default=1000, help='number of bundles to convert per transaction')
+args = parser.parse_args()
+
+model = CodaLabManager().model()
+num_converted = model.convert_metadata_storage(args.storage, args.batch_size)
+print 'Converted %d bundles to %s metadata storage.' % (num_converted, args.storage)
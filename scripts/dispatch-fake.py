@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# Fake dispatcher that runs each job as a background process on this machine,
+# to test RemoteMachine (and the dispatcher protocol) without a cluster.
+# See dispatch_util.py for the commands; each command outputs JSON.
+#
+# The state of the jobs is kept in files in $CODALAB_DISPATCH_FAKE_DIR (by
+# default, codalab-dispatch-fake in the temp directory), so that the jobs
+# outlive the dispatcher: <handle>.json has the job and <handle>.exitcode the
+# exit code, once the job has finished.
+
+import sys, os, json
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+import uuid
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import dispatch_util
+
+STATE_DIR = os.environ.get('CODALAB_DISPATCH_FAKE_DIR') or os.path.join(tempfile.gettempdir(), 'codalab-dispatch-fake')
+
+processes = {}  # handle => process started by this dispatcher (so that it can be reaped)
+
+def get_path(handle, extension):
+    return os.path.join(STATE_DIR, '%s.%s' % (handle, extension))
+
+def start_jobs(jobs):
+    if not os.path.isdir(STATE_DIR):
+        os.makedirs(STATE_DIR)
+    handles = []
+    for job in jobs:
+        handle = 'fake-' + uuid.uuid4().hex[:12]
+        # Record the exit code once the script is done; in its own process group
+        # so that kill gets everything, and without our stdout, which is how we
+        # answer (the caller would wait for the job to close it).
+        with open(os.devnull, 'r+') as devnull:
+            process = subprocess.Popen(['bash', '-c', 'bash "$0"; echo $? > "$1"', job['script'], get_path(handle, 'exitcode')],
+                                       stdin=devnull, stdout=devnull, close_fds=True, preexec_fn=os.setsid)
+        processes[handle] = process
+        with open(get_path(handle, 'json'), 'w') as f:
+            json.dump(dict(job, pid=process.pid, start_time=time.time()), f)
+        handles.append(handle)
+    return handles
+
+def info(handles):
+    for process in processes.values():
+        process.poll()
+    if not handles and os.path.isdir(STATE_DIR):
+        handles = [name[:-len('.json')] for name in os.listdir(STATE_DIR) if name.endswith('.json')]
+    infos = []
+    for handle in handles:
+        try:
+            with open(get_path(handle, 'json')) as f:
+                job = json.load(f)
+        except IOError:
+            continue  # Not one of ours, or cleaned up
+        info = {'handle': handle, 'hostname': job.get('request_node') or socket.gethostname()}
+        exitcode_path = get_path(handle, 'exitcode')
+        if os.path.exists(exitcode_path):
+            with open(exitcode_path) as f:
+                info['exitcode'] = int(f.read().strip() or -1)
+            info['time'] = os.path.getmtime(exitcode_path) - job['start_time']
+        else:
+            info['state'] = 'running'
+            info['time'] = time.time() - job['start_time']
+        infos.append(info)
+    return infos
+
+def kill(handle):
+    with open(get_path(handle, 'json')) as f:
+        job = json.load(f)
+    try:
+        os.killpg(job['pid'], signal.SIGKILL)
+    except OSError:
+        pass  # Already done
+    exitcode_path = get_path(handle, 'exitcode')
+    if not os.path.exists(exitcode_path):
+        with open(exitcode_path, 'w') as f:
+            print >>f, 128 + signal.SIGKILL
+    return ''
+
+def cleanup(handle):
+    for extension in ('json', 'exitcode'):
+        if os.path.exists(get_path(handle, extension)):
+            os.remove(get_path(handle, extension))
+    processes.pop(handle, None)
+    return ''
+
+if __name__ == '__main__':
+    dispatch_util.main(start_jobs, info, kill, cleanup)
@@ -2,11 +2,13 @@
 
 # Wrapper for fig's simple workqueue system.
 # https://github.com/percyliang/fig/blob/master/bin/q
-# Each command outputs JSON.
+# See dispatch_util.py for the commands; each command outputs JSON.
 
-import sys, os, json, re
+import sys, os, re
 import subprocess
-import argparse
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import dispatch_util
 
 def get_output(command):
     print >>sys.stderr, 'dispatch-q.py: ' + command,
@@ -14,47 +16,27 @@ def get_output(command):
     print >>sys.stderr, ('=> %d lines' % len(output.split('\n')))
     return output
 
-if len(sys.argv) <= 1:
-    print 'Usage:'
-    print '  start [--request-time <seconds>] [--request-memory <bytes>] <script>'
-    print '    => {handle: ...}'
-    print '  info <handle>*'
-    print '    => {..., infos: [{handle: ..., hostname: ..., memory: ...}, ...]}'
-    print '  kill <handle>'
-    print '    => {handle: ...}'
-    print '  cleanup <handle>'
-    print '    => {handle: ...}'
-    sys.exit(1)
-
-mode = sys.argv[1]
-if mode == 'start':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--username', type=str, help='user who is running this job')
-    parser.add_argument('--request_time', type=float, help='request this much computation time (in seconds)')
-    parser.add_argument('--request_memory', type=float, help='request this much memory (in bytes)')
-    parser.add_argument('--request_cpus', type=int, help='request this many CPUs')
-    parser.add_argument('--request_gpus', type=int, help='request this many GPUs')
-    parser.add_argument('--request_queue', type=int, help='submit job to this queue')
-    parser.add_argument('script', type=str, help='script to run')
-    args = parser.parse_args(sys.argv[2:])
-
-    resource_args = ''
-    if args.request_time:
-        resource_args += ' -time %ds' % int(args.request_time)
-    if args.request_memory:
-        resource_args += ' -mem %dm' % int(args.request_memory / (1024*1024)) # convert to MB
-
-    stdout = get_output('q%s -shareWorkingPath -add bash %s' % (resource_args, args.script))
-    m = re.match(r'Job (J-.+) added successfully', stdout)
-    handle = m.group(1) if m else None
-    response = {'raw': stdout, 'handle': handle}
-elif mode == 'info':
-    handles = sys.argv[2:]  # If empty, then get info about everything
+def start_jobs(jobs):
+    # q has no array jobs, so add the jobs one by one.
+    # request_node is not supported by q.
+    handles = []
+    for job in jobs:
+        resource_args = ''
+        if job.get('request_time'):
+            resource_args += ' -time %ds' % int(job['request_time'])
+        if job.get('request_memory'):
+            resource_args += ' -mem %dm' % int(job['request_memory'] / (1024*1024)) # convert to MB
+
+        stdout = get_output('q%s -shareWorkingPath -add bash %s' % (resource_args, job['script']))
+        m = re.match(r'Job (J-.+) added successfully', stdout)
+        handles.append(m.group(1) if m else None)
+    return handles
+
+def info(handles):
     list_args = ''
     if len(handles) > 0:
         list_args += ' ' + ' '.join(handles)
     stdout = get_output('q -list%s -tabs' % list_args)
-    response = {'raw': stdout}
     # Example output:
     # handle    worker              status  exitcode   time    mem    disk    outName     command
     # J-ifnrj9  mazurka-37 mazurka  done    0          1m40s   1m     -1m                 sleep 100
@@ -83,21 +65,13 @@ elif mode == 'info':
             info['memory'] = int(memory) * 1024 * 1024  # Convert to bytes
 
         infos.append(info)
-    response['infos'] = infos
-elif mode == 'kill':
-    handle = sys.argv[2]
-    response = {
-        'handle': handle,
-        'raw': get_output('q -kill %s' % handle)
-    }
-elif mode == 'cleanup':
-    handle = sys.argv[2]
-    response = {
-        'handle': handle,
-        'raw': get_output('q -del %s' % handle)
-    }
-else:
-    print 'Invalid mode: %s' % mode
-    sys.exit(1)
-
-print json.dumps(response)
+    return infos
+
+def kill(handle):
+    return get_output('q -kill %s' % handle)
+
+def cleanup(handle):
+    return get_output('q -del %s' % handle)
+
+if __name__ == '__main__':
+    dispatch_util.main(start_jobs, info, kill, cleanup)
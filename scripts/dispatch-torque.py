@@ -2,68 +2,77 @@
 
 # Wrapper for the Torque Resource Manager (PBS).
 # http://docs.adaptivecomputing.com/torque/4-1-4/Content/topics/commands/qsub.htm
-# Each command outputs JSON.
+# See dispatch_util.py for the commands; each command outputs JSON.
 
-import sys, os, json, re
+import sys, os, re
 import subprocess
-import argparse
 
-def get_output(command):
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import dispatch_util
+
+def get_output(command, input=None, ignored_error=None):
+    '''
+    Run command and return its stdout. Fail if it exits with an error, unless
+    every line it printed to stderr contains ignored_error.
+    '''
     print >>sys.stderr, 'dispatch-torque.py: ' + command,
-    output = subprocess.check_output(command, shell=True)
+    proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = proc.communicate(input)
+    sys.stderr.write(errors)
+    if proc.returncode != 0:
+        error_lines = [line for line in errors.split('\n') if line.strip()]
+        if not ignored_error or not error_lines or not all(ignored_error in line for line in error_lines):
+            raise subprocess.CalledProcessError(proc.returncode, command)
     print >>sys.stderr, ('=> %d lines' % len(output.split('\n')))
-    return output
-
-if len(sys.argv) <= 1:
-    print 'Usage:'
-    print '  start [--request-time <seconds>] [--request-memory <bytes>] <script>'
-    print '    => {handle: ...}'
-    print '  info <handle>*'
-    print '    => {..., infos: [{handle: ..., hostname: ..., memory: ...}, ...]}'
-    print '  kill <handle>'
-    print '    => {handle: ...}'
-    print '  cleanup <handle>'
-    print '    => {handle: ...}'
-    sys.exit(1)
-
-result = {}
-handle = None
-
-mode = sys.argv[1]
-if mode == 'start':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--username', type=str, help='user who is running this job')
-    parser.add_argument('--request_time', type=float, help='request this much computation time (in seconds)')
-    parser.add_argument('--request_memory', type=float, help='request this much memory (in bytes)')
-    parser.add_argument('--request_cpus', type=int, help='request this many CPUs')
-    parser.add_argument('--request_gpus', type=int, help='request this many GPUs')
-    parser.add_argument('--request_queue', type=str, help='submit job to this queue')
-    parser.add_argument('script', type=str, help='script to run')
-
-    args = parser.parse_args(sys.argv[2:])
+    return output, errors
 
+def get_resource_args(job):
     resource_args = ''
-    if args.username:
-        resource_args += ' -N codalab-%s' % args.username
-    if args.request_cpus:
-        resource_args += ' -l nodes=1:ppn=%d' % args.request_cpus
-    if args.request_memory:
-        resource_args += ' -l mem=%d' % int(args.request_memory)
-    if args.request_queue:
-        resource_args += ' -q %s' % args.request_queue
+    if job.get('username'):
+        resource_args += ' -N codalab-%s' % job['username']
+    if job.get('request_node'):
+        resource_args += ' -l nodes=%s:ppn=%d' % (job['request_node'], job.get('request_cpus') or 1)
+    elif job.get('request_cpus'):
+        resource_args += ' -l nodes=1:ppn=%d' % job['request_cpus']
+    if job.get('request_memory'):
+        resource_args += ' -l mem=%d' % int(job['request_memory'])
+    if job.get('request_queue'):
+        resource_args += ' -q %s' % job['request_queue']
+    return resource_args
 
-    stdout = get_output('qsub -o /dev/null -e /dev/null%s %s' % (resource_args, args.script))
-    handle = stdout.strip()
-    response = {'raw': stdout, 'handle': handle}
-elif mode == 'info':
-    handles = sys.argv[2:]  # If empty, then get info about everything
+def start_jobs(jobs):
+    # Jobs with the same resources are submitted together as an array job.
+    scripts_by_args = {}
+    for (i, job) in enumerate(jobs):
+        scripts_by_args.setdefault(get_resource_args(job), []).append((i, job['script']))
+    handles = [None] * len(jobs)
+    for (resource_args, scripts) in scripts_by_args.items():
+        if len(scripts) == 1:
+            stdout, _ = get_output('qsub -o /dev/null -e /dev/null%s %s' % (resource_args, scripts[0][1]))
+            handles[scripts[0][0]] = stdout.strip()
+            continue
+        # The array job reads its script from stdin; member k runs the k-th script.
+        array_script = 'case $PBS_ARRAYID in\n'
+        for (k, (i, script)) in enumerate(scripts):
+            array_script += '%d) bash %s;;\n' % (k, script)
+        array_script += 'esac\n'
+        stdout, _ = get_output('qsub -o /dev/null -e /dev/null -t 0-%d%s' % (len(scripts) - 1, resource_args), array_script)
+        handle = stdout.strip()  # e.g., 123[].server
+        for (k, (i, script)) in enumerate(scripts):
+            handles[i] = handle.replace('[]', '[%d]' % k)
+    return handles
+
+def info(handles):
     list_args = ''
     if len(handles) > 0:
         list_args += ' ' + ' '.join(handles)
-    stdout = get_output('qstat -f%s' % list_args)
-    response = {'raw': ''}
+    # -t lists the members of array jobs. qstat fails if it doesn't know one of
+    # the jobs (e.g., a completed job that was purged), but still prints the
+    # others.
+    stdout, errors = get_output('qstat -f -t%s' % list_args, ignored_error='Unknown Job Id')
 
     infos = []
+    info = None
     for line in stdout.split("\n"):
         # Job Id: ...
         m = re.match('^Job Id: (.+)', line)
@@ -74,8 +83,8 @@ elif mode == 'info':
 
         if line == '':
             # Ensure exitcode if job is completed
-            if completed and 'exitcode' not in result:
-                result['exitcode'] = -1
+            if info and completed and 'exitcode' not in info:
+                info['exitcode'] = -1
 
             # Flush
             if info: infos.append(info)
@@ -83,7 +92,7 @@ elif mode == 'info':
             continue
 
         m = re.match(r'\s*([^ ]+) = (.+)', line)
-        if not m:
+        if not m or not info:
             continue
         key = m.group(1)
         value = m.group(2)
@@ -95,7 +104,6 @@ elif mode == 'info':
         elif key == 'job_state':
             if value == 'C':
                 completed = True
-            result['state'] = {'R': 'running'}.get(value, 'queued')
         elif key == 'resources_used.mem':
             m = re.match(r'(\d+)kb', value)
             if m:
@@ -104,23 +112,21 @@ elif mode == 'info':
             m = re.match('(\d+):(\d+):(\d+)', value)
             if m:
                 info['time'] = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + int(m.group(3))
-    response['infos'] = infos
 
-elif mode == 'kill':
-    handle = sys.argv[2]
-    response = {
-        'handle': handle,
-        'raw': get_output('qdel %s' % handle)
-    }
-elif mode == 'cleanup':
+    # The jobs that qstat doesn't know anymore have finished long ago.
+    known_handles = set(info['handle'] for info in infos)
+    unknown_handles = set(errors.split())  # e.g., qstat: Unknown Job Id Error 123.server
+    for handle in handles:
+        if handle not in known_handles and handle in unknown_handles:
+            infos.append({'handle': handle, 'exitcode': -1})
+    return infos
+
+def kill(handle):
+    return get_output('qdel %s' % handle)[0]
+
+def cleanup(handle):
     # Do nothing
-    handle = sys.argv[2]
-    response = {
-        'handle': handle,
-        'raw': '',
-    }
-else:
-    print 'Invalid mode: %s' % mode
-    sys.exit(1)
+    return ''
 
-print json.dumps(response)
+if __name__ == '__main__':
+    dispatch_util.main(start_jobs, info, kill, cleanup)
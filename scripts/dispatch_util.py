@@ -0,0 +1,92 @@
+# Command-line and co-process interface shared by the dispatch-*.py scripts,
+# which RemoteMachine uses to run jobs on a cluster.
+#
+# Each script provides four functions:
+#   start_jobs(jobs) => list of handles, where each job is a dict with the
+#     script to run and optionally username, request_time (seconds),
+#     request_memory (bytes), request_cpus, request_gpus, request_queue and
+#     request_node
+#   info(handles) => list of infos ({handle, hostname, state, exitcode, time,
+#     memory}) of the given jobs (all jobs if handles is empty)
+#   kill(handle) => raw output
+#   cleanup(handle) => raw output
+# and calls main, which runs one command given on the command line and prints
+# the JSON response, or, with 'serve', keeps reading requests (one JSON object
+# per line) from stdin and writing one JSON response per line to stdout:
+#   {"command": "start", "jobs": [...]} => {"handles": [...]}
+#   {"command": "info", "handles": [...]} => {"infos": [...]}
+#   {"command": "kill", "handle": ...} => {"handle": ...}
+#   {"command": "cleanup", "handle": ...} => {"handle": ...}
+# A request that fails gets {"error": ...}.
+
+import sys, json
+import argparse
+import traceback
+
+USAGE = '''Usage:
+  start [--request_time <seconds>] [--request_memory <bytes>] ... <script>
+    => {handle: ...}
+  info <handle>*
+    => {..., infos: [{handle: ..., hostname: ..., memory: ...}, ...]}
+  kill <handle>
+    => {handle: ...}
+  cleanup <handle>
+    => {handle: ...}
+  serve
+    => one JSON response per line for each JSON request read from stdin'''
+
+def parse_start_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--username', type=str, help='user who is running this job')
+    parser.add_argument('--request_time', type=float, help='request this much computation time (in seconds)')
+    parser.add_argument('--request_memory', type=float, help='request this much memory (in bytes)')
+    parser.add_argument('--request_cpus', type=int, help='request this many CPUs')
+    parser.add_argument('--request_gpus', type=int, help='request this many GPUs')
+    parser.add_argument('--request_queue', type=str, help='submit job to this queue')
+    parser.add_argument('--request_node', type=str, help='run job on this node')
+    parser.add_argument('script', type=str, help='script to run')
+    args = parser.parse_args(argv)
+    return dict((key, value) for (key, value) in vars(args).items() if value is not None)
+
+def handle_request(request, functions):
+    command = request.get('command')
+    if command == 'start':
+        return {'handles': functions['start_jobs'](request['jobs'])}
+    if command == 'info':
+        return {'infos': functions['info'](request.get('handles', []))}
+    if command in ('kill', 'cleanup'):
+        return {'handle': request['handle'], 'raw': functions[command](request['handle'])}
+    raise ValueError('Invalid command: %s' % (command,))
+
+def serve(functions):
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            response = handle_request(json.loads(line), functions)
+        except Exception, e:
+            traceback.print_exc()
+            response = {'error': '%s: %s' % (e.__class__.__name__, e)}
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+def main(start_jobs, info, kill, cleanup):
+    functions = {'start_jobs': start_jobs, 'info': info, 'kill': kill, 'cleanup': cleanup}
+    if len(sys.argv) <= 1:
+        print USAGE
+        sys.exit(1)
+    mode = sys.argv[1]
+    if mode == 'serve':
+        serve(functions)
+        return
+    if mode == 'start':
+        response = {'handle': start_jobs([parse_start_args(sys.argv[2:])])[0]}
+    elif mode == 'info':
+        response = {'infos': info(sys.argv[2:])}  # If no handles, then get info about everything
+    elif mode in ('kill', 'cleanup'):
+        handle = sys.argv[2]
+        response = {'handle': handle, 'raw': functions[mode](handle)}
+    else:
+        print 'Invalid mode: %s' % mode
+        sys.exit(1)
+    print json.dumps(response)
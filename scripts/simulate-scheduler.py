@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# Simulates the worker starting STAGED bundles with each scheduler (see
+# codalab/objects/scheduler.py) on a synthetic workload, and prints throughput
+# and per-user wait times, to compare schedulers without running anything.
+# Usage: simulate-scheduler.py [options]
+#
+# The workload has one heavy user who stages many bundles at once, light users
+# who stage a few bundles at random times, and some urgent bundles with a higher
+# request_priority. A fraction of the bundles go to a separate 'gpu' queue with
+# its own slots.
+
+import sys, os
+import argparse
+import collections
+import heapq
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from codalab.objects.scheduler import SCHEDULERS, get_queue
+
+class SimMetadata(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class SimBundle(object):
+    def __init__(self, uuid, owner_id, created, duration, priority, queue):
+        self.uuid = uuid
+        self.owner_id = owner_id
+        self.metadata = SimMetadata(created=created, request_priority=priority, request_queue=queue)
+        self.duration = duration
+        self.start_time = None
+
+def make_workload(args, rng):
+    bundles = []
+    def add(owner_id, created, priority=0):
+        queue = 'gpu' if rng.random() < args.gpu_fraction else None
+        duration = rng.expovariate(1.0 / args.mean_duration)
+        bundles.append(SimBundle('0x%d' % len(bundles), owner_id, created, duration, priority, queue))
+    for i in range(args.heavy_bundles):
+        add('heavy', 0)
+    for user in range(args.light_users):
+        for i in range(args.light_bundles):
+            add('light-%d' % user, rng.uniform(0, args.horizon))
+    for i in range(args.urgent_bundles):
+        add('urgent', rng.uniform(0, args.horizon), priority=10)
+    return bundles
+
+def simulate(scheduler, bundles, slots):
+    '''
+    Start bundles in the order given by the scheduler whenever a slot of their
+    queue is free, like Worker.update_staged_bundles, and return the time when
+    the last bundle finished.
+    '''
+    events = [(bundle.metadata.created, 0, bundle) for bundle in bundles]  # (time, is_finish, bundle)
+    heapq.heapify(events)
+    staged = []
+    running = {}  # uuid => bundle
+    now = 0
+    while events:
+        now = events[0][0]
+        while events and events[0][0] == now:
+            (_, is_finish, bundle) = heapq.heappop(events)
+            if is_finish:
+                del running[bundle.uuid]
+            else:
+                staged.append(bundle)
+        used = collections.Counter(get_queue(bundle) for bundle in running.itervalues())
+        started = set()
+        for bundle in scheduler.order(staged, [bundle.owner_id for bundle in running.itervalues()]):
+            queue = get_queue(bundle)
+            if used[queue] >= slots[queue]:
+                continue
+            used[queue] += 1
+            bundle.start_time = now
+            running[bundle.uuid] = bundle
+            started.add(bundle.uuid)
+            heapq.heappush(events, (now + bundle.duration, 1, bundle))
+        staged = [bundle for bundle in staged if bundle.uuid not in started]
+    return now
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def jain_index(values):
+    # 1 when all values are equal, 1/n when one of n values has everything.
+    return sum(values) ** 2 / (len(values) * sum(value ** 2 for value in values)) if any(values) else 1.0
+
+def report(name, bundles, makespan):
+    waits_by_owner = collections.defaultdict(list)
+    for bundle in bundles:
+        owner = bundle.owner_id if not bundle.owner_id.startswith('light-') else 'light'
+        waits_by_owner[owner].append(bundle.start_time - bundle.metadata.created)
+    print '%s: makespan %.0fs, throughput %.1f bundles/hour' % (name, makespan, len(bundles) * 3600.0 / makespan)
+    for (owner, waits) in sorted(waits_by_owner.items()):
+        print '  %-8s %5d bundles, wait mean %8.1fs, p90 %8.1fs, max %8.1fs' % \
+            (owner, len(waits), sum(waits) / len(waits), percentile(waits, 0.9), max(waits))
+    # Fairness of the mean slowdown (wait + duration over duration) across users.
+    slowdowns = collections.defaultdict(list)
+    for bundle in bundles:
+        slowdowns[bundle.owner_id].append((bundle.start_time - bundle.metadata.created + bundle.duration) / bundle.duration)
+    mean_slowdowns = [1.0 / (sum(values) / len(values)) for values in slowdowns.values()]
+    print '  fairness (Jain index of 1 / mean slowdown per user): %.3f' % (jain_index(mean_slowdowns),)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate the STAGED bundle schedulers on a synthetic workload.')
+    parser.add_argument('--schedulers', nargs='+', choices=sorted(SCHEDULERS), default=sorted(SCHEDULERS), help='schedulers to compare')
+    parser.add_argument('--slots', type=int, default=10, help='number of bundles that can run at once in the default queue')
+    parser.add_argument('--gpu-slots', type=int, default=2, help='number of bundles that can run at once in the gpu queue')
+    parser.add_argument('--gpu-fraction', type=float, default=0.1, help='fraction of the bundles that go to the gpu queue')
+    parser.add_argument('--heavy-bundles', type=int, default=1000, help='number of bundles that the heavy user stages at once')
+    parser.add_argument('--light-users', type=int, default=10, help='number of light users')
+    parser.add_argument('--light-bundles', type=int, default=20, help='number of bundles of each light user')
+    parser.add_argument('--urgent-bundles', type=int, default=20, help='number of bundles with a higher priority')
+    parser.add_argument('--mean-duration', type=float, default=60, help='mean running time of a bundle, in seconds')
+    parser.add_argument('--horizon', type=float, default=3600, help='seconds over which the other bundles are staged')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the workload')
+    args = parser.parse_args()
+
+    slots = collections.defaultdict(lambda: args.slots, gpu=args.gpu_slots)
+    for name in args.schedulers:
+        bundles = make_workload(args, random.Random(args.seed))
+        makespan = simulate(SCHEDULERS[name](), bundles, slots)
+        report(name, bundles, makespan)
@@ -3,9 +3,10 @@ Local bundle client tests.
 '''
 import unittest
 
-from codalab.common import UsageError
+from codalab.common import PermissionError, UsageError
+from codalab.bundles.run_bundle import RunBundle
 from codalab.client.local_bundle_client import LocalBundleClient
-from codalab.lib import path_util, spec_util
+from codalab.lib import path_util, spec_util, worksheet_util
 from codalab.lib.bundle_store import BundleStore
 from codalab.model.sqlite_model import SQLiteModel
 from codalab.server.auth import MockAuthHandler, User
@@ -158,3 +159,84 @@ class GroupsAndPermsTest(unittest.TestCase):
         _assert_group_count_for('root', 0)
         _assert_group_count_for('user1', 0)
         _assert_group_count_for('user2', 0)
+
+
+class DeriveBundlesTest(unittest.TestCase):
+    '''
+    Tests for bulk bundle creation
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_root = path_util.normalize("~/.codalab_tests")
+        path_util.make_directory(cls.test_root)
+        cls.bundle_store = BundleStore(cls.test_root, [])
+        cls.model = SQLiteModel(cls.test_root)
+        cls.model.root_user_id = '0'
+        users = [User('root', '0'), User('user1', '1')]
+        cls.auth_handler = MockAuthHandler(users)
+        cls.client = LocalBundleClient('local', cls.bundle_store, cls.model, cls.auth_handler, verbose=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.model.engine.close()
+        path_util.remove(cls.test_root)
+
+    def set_current_user(self, username, password):
+        token_info = self.client.login('credentials', username, password)
+        self.auth_handler.validate_token(token_info['access_token'])
+
+    def test_derive_bundles(self):
+        self.set_current_user('user1', '')
+        worksheet_uuid = self.client.new_worksheet('derive_bundles')
+        group = self.client.new_group('g_derive_bundles')
+        self.client.set_worksheet_perm(worksheet_uuid, group['uuid'], 'read')
+
+        metadata = {}
+        for spec in RunBundle.get_user_defined_metadata():
+            metadata[spec.key] = [] if spec.type == list else spec.get_constructor()()
+        specs = [{
+            'bundle_type': 'run',
+            'targets': [],
+            'command': 'echo %d' % i,
+            'metadata': dict(metadata, name='run%d' % i),
+        } for i in range(3)]
+        uuids = self.client.derive_bundles(specs, worksheet_uuid)
+        self.assertEqual(3, len(uuids))
+
+        # Bundles are appended to the worksheet in order.
+        worksheet_info = self.client.get_worksheet_info(worksheet_uuid, fetch_items=True)
+        self.assertEqual(uuids, [item[0]['uuid'] for item in worksheet_info['items']])
+
+        # Bundles inherit the permissions of the worksheet.
+        worksheet_groups = set(row['group_uuid'] for row in self.model.get_group_worksheet_permissions(worksheet_uuid))
+        self.assertIn(group['uuid'], worksheet_groups)
+        infos = self.client.get_bundle_infos(uuids, get_permissions=True)
+        for uuid in uuids:
+            self.assertEqual('echo %d' % uuids.index(uuid), infos[uuid]['command'])
+            self.assertEqual(worksheet_groups, set(row['group_uuid'] for row in infos[uuid]['group_permissions']))
+
+        # Bundles must be owned by the caller's worksheet.
+        self.set_current_user('root', '')
+        other_worksheet_uuid = self.client.new_worksheet('derive_bundles_root')
+        self.set_current_user('user1', '')
+        with self.assertRaises(PermissionError):
+            self.client.derive_bundles(specs, other_worksheet_uuid)
+
+    def test_subworksheet_items(self):
+        self.set_current_user('root', '')
+        private_uuid = self.client.new_worksheet('subworksheet_private')
+        self.client.set_worksheet_perm(private_uuid, self.model.public_group_uuid, 'none')
+        self.set_current_user('user1', '')
+        worksheet_uuid = self.client.new_worksheet('subworksheet_index')
+        public_uuid = self.client.new_worksheet('subworksheet_public')
+        missing_uuid = spec_util.generate_uuid()
+        for uuid in (public_uuid, private_uuid, missing_uuid):
+            self.model.add_worksheet_item(worksheet_uuid, worksheet_util.subworksheet_item(uuid))
+
+        items = self.client.get_worksheet_info(worksheet_uuid, fetch_items=True)['items']
+        self.assertEqual(('subworksheet_public', 'user1'), (items[0][1]['name'], items[0][1]['owner_name']))
+        # Unreadable subworksheets stay links, without revealing anything else.
+        self.assertEqual({'uuid': private_uuid, 'name': '<private>'}, items[1][1])
+        self.assertEqual(worksheet_util.TYPE_WORKSHEET, items[1][3])
+        self.assertEqual((None, worksheet_util.TYPE_MARKUP), (items[2][1], items[2][3]))
@@ -10,6 +10,7 @@ from codalab.lib import (
   canonicalize,
   spec_util,
 )
+from codalab.model.util import LikeQuery
  
 
 class CanonicalizeTest(unittest.TestCase):
@@ -58,6 +59,42 @@ class CanonicalizeTest(unittest.TestCase):
       lambda: canonicalize.get_bundle_uuid(model, user_id, worksheet_uuid, 'names have no exclamations!'),
     )
 
+  def test_get_bundle_uuids(self):
+    tester = self
+    worksheet_uuid = '0x12345'
+    uuid = spec_util.generate_uuid()
+    prefix_uuid = spec_util.generate_uuid()
+    bundle_uuids = {
+      LikeQuery(prefix_uuid[:8] + '%'): [prefix_uuid],
+      'foo': ['foo_2', 'foo_1'],
+      LikeQuery('ba%'): ['bar'],
+      None: ['h1', 'h2', 'h3'],
+    }
+
+    class MockBundleModel(object):
+      def __init__(self):
+        self.num_calls = 0
+      def batch_get_bundle_uuids(self, queries):
+        self.num_calls += 1
+        results = []
+        for (conditions, max_results) in queries:
+          key = conditions['uuid'] if 'uuid' in conditions else conditions['name']
+          if 'name' in conditions:
+            tester.assertEqual(conditions['worksheet_uuid'], worksheet_uuid)
+          results.append(bundle_uuids.get(key, [])[:max_results])
+        return results
+    model = MockBundleModel()
+
+    specs = [uuid, prefix_uuid[:8], 'foo^2', 'ba.*', '^3', 'foo', uuid]
+    expected = [uuid, prefix_uuid, 'foo_1', 'bar', 'h3', 'foo_2', uuid]
+    self.assertEqual(canonicalize.get_bundle_uuids(model, None, worksheet_uuid, specs), expected)
+    self.assertEqual(model.num_calls, 1)
+    # Specs that are all uuids don't need a query.
+    self.assertEqual(canonicalize.get_bundle_uuids(model, None, worksheet_uuid, [uuid]), [uuid])
+    self.assertEqual(model.num_calls, 1)
+    for spec in ('foo^3', '^4', 'missing', '0xabc', ''):
+      self.assertRaises(UsageError, lambda: canonicalize.get_bundle_uuids(model, None, worksheet_uuid, [uuid, spec]))
+
   def test_get_target_path(self):
     tester = self
     test_bundle_spec = 'test_bundle_spec'
@@ -68,9 +105,10 @@ class CanonicalizeTest(unittest.TestCase):
     target = (test_uuid, test_path)
 
     class MockBundleModel(object):
-      def get_bundle(self, uuid):
+      def batch_get_bundle_fields(self, fields, uuid):
+        tester.assertEqual(fields, ['data_hash'])
         tester.assertEqual(uuid, test_uuid)
-        return self._bundle
+        return [{'id': 1, 'data_hash': self._bundle.data_hash}]
     test_model = MockBundleModel()
 
     class MockBundleStore(object):
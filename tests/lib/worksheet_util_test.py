@@ -8,6 +8,34 @@ from codalab.common import PreconditionViolation
 from codalab.lib import worksheet_util
 
 class WorksheetUtilTest(unittest.TestCase):
+  def test_diff_items(self):
+    '''
+    Test that diff_items only includes the items that changed.
+    '''
+    items = [worksheet_util.markup_item(str(i)) for i in range(6)]
+    item_ids = range(10, 16)
+    self.assertEqual(worksheet_util.diff_items(items, item_ids, items), [])
+    new_items = [items[0], worksheet_util.markup_item('new'), items[1], items[5], items[3], items[4]]
+    self.assertEqual(worksheet_util.diff_items(items, item_ids, new_items), [
+      ('delete', [12]),
+      ('insert', 11, [worksheet_util.markup_item('new')]),
+      ('move', [15], 13),
+    ])
+
+  def test_get_context_items(self):
+    '''
+    Test that get_context_items keeps schemas and the display still in effect.
+    '''
+    schema = [worksheet_util.directive_item('schema s'), worksheet_util.directive_item('add name')]
+    display = worksheet_util.directive_item('display table s')
+    bundle = worksheet_util.bundle_item('0x1')
+    markup = worksheet_util.markup_item('text')
+    comment = worksheet_util.directive_item('% comment')
+    self.assertEqual(worksheet_util.get_context_items(schema + [display]), schema + [display])
+    self.assertEqual(worksheet_util.get_context_items(schema + [display, markup, bundle]), schema + [display])
+    self.assertEqual(worksheet_util.get_context_items(schema + [display, bundle, markup]), schema)
+    self.assertEqual(worksheet_util.get_context_items([display, bundle, comment, bundle]), [])
+
   def test_apply_func(self):
     '''
     Test apply_func for rendering values in worksheets.
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from codalab.machines.local_machine import LocalMachine
+from mocks import MockBundle, MockBundleStore
+
+
+class LocalMachineTest(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.bundle_store = MockBundleStore(self.root)
+    self.machine = LocalMachine({'cpus': 4, 'memory': '1g'})
+
+  def tearDown(self):
+    for job in self.machine.jobs.values():
+      job['process'].kill()
+      job['process'].wait()
+    shutil.rmtree(self.root)
+
+  def start(self, bundle):
+    status = self.machine.start_bundle(bundle, self.bundle_store, {}, 'user')
+    if status:
+      bundle.metadata.job_handle = status['job_handle']
+    return status
+
+  def wait_for(self, bundle):
+    for _ in range(500):
+      for status in self.machine.get_bundle_statuses():
+        if status['job_handle'] == bundle.metadata.job_handle and status['exitcode'] is not None:
+          return status
+      time.sleep(0.01)
+    self.fail('%s did not finish' % (bundle.uuid,))
+
+  def test_slots(self):
+    sleeper = MockBundle('sleeper', 'sleep 10', request_cpus=2)
+    quick = MockBundle('quick', 'echo hello', request_cpus=1, request_memory='256m')
+    big = MockBundle('big', 'true', request_cpus=2)
+    huge = MockBundle('huge', 'true', request_cpus=8)
+    self.assertTrue(self.start(sleeper))
+    self.assertTrue(self.start(quick))
+    # Only one CPU is left, and a bundle that needs more than the machine has
+    # waits until nothing else is running.
+    self.assertIsNone(self.start(big))
+    self.assertIsNone(self.start(huge))
+    self.assertEqual(len(self.machine.get_bundle_statuses()), 2)
+
+    status = self.wait_for(quick)
+    self.assertTrue(status['success'])
+    self.assertEqual(open(os.path.join(self.root, 'quick', 'stdout')).read(), 'hello\n')
+    self.assertTrue(self.machine.finalize_bundle(quick))
+    self.assertTrue(self.start(big))
+
+    self.assertTrue(self.machine.kill_bundle(sleeper))
+    self.assertFalse(self.wait_for(sleeper)['success'])
+    self.assertTrue(self.machine.finalize_bundle(sleeper))
+    self.wait_for(big)
+    self.assertTrue(self.machine.finalize_bundle(big))
+    self.assertFalse(self.machine.finalize_bundle(big))
+    self.assertEqual(self.machine.jobs, {})
+    self.assertTrue(self.start(huge))
+
+  def test_exited_jobs(self):
+    # A job that exited frees its CPUs before it is finalized.
+    first = MockBundle('first', 'true', request_cpus=4)
+    self.assertTrue(self.start(first))
+    self.assertIsNone(self.start(MockBundle('second', 'true', request_cpus=4)))
+    self.wait_for(first)
+    self.assertTrue(self.start(MockBundle('third', 'true', request_cpus=4)))
+    self.assertTrue(self.machine.finalize_bundle(first))
+
+  def test_memory(self):
+    self.assertTrue(self.start(MockBundle('a', 'sleep 10', request_memory='768m')))
+    self.assertIsNone(self.start(MockBundle('b', 'true', request_memory='512m')))
+    self.assertTrue(self.start(MockBundle('c', 'true', request_memory='256m')))
@@ -0,0 +1,179 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from codalab.common import UsageError
+from codalab.machines.remote_machine import RemoteMachine
+from mocks import MockBundle, MockBundleStore
+
+
+class RemoteMachineTest(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.bundle_store = MockBundleStore(self.root)
+    self.machine = RemoteMachine({
+      'verbose': 0,
+      'dispatch_command': 'dispatch',
+      'nodes': [
+        {'name': 'big', 'cpus': 8, 'memory': '32g', 'gpus': 2},
+        {'name': 'small', 'cpus': 2, 'memory': '4g'},
+      ],
+    })
+    self.commands = []
+    self.machine.run_command_get_stdout = self.run_command
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def run_command(self, args):
+    self.commands.append(args)
+    return json.dumps({'handle': 'job-%d' % (len(self.commands),)})
+
+  def start(self, bundle):
+    return self.machine.start_bundle(bundle, self.bundle_store, {}, 'user')
+
+  def test_best_fit(self):
+    # Small bundles go to the small node, so the big node stays free.
+    status = self.start(MockBundle('a'))
+    self.assertEqual(status['remote'], 'small')
+    self.assertEqual(self.commands[-1][-5:-3], ['--request_node', 'small'])
+    self.assertEqual(self.start(MockBundle('b', request_memory='2g'))['remote'], 'small')
+    self.assertEqual(self.start(MockBundle('c'))['remote'], 'big')
+    self.assertEqual(self.start(MockBundle('d', request_gpus=2, request_cpus=7))['remote'], 'big')
+    # Nothing fits: the bundle isn't dispatched.
+    num_commands = len(self.commands)
+    self.assertEqual(self.start(MockBundle('e', request_cpus=2)), None)
+    self.assertEqual(len(self.commands), num_commands)
+
+    utilization = self.machine.get_utilization()
+    self.assertEqual(utilization['nodes']['small']['memory'], {'used': 2 * 1024 ** 3, 'total': 4 * 1024 ** 3})
+    self.assertEqual(utilization['total']['cpus'], {'used': 10, 'total': 10})
+    self.assertEqual(utilization['total']['gpus'], {'used': 2, 'total': 2})
+
+  def test_too_big(self):
+    # Bundles that request more than any node has fail instead of waiting.
+    bundles = [MockBundle('a', request_cpus=9), MockBundle('b', request_gpus=3), MockBundle('c', request_memory='64g')]
+    results = self.machine.start_bundles([(bundle, self.bundle_store, {}, 'user') for bundle in bundles])
+    self.assertTrue(all(isinstance(result, UsageError) for result in results))
+    self.assertEqual(self.commands, [])
+    # Even on a full cluster, a bundle that fits on an empty node waits.
+    self.start(MockBundle('d', request_cpus=8))
+    self.start(MockBundle('e', request_cpus=2))
+    self.assertEqual(self.start(MockBundle('f', request_cpus=8)), None)
+
+  def test_update_allocations(self):
+    self.start(MockBundle('a', request_cpus=8))
+    self.assertEqual(self.machine.place_bundle({'cpus': 4, 'memory': 0, 'gpus': 0}), None)
+    # The job finished, and one we didn't start (before a restart) runs on small.
+    self.machine.update_allocations([
+      {'job_handle': 'job-1', 'exitcode': 0, 'remote': 'big'},
+      {'job_handle': 'job-0', 'exitcode': None, 'remote': 'small'},
+    ])
+    self.assertEqual(self.machine.allocations.keys(), ['job-0'])
+    self.assertEqual(self.machine.place_bundle({'cpus': 4, 'memory': 0, 'gpus': 0}), 'big')
+    self.assertEqual(self.machine.get_free_resources('small')['cpus'], 1)
+
+  def test_missing_handles(self):
+    # The dispatcher returned no handle for one job, and nothing for another.
+    self.machine.dispatch_start = lambda jobs: ['job-0', None]
+    bundles = [MockBundle(uuid) for uuid in ('a', 'b', 'c')]
+    results = self.machine.start_bundles([(bundle, self.bundle_store, {}, 'user') for bundle in bundles])
+    self.assertEqual(results[0]['job_handle'], 'job-0')
+    self.assertTrue(all(isinstance(result, Exception) for result in results[1:]))
+    # Only the started job holds resources.
+    self.assertEqual(self.machine.allocations.keys(), ['job-0'])
+
+
+class FakeDispatcherTest(unittest.TestCase):
+  '''
+  Run bundles through scripts/dispatch-fake.py, which runs them locally.
+  '''
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.bundle_store = MockBundleStore(self.root)
+    os.environ['CODALAB_DISPATCH_FAKE_DIR'] = os.path.join(self.root, 'dispatch')
+    script = os.path.join(os.path.dirname(__file__), '..', '..', 'scripts', 'dispatch-fake.py')
+    self.dispatch_command = '%s %s' % (sys.executable, os.path.abspath(script))
+
+  def tearDown(self):
+    del os.environ['CODALAB_DISPATCH_FAKE_DIR']
+    shutil.rmtree(self.root)
+
+  def run_bundles(self, machine):
+    bundles = [MockBundle('fail'), MockBundle('succeed'), MockBundle('sleep')]
+    bundles[0].command = 'exit 3'
+    bundles[2].command = 'sleep 10'
+    statuses = machine.start_bundles([(bundle, self.bundle_store, {}, 'user') for bundle in bundles])
+    for (bundle, status) in zip(bundles, statuses):
+      bundle.metadata.job_handle = status['job_handle']
+      bundle.metadata.temp_dir = status['temp_dir']
+      bundle.metadata.docker_image = None
+    job_handles = [bundle.metadata.job_handle for bundle in bundles]
+
+    for _ in range(500):
+      exitcodes = dict((status['job_handle'], status['exitcode']) for status in machine.get_bundle_statuses(job_handles))
+      if exitcodes[job_handles[0]] is not None and exitcodes[job_handles[1]] is not None:
+        break
+      time.sleep(0.01)
+    self.assertEqual([exitcodes[job_handle] for job_handle in job_handles], [3, 0, None])
+    # Only the statuses of the given jobs are returned.
+    self.assertEqual([status['job_handle'] for status in machine.get_bundle_statuses(job_handles[1:2])], job_handles[1:2])
+
+    self.assertTrue(machine.kill_bundle(bundles[2]))
+    self.assertNotEqual(machine.get_bundle_statuses(job_handles[2:])[0]['exitcode'], None)
+    for bundle in bundles:
+      self.assertTrue(machine.finalize_bundle(bundle))
+    self.assertEqual(machine.get_bundle_statuses(job_handles), [])
+
+  def test_persistent_dispatcher(self):
+    machine = RemoteMachine({'verbose': 0, 'dispatch_command': self.dispatch_command, 'persistent_dispatcher': True})
+    machine.run_command_get_stdout = None  # Everything goes through the dispatcher process.
+    try:
+      self.run_bundles(machine)
+      process = machine.dispatcher.process
+      self.assertEqual(process.poll(), None)
+    finally:
+      machine.dispatcher.close()
+    self.assertEqual(process.returncode, 0)
+
+  def test_dispatch_command(self):
+    self.run_bundles(RemoteMachine({'verbose': 0, 'dispatch_command': self.dispatch_command}))
+
+
+class TorqueDispatcherTest(unittest.TestCase):
+  '''
+  Run scripts/dispatch-torque.py info with a fake qstat.
+  '''
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    with open(os.path.join(self.root, 'qstat'), 'w') as f:
+      f.write('#!/bin/sh\neval "$QSTAT_COMMAND"\n')
+    os.chmod(os.path.join(self.root, 'qstat'), 0755)
+    self.env = dict(os.environ, PATH=self.root + os.pathsep + os.environ['PATH'])
+    self.script = os.path.join(os.path.dirname(__file__), '..', '..', 'scripts', 'dispatch-torque.py')
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def info(self, qstat_command, handles):
+    env = dict(self.env, QSTAT_COMMAND=qstat_command)
+    process = subprocess.Popen([sys.executable, self.script, 'info'] + handles,
+                               env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = process.communicate()
+    return process.returncode, stdout
+
+  def test_unknown_jobs(self):
+    # qstat prints the jobs it knows and fails on a purged one.
+    (returncode, stdout) = self.info(
+      "printf 'Job Id: 1.server\\n    job_state = R\\n\\n'; echo qstat: Unknown Job Id Error 2.server >&2; exit 153",
+      ['1.server', '2.server'])
+    self.assertEqual(returncode, 0)
+    self.assertEqual(json.loads(stdout)['infos'], [{'handle': '1.server'}, {'handle': '2.server', 'exitcode': -1}])
+    # Other errors still fail.
+    (returncode, stdout) = self.info('echo qstat: cannot connect to server >&2; exit 1', ['1.server'])
+    self.assertNotEqual(returncode, 0)
@@ -0,0 +1,48 @@
+'''
+Bundles for tests: real run bundles to save in a model, and stand-ins for
+bundles and the bundle store, for the tests of code that only reads a few
+attributes of them (machines and schedulers).
+'''
+import os
+
+from codalab.bundles.run_bundle import RunBundle
+
+REQUEST_KEYS = ('docker_image', 'time', 'memory', 'cpus', 'gpus', 'queue')
+
+
+def make_run_bundle(name, parents=(), **metadata):
+  '''
+  Return a run bundle with the given name, metadata (defaults for the rest)
+  and a dependency on each of the given parents.
+  '''
+  default_metadata = {}
+  for spec in RunBundle.get_user_defined_metadata():
+    default_metadata[spec.key] = [] if spec.type == list else spec.get_constructor()()
+  targets = [(parent.metadata.name, (parent.uuid, '')) for parent in parents]
+  return RunBundle.construct(targets=targets, command='echo', owner_id='0',
+                             metadata=dict(default_metadata, name=name, **metadata))
+
+
+class MockMetadata(object):
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+
+class MockBundle(object):
+  def __init__(self, uuid, command='true', owner_id='0', **metadata):
+    self.uuid = uuid
+    self.command = command
+    self.owner_id = owner_id
+    request_metadata = dict(('request_' + key, None) for key in REQUEST_KEYS)
+    self.metadata = MockMetadata(**dict(request_metadata, **metadata))
+
+  def get_dependency_paths(self, bundle_store, parent_dict, temp_dir):
+    return []
+
+
+class MockBundleStore(object):
+  def __init__(self, root):
+    self.root = root
+
+  def get_temp_location(self, identifier):
+    return os.path.join(self.root, identifier)
@@ -1,12 +1,28 @@
 import mock
+import random
 from sqlalchemy import create_engine
 from sqlalchemy.engine.reflection import Inspector
 import unittest
 
+from codalab.bundles.run_bundle import RunBundle
+from codalab.common import (
+  State,
+  UsageError,
+)
+from codalab.lib import worksheet_util
 from codalab.model.bundle_model import (
   BundleModel,
   db_metadata,
 )
+from codalab.model.util import LikeQuery
+from codalab.objects.worksheet import Worksheet
+from codalab.model.tables import (
+  bundle_metadata as cl_bundle_metadata,
+  GROUP_OBJECT_PERMISSION_ALL,
+  GROUP_OBJECT_PERMISSION_NONE,
+  GROUP_OBJECT_PERMISSION_READ,
+)
+from mocks import make_run_bundle
 
 
 def metadata_to_dicts(uuid, metadata):
@@ -116,3 +132,310 @@ class BundleModelTest(unittest.TestCase):
       retrieved_bundle = self.model.get_bundle(bundle.uuid)
     self.assertTrue(isinstance(retrieved_bundle, MockBundle))
     self.assertTrue(retrieved_bundle._validate_called)
+
+  def test_get_user_permissions(self):
+    self.model.root_user_id = '0'
+    for group_uuid in ('g1', 'g2', 'g3'):
+      self.model.create_group({'uuid': group_uuid, 'name': group_uuid, 'owner_id': '0', 'user_defined': True})
+    self.model.add_user_in_group('1', 'g1', False)
+    self.model.add_user_in_group('1', 'g2', False)
+    self.model.add_bundle_permission('g1', 'b1', GROUP_OBJECT_PERMISSION_READ)
+    self.model.add_bundle_permission('g2', 'b1', GROUP_OBJECT_PERMISSION_ALL)
+    self.model.add_bundle_permission('g3', 'b2', GROUP_OBJECT_PERMISSION_ALL)
+    self.model.add_bundle_permission(self.model.public_group_uuid, 'b3', GROUP_OBJECT_PERMISSION_READ)
+    owner_ids = {'b1': '2', 'b2': '2', 'b3': '2', 'b4': '1'}
+    expected = {
+      'b1': GROUP_OBJECT_PERMISSION_ALL,
+      'b2': GROUP_OBJECT_PERMISSION_NONE,
+      'b3': GROUP_OBJECT_PERMISSION_READ,
+      'b4': GROUP_OBJECT_PERMISSION_ALL,
+    }
+    uuids = sorted(owner_ids)
+    self.assertEqual(expected, self.model.get_user_bundle_permissions('1', uuids, owner_ids))
+    with self.model.cache_user_groups():
+      self.assertEqual(expected, self.model.get_user_bundle_permissions('1', uuids, owner_ids))
+      # Changing group membership invalidates the cache.
+      self.model.add_user_in_group('1', 'g3', False)
+      expected['b2'] = GROUP_OBJECT_PERMISSION_ALL
+      self.assertEqual(expected, self.model.get_user_bundle_permissions('1', uuids, owner_ids))
+    anonymous = self.model.get_user_bundle_permissions(None, uuids, owner_ids)
+    self.assertEqual(GROUP_OBJECT_PERMISSION_READ, anonymous['b3'])
+    self.assertEqual(GROUP_OBJECT_PERMISSION_NONE, anonymous['b1'])
+
+  def test_set_group_permissions(self):
+    for group_uuid in ('g1', 'g2'):
+      self.model.create_group({'uuid': group_uuid, 'name': group_uuid, 'owner_id': '0', 'user_defined': True})
+    self.model.add_bundle_permission('g1', 'b1', GROUP_OBJECT_PERMISSION_ALL)
+    self.model.add_bundle_permission('g2', 'b1', GROUP_OBJECT_PERMISSION_READ)
+    def get_permissions():
+      result = self.model.batch_get_group_bundle_permissions(['b1', 'b2', 'b3'])
+      return dict((uuid, sorted((row['group_uuid'], row['permission']) for row in rows)) for (uuid, rows) in result.items())
+
+    self.model.set_group_bundle_permissions(['b1', 'b2', 'b3'], [
+      {'group_uuid': 'g1', 'permission': GROUP_OBJECT_PERMISSION_READ},
+      {'group_uuid': 'g2', 'permission': GROUP_OBJECT_PERMISSION_NONE},
+    ])
+    expected = [('g1', GROUP_OBJECT_PERMISSION_READ)]
+    self.assertEqual({'b1': expected, 'b2': expected, 'b3': expected}, get_permissions())
+    self.model.set_group_bundle_permissions(['b2', 'b3'], [{'group_uuid': 'g1', 'permission': GROUP_OBJECT_PERMISSION_NONE}])
+    self.assertEqual({'b1': expected}, get_permissions())
+
+  def test_replica_routing(self):
+    replica_engine = create_engine('sqlite://', strategy='threadlocal')
+    db_metadata.create_all(replica_engine)
+    model = BundleModel(self.engine, replica_engines=[replica_engine], replica_lag=60)
+    bundle = MockBundle()
+    with model.read_your_writes('writer'):
+      model.save_bundle(bundle)
+
+    get_bundle_subclass_path = 'codalab.model.bundle_model.get_bundle_subclass'
+    with mock.patch(get_bundle_subclass_path, lambda bundle_type: MockBundle):
+      # The replica hasn't seen the write, but the writer reads its own writes.
+      with model.read_your_writes('reader'):
+        self.assertEqual([], model.batch_get_bundles(uuid=bundle.uuid))
+        with model.read_from_primary():
+          self.assertEqual(1, len(model.batch_get_bundles(uuid=bundle.uuid)))
+      with model.read_your_writes('writer'):
+        self.assertEqual(1, len(model.batch_get_bundles(uuid=bundle.uuid)))
+
+  def test_large_uuid_batches(self):
+    # More uuids than fit into a single IN clause (SQLite allows 999 variables).
+    bundle = MockBundle()
+    self.model.save_bundle(bundle)
+    self.model.root_user_id = '0'
+    uuids = ['0x%032x' % i for i in range(100000)] + [bundle.uuid]
+
+    class MockBundleWithId(MockBundle):
+      def __init__(self, row=None):
+        super(MockBundleWithId, self).__init__(row)
+        self.id = row['id'] if row else None
+
+    get_bundle_subclass_path = 'codalab.model.bundle_model.get_bundle_subclass'
+    with mock.patch(get_bundle_subclass_path, lambda bundle_type: MockBundleWithId):
+      bundles = self.model.batch_get_bundles(uuid=uuids)
+    self.assertEqual([bundle.uuid], [b.uuid for b in bundles])
+    self.assertEqual(len(uuids), len(self.model.get_children_uuids(uuids)))
+    self.assertEqual(len(uuids), len(self.model.get_user_bundle_permissions('1', uuids, {})))
+    self.model.delete_bundles(uuids[-2000:])
+    self.assertEqual({}, self.model.get_bundle_owner_ids([bundle.uuid]))
+
+  def test_metadata_storage(self):
+    def get_metadata_keys(uuid):
+      rows = self.engine.execute(cl_bundle_metadata.select().where(cl_bundle_metadata.c.bundle_uuid == uuid))
+      return set(row.metadata_key for row in rows)
+    def check_metadata(bundle):
+      retrieved_bundle = self.model.get_bundle(bundle.uuid)
+      self.assertEqual(canonicalize(bundle.metadata.to_dicts(RunBundle.METADATA_SPECS)),
+                       canonicalize(retrieved_bundle.metadata.to_dicts(RunBundle.METADATA_SPECS)))
+
+    # Bundles in both layouts can be read at the same time.
+    table_bundle = make_run_bundle('table', tags=['a', 'b'], request_cpus=2)
+    self.model.save_bundle(table_bundle)
+    self.model.metadata_storage = 'document'
+    document_bundle = make_run_bundle('document', tags=['a', 'b'], request_cpus=2)
+    self.model.save_bundle(document_bundle)
+    self.assertEqual(set(['name', 'description', 'tags', 'created']), get_metadata_keys(document_bundle.uuid))
+    check_metadata(table_bundle)
+    check_metadata(document_bundle)
+
+    # Updates keep both the document and the searchable rows current.
+    self.model.update_bundle(document_bundle, {'metadata': {'name': 'renamed', 'time': 1.5}})
+    check_metadata(document_bundle)
+    self.assertEqual([document_bundle.uuid], self.model.get_bundle_uuids({'name': 'renamed', 'worksheet_uuid': None}, None))
+    self.model.metadata_storage = 'table'
+    self.model.update_bundle(document_bundle, {'metadata': {'request_cpus': 4}})
+    check_metadata(document_bundle)
+
+    # Converting moves the metadata of all bundles between the layouts.
+    self.assertEqual(1, self.model.convert_metadata_storage('document'))
+    self.assertEqual(set(['name', 'description', 'tags', 'created']), get_metadata_keys(table_bundle.uuid))
+    check_metadata(table_bundle)
+    self.assertEqual(2, self.model.convert_metadata_storage('table', batch_size=1))
+    self.assertIn('request_cpus', get_metadata_keys(document_bundle.uuid))
+    check_metadata(table_bundle)
+    check_metadata(document_bundle)
+
+  def test_batch_get_bundle_fields(self):
+    parent = make_run_bundle('parent', tags=['a', 'b'], request_cpus=2)
+    self.model.save_bundle(parent)
+    self.model.metadata_storage = 'document'
+    child = make_run_bundle('child', [parent], tags=['a', 'b'], request_cpus=2)
+    self.model.save_bundle(child)
+
+    fields = ['uuid', 'state', 'parent_uuids', 'name', 'tags', 'request_cpus', 'exitcode']
+    results = self.model.batch_get_bundle_fields(fields, uuid=[child.uuid, parent.uuid])
+    self.assertEqual([parent.id, child.id], [result['id'] for result in results])
+    self.assertEqual(set(fields + ['id']), set(results[0]))
+    for (bundle, result) in zip([parent, child], results):
+      self.assertEqual(bundle.uuid, result['uuid'])
+      self.assertEqual(bundle.state, result['state'])
+      self.assertEqual([dep.parent_uuid for dep in bundle.dependencies], result['parent_uuids'])
+      self.assertEqual(bundle.metadata.name, result['name'])
+      self.assertEqual(['a', 'b'], result['tags'])
+      self.assertEqual(2, result['request_cpus'])
+      self.assertEqual(None, result['exitcode'])
+    self.assertEqual([], self.model.batch_get_bundle_fields(['uuid'], state='nonexistent'))
+
+  def test_patch_worksheet(self):
+    worksheet = Worksheet({'name': 'patched', 'items': [], 'owner_id': '0'})
+    self.model.save_worksheet(worksheet)
+    items = [worksheet_util.markup_item(str(i)) for i in range(20)]
+    self.model.add_worksheet_items(worksheet.uuid, items)
+
+    rng = random.Random(1)
+    for _ in range(30):
+      worksheet = self.model.get_worksheet(worksheet.uuid, fetch_items=True)
+      new_items = list(worksheet.items)
+      for _ in range(rng.randint(1, 3)):
+        i = rng.randrange(len(new_items))
+        j = rng.randrange(len(new_items))
+        edit = rng.choice(['insert', 'delete', 'move'])
+        if edit == 'insert':
+          new_items.insert(i, worksheet_util.markup_item('new %d' % rng.randrange(1000)))
+        elif edit == 'delete' and len(new_items) > 1:
+          new_items.pop(i)
+        else:
+          new_items.insert(j, new_items.pop(i))
+      patch = worksheet_util.diff_items(worksheet.items, worksheet.item_ids, new_items)
+      self.model.patch_worksheet(worksheet.uuid, worksheet.last_item_id, len(worksheet.items), patch)
+      self.assertEqual(new_items, self.model.get_worksheet(worksheet.uuid, fetch_items=True).items)
+
+    # Items appended after the worksheet was read stay at the end.
+    worksheet = self.model.get_worksheet(worksheet.uuid, fetch_items=True)
+    self.model.add_worksheet_items(worksheet.uuid, [worksheet_util.markup_item('appended')])
+    new_items = worksheet.items + [worksheet_util.markup_item('last')]
+    patch = worksheet_util.diff_items(worksheet.items, worksheet.item_ids, new_items)
+    self.model.patch_worksheet(worksheet.uuid, worksheet.last_item_id, len(worksheet.items), patch)
+    self.assertEqual(new_items + [worksheet_util.markup_item('appended')],
+                     self.model.get_worksheet(worksheet.uuid, fetch_items=True).items)
+    # But a patch to items that were deleted in the meantime is rejected.
+    patch = worksheet_util.diff_items(worksheet.items, worksheet.item_ids, worksheet.items[1:])
+    self.model.patch_worksheet(worksheet.uuid, worksheet.last_item_id, len(worksheet.items), patch)
+    self.assertRaises(UsageError, lambda: self.model.patch_worksheet(
+      worksheet.uuid, worksheet.last_item_id, len(worksheet.items), patch))
+
+  def test_batch_get_bundle_uuids(self):
+    bundles = [make_run_bundle(name) for name in ('foo', 'bar', 'foo', 'foobar', 'baz')]
+    self.model.batch_save_bundles(bundles)
+    worksheet = Worksheet({'name': 'resolve', 'items': [], 'owner_id': '0'})
+    self.model.save_worksheet(worksheet)
+    self.model.add_worksheet_items(worksheet.uuid, [worksheet_util.bundle_item(bundle.uuid) for bundle in bundles])
+    queries = [
+      ({'uuid': LikeQuery(bundles[0].uuid[:10] + '%')}, 2),
+      ({'name': 'foo', 'worksheet_uuid': worksheet.uuid}, 2),
+      ({'name': LikeQuery('foo%'), 'worksheet_uuid': worksheet.uuid}, 3),
+      ({'name': None, 'worksheet_uuid': worksheet.uuid}, 4),
+      ({'name': 'foo', 'worksheet_uuid': None}, None),
+      ({'name': 'missing', 'worksheet_uuid': worksheet.uuid}, 1),
+    ]
+    expected = [self.model.get_bundle_uuids(conditions, max_results) for (conditions, max_results) in queries]
+    self.assertEqual(expected[1], [bundles[2].uuid, bundles[0].uuid])
+    self.assertEqual(expected[3], [bundle.uuid for bundle in reversed(bundles[1:])])
+    self.assertEqual(self.model.batch_get_bundle_uuids(queries), expected)
+    self.model.MAX_UNION_SIZE = 4
+    self.assertEqual(self.model.batch_get_bundle_uuids(queries), expected)
+    self.assertEqual(self.model.batch_get_bundle_uuids(queries[:1]), expected[:1])
+
+  def test_bundle_leases(self):
+    bundles = [make_run_bundle('run-%d' % i) for i in range(3)]
+    self.model.batch_save_bundles(bundles)
+    self.model.batch_update_bundles(bundles, {'state': State.STAGED})
+    self.assertTrue(self.model.claim_bundle(bundles[0], 'w1', 100))
+    self.assertEqual(bundles[0].state, State.RUNNING)
+    # A bundle can only be claimed once.
+    self.assertFalse(self.model.claim_bundle(bundles[0], 'w2', 100))
+    self.assertTrue(self.model.claim_bundle(bundles[1], 'w2', -1))
+    leases = self.model.get_bundle_leases([bundle.uuid for bundle in bundles])
+    self.assertEqual(sorted((uuid, lease['worker_id']) for (uuid, lease) in leases.iteritems()),
+                     sorted([(bundles[0].uuid, 'w1'), (bundles[1].uuid, 'w2')]))
+
+    # Actions go to the worker that holds the lease, or to anyone if there is none.
+    self.model.add_bundle_actions([{'bundle_uuid': bundle.uuid, 'action': 'kill'} for bundle in bundles])
+    actions = self.model.pop_bundle_actions('w1')
+    self.assertEqual(sorted(action.bundle_uuid for action in actions), sorted([bundles[0].uuid, bundles[2].uuid]))
+    self.assertEqual([action.bundle_uuid for action in self.model.pop_bundle_actions('w1')], [])
+
+    # w2 stopped renewing its lease, so w1 takes it over.
+    self.assertEqual(self.model.renew_bundle_leases('w1', 100), [bundles[0].uuid])
+    self.assertEqual(self.model.take_over_expired_bundle_leases('w1', 100), [bundles[1].uuid])
+    self.assertEqual(self.model.take_over_expired_bundle_leases('w3', 100), [])
+    self.assertEqual(sorted(self.model.renew_bundle_leases('w1', 100)), sorted([bundles[0].uuid, bundles[1].uuid]))
+    self.assertEqual([action.bundle_uuid for action in self.model.pop_bundle_actions('w1')], [bundles[1].uuid])
+
+    self.model.release_bundle_leases([bundles[0].uuid])
+    self.assertEqual(self.model.renew_bundle_leases('w1', 100), [bundles[1].uuid])
+
+  def test_run_keys(self):
+    bundles = [make_run_bundle('run-%d' % i) for i in range(4)]
+    self.model.batch_save_bundles(bundles)
+    self.model.add_run_keys({bundles[0].uuid: 'k1', bundles[1].uuid: 'k1', bundles[2].uuid: 'k2'})
+    self.model.add_run_keys({bundles[3].uuid: 'k2', bundles[2].uuid: 'k3'})
+    # Only READY bundles with data can be reused, the oldest first.
+    self.assertEqual(self.model.get_reusable_bundles(['k1', 'k2', 'k3']), {})
+    self.model.batch_update_bundles(bundles[1:], {'state': State.READY})
+    self.assertEqual(self.model.get_reusable_bundles(['k1', 'k2', 'k3']), {})
+    for bundle in bundles[1:]:
+      self.model.update_bundle(bundle, {'data_hash': '0x' + bundle.uuid})
+    self.assertEqual(self.model.get_reusable_bundles(['k1', 'k2', 'k3', 'k4']),
+                     {'k1': bundles[1].uuid, 'k2': bundles[3].uuid, 'k3': bundles[2].uuid})
+    self.model.delete_bundles([bundles[1].uuid, bundles[3].uuid])
+    self.assertEqual(self.model.get_reusable_bundles(['k1', 'k2', 'k3']), {'k3': bundles[2].uuid})
+    # Nor can bundles whose data was removed (cl rm --data-only).
+    self.model.remove_data_hash_references([bundles[2].uuid])
+    self.assertEqual(self.model.get_reusable_bundles(['k3']), {})
+    self.model.update_bundle(bundles[2], {'data_hash': '0x' + bundles[2].uuid})
+    self.assertEqual(self.model.get_reusable_bundles(['k3']), {})
+
+  def test_get_worksheet_item_window(self):
+    worksheet = Worksheet({'name': 'windowed', 'items': [], 'owner_id': '0'})
+    self.model.save_worksheet(worksheet)
+    items = [worksheet_util.markup_item(str(i)) for i in range(10)]
+    self.model.add_worksheet_items(worksheet.uuid, items)
+    # Place some items in between the others, and append some more.
+    worksheet = self.model.get_worksheet(worksheet.uuid, fetch_items=True)
+    new_items = [worksheet_util.directive_item('display table run')] + items[:5] + \
+      [worksheet_util.markup_item('inserted')] + items[7:] + items[5:7]
+    patch = worksheet_util.diff_items(worksheet.items, worksheet.item_ids, new_items)
+    self.model.patch_worksheet(worksheet.uuid, worksheet.last_item_id, len(worksheet.items), patch)
+    self.model.add_worksheet_items(worksheet.uuid, [worksheet_util.markup_item('appended')])
+    worksheet = self.model.get_worksheet(worksheet.uuid, fetch_items=True)
+
+    for (offset, limit) in ((0, 5), (3, 4), (10, 100), (20, 5)):
+      window = self.model.get_worksheet_item_window(worksheet.uuid, offset, limit)
+      self.assertEqual(window['num_items'], len(worksheet.items))
+      self.assertEqual(window['items'], worksheet.items[offset:offset + limit])
+      self.assertEqual(window['item_ids'], worksheet.item_ids[offset:offset + limit])
+      expected_context = [worksheet_util.directive_item('display table run')] if 0 < offset < len(worksheet.items) else []
+      self.assertEqual(window['context_items'], expected_context)
+
+  def test_get_changes(self):
+    def get_changes(since_seq):
+      result = self.model.get_changes(since_seq, 100)
+      return [(row['object_type'], row['object_uuid'], row['change']) for row in result['changes']]
+    bundle = make_run_bundle('changed')
+    worksheet = Worksheet({'name': 'changed', 'items': [], 'owner_id': '0'})
+    self.model.save_worksheet(worksheet)
+    self.model.batch_save_bundles([bundle], worksheet_uuid=worksheet.uuid)
+    last_seq = self.model.get_changes(0, 100)['last_seq']
+    self.assertEqual(get_changes(0), [
+      ('worksheet', worksheet.uuid, 'create'),
+      ('bundle', bundle.uuid, 'create'),
+      ('worksheet', worksheet.uuid, 'items'),
+    ])
+
+    self.model.update_bundle(bundle, {'metadata': {'description': 'new'}})
+    self.model.add_worksheet_permission(self.model.public_group_uuid, worksheet.uuid, 1)
+    self.model.delete_bundles([bundle.uuid])
+    self.assertEqual(get_changes(last_seq), [
+      ('bundle', bundle.uuid, 'update'),
+      ('worksheet', worksheet.uuid, 'permission'),
+      ('bundle', bundle.uuid, 'delete'),
+      ('worksheet', worksheet.uuid, 'items'),
+    ])
+    self.assertEqual(self.model.get_changes(last_seq, 2)['last_seq'], last_seq + 2)
+
+    # Compaction keeps the last change, and readers that missed changes are told.
+    self.assertEqual(self.model.compact_changes(-1), last_seq + 3)
+    self.assertEqual(len(get_changes(0)), 1)
+    self.assertTrue(self.model.get_changes(0, 100)['truncated'])
+    self.assertFalse(self.model.get_changes(last_seq + 3, 100)['truncated'])
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+
+from codalab.model.bundle_model import BundleModel
+
+
+class QueryLogTest(unittest.TestCase):
+  def setUp(self):
+    self.model = BundleModel(create_engine('sqlite://', strategy='threadlocal'))
+    self.model.root_user_id = '0'
+
+  def test_command_summary(self):
+    with self.model.query_log.command('get_bundle_owner_ids') as stats:
+      self.model.get_bundle_owner_ids(['0x1', '0x2'])
+      self.model.get_bundle_owner_ids(['0x3'])
+    self.assertEqual('get_bundle_owner_ids', stats['command'])
+    self.assertEqual(2, stats['num_queries'])
+    self.assertTrue(stats['db_time'] > 0)
+    # Queries outside the command aren't counted.
+    self.model.get_bundle_owner_ids(['0x4'])
+    self.assertEqual(2, stats['num_queries'])
+
+  def test_slow_log(self):
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      self.model.query_log.slow_threshold = 0
+      self.model.query_log.slow_log_path = path
+      with self.model.query_log.command('search_bundle_uuids'):
+        self.model.search_bundle_uuids('0', None, ['name=foo'])
+      with open(path) as f:
+        text = f.read()
+      self.assertIn('slow query', text)
+      self.assertIn('in search_bundle_uuids', text)
+      self.assertIn('-- plan:', text)
+    finally:
+      os.remove(path)
@@ -0,0 +1,46 @@
+import unittest
+
+from sqlalchemy import create_engine
+
+from codalab.lib.spec_util import generate_uuid
+from codalab.model.bundle_model import BundleModel
+from codalab.model.tables import GROUP_OBJECT_PERMISSION_READ
+from codalab.model.util import LikeQuery
+
+
+class StatementCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.model = BundleModel(create_engine('sqlite://', strategy='threadlocal'))
+    self.model.root_user_id = '0'
+
+  def test_cached_statements(self):
+    cache = self.model.statement_cache
+    self.model.get_bundle_owner_ids([generate_uuid() for _ in range(3)])
+    self.assertEqual((0, 1), (cache.hits, cache.misses))
+    # IN clauses are padded, so a different number of values can reuse a statement.
+    with self.model.query_log.command('get_bundle_owner_ids') as stats:
+      self.model.get_bundle_owner_ids([generate_uuid() for _ in range(4)])
+      self.model.get_bundle_owner_ids([generate_uuid() for _ in range(5)])
+    self.assertEqual((1, 2), (cache.hits, cache.misses))
+    self.assertEqual(1, stats['num_cached'])
+    self.assertTrue(stats['compile_time_saved'] > 0)
+
+  def test_results_match_uncached(self):
+    for i in range(3):
+      group = self.model.create_group({'uuid': generate_uuid(), 'name': 'group%d' % i, 'owner_id': '1', 'user_defined': True})
+      self.model.add_user_in_group('1', group['uuid'], False)
+    self.model.add_bundle_permission(group['uuid'], '0x2', GROUP_OBJECT_PERMISSION_READ)
+    def run_queries():
+      return [
+        self.model.get_bundle_uuids({'uuid': LikeQuery('0x%')}, 5),
+        self.model.get_bundle_uuids({'name': 'foo', 'worksheet_uuid': None}, 2),
+        self.model.get_user_bundle_permissions('1', ['0x1', '0x2'], {'0x1': '1'}),
+        self.model.batch_get_bundle_fields(['uuid', 'state'], uuid=[], state=None),
+      ]
+    cached_results = run_queries()
+    self.assertEqual(GROUP_OBJECT_PERMISSION_READ, cached_results[2]['0x2'])
+    self.assertEqual(cached_results, run_queries())
+    with self.model.cache_user_groups():
+      self.assertEqual(cached_results, run_queries())
+    self.model.statement_cache = None
+    self.assertEqual(cached_results, run_queries())
@@ -0,0 +1,40 @@
+import time
+import unittest
+
+from sqlalchemy import create_engine
+
+from codalab.model.bundle_model import BundleModel
+from codalab.model.worker_wakeup import WorkerWakeup
+
+
+class WorkerWakeupTest(unittest.TestCase):
+  def setUp(self):
+    self.wakeup = WorkerWakeup(0)
+    self.wakeup.listen()
+
+  def tearDown(self):
+    self.wakeup.close()
+
+  def test_wait(self):
+    start_time = time.time()
+    self.assertEqual(self.wakeup.wait(0.05), [])
+    self.assertTrue(time.time() - start_time >= 0.04)
+    # A burst of notifications is received at once.
+    for reason in ('created', 'action', 'created'):
+      self.wakeup.notify(reason)
+    self.assertEqual(sorted(self.wakeup.wait(1)), ['action', 'created', 'created'])
+    self.assertEqual(self.wakeup.wait(0), [])
+
+  def test_notify_without_listener(self):
+    # Nobody is listening on this port after close; notify must not fail.
+    port = self.wakeup.port
+    self.wakeup.close()
+    WorkerWakeup(port).notify('created')
+
+  def test_model_wakes_worker(self):
+    model = BundleModel(create_engine('sqlite://', strategy='threadlocal'))
+    model.worker_wakeup = WorkerWakeup(self.wakeup.port)
+    model.add_bundle_actions([])
+    self.assertEqual(self.wakeup.wait(0.05), [])
+    model.add_bundle_action('0x1', 'kill')
+    self.assertEqual(self.wakeup.wait(1), ['action'])
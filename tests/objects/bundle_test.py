@@ -21,7 +21,7 @@ class MockBundle(Bundle):
 
 
 class BundleTest(unittest.TestCase):
-  COLUMNS = tuple(col.name for col in cl_bundle.c if col.name != 'id')
+  COLUMNS = tuple(col.name for col in cl_bundle.c if col.name not in ('id', 'metadata_document'))
 
   str_metadata = 'my_str'
   int_metadata = 17
@@ -64,8 +64,9 @@ class BundleTest(unittest.TestCase):
 
   def test_columns(self):
     '''
-    Test that Bundle.COLUMNS includes precisely the non-id columns of cl_bundle,
-    in the same order.
+    Test that Bundle.COLUMNS includes precisely the non-id columns of cl_bundle
+    (other than the metadata document, which is loaded as metadata), in the
+    same order.
     '''
     self.assertEqual(Bundle.COLUMNS, self.COLUMNS)
 
@@ -0,0 +1,42 @@
+import threading
+import time
+import unittest
+
+from codalab.objects.finalizer_pool import FinalizerPool
+
+
+class FinalizerPoolTest(unittest.TestCase):
+  def setUp(self):
+    self.pool = FinalizerPool(1, max_queued=1)
+
+  def tearDown(self):
+    self.pool.close()
+
+  def wait_for_results(self, num_results):
+    results = []
+    for _ in range(500):
+      results.extend(self.pool.get_results())
+      if len(results) >= num_results:
+        return results
+      time.sleep(0.01)
+    self.fail('Got only %s results' % (results,))
+
+  def test_submit(self):
+    event = threading.Event()
+    def fail():
+      raise ValueError('failed')
+    self.assertTrue(self.pool.submit('a', lambda: event.wait(5) and 'done'))
+    self.assertTrue(self.pool.submit('b', fail))
+    # One task runs and one waits, so the pool is full.
+    self.assertFalse(self.pool.submit('c', lambda: None))
+    self.assertEqual(self.pool.get_results(), [])
+    self.assertEqual(self.pool.get_stats()['queued'] + self.pool.get_stats()['running'], 2)
+
+    event.set()
+    results = self.wait_for_results(2)
+    self.assertEqual(results[0][:2], ('a', 'done'))
+    self.assertEqual(results[1][0], 'b')
+    self.assertIsInstance(results[1][1], ValueError)
+    stats = self.pool.get_stats()
+    self.assertEqual((stats['queued'], stats['running'], stats['finished']), (0, 0, 2))
+    self.assertTrue(stats['max_time'] >= stats['mean_time'] > 0)
@@ -0,0 +1,44 @@
+import unittest
+
+from codalab.common import UsageError
+from codalab.objects.scheduler import (
+  FairShareScheduler,
+  FifoScheduler,
+  get_scheduler,
+)
+from mocks import MockBundle
+
+
+def get_uuids(bundles):
+  return [bundle.uuid for bundle in bundles]
+
+
+class SchedulerTest(unittest.TestCase):
+  def setUp(self):
+    # User a stages many bundles before users b and c stage theirs.
+    self.bundles = [MockBundle('a%d' % i, owner_id='a', created=i) for i in range(4)]
+    self.bundles.append(MockBundle('b0', owner_id='b', created=10))
+    self.bundles.append(MockBundle('c0', owner_id='c', created=11, request_priority=5))
+    self.bundles.append(MockBundle('b1', owner_id='b', created=12))
+
+  def test_fifo(self):
+    self.assertEqual(get_uuids(FifoScheduler().order(self.bundles, [])),
+                     ['c0', 'a0', 'a1', 'a2', 'a3', 'b0', 'b1'])
+
+  def test_fair_share(self):
+    scheduler = FairShareScheduler()
+    self.assertEqual(get_uuids(scheduler.order(self.bundles, [])),
+                     ['c0', 'a0', 'b0', 'a1', 'b1', 'a2', 'a3'])
+    # Bundles that are already running count towards the share of their owner.
+    self.assertEqual(get_uuids(scheduler.order(self.bundles, ['a', 'a'])),
+                     ['c0', 'b0', 'b1', 'a0', 'a1', 'a2', 'a3'])
+    scheduler = FairShareScheduler(user_weights={'a': 2})
+    self.assertEqual(get_uuids(scheduler.order(self.bundles, [])),
+                     ['c0', 'a0', 'a1', 'b0', 'a2', 'a3', 'b1'])
+
+  def test_get_scheduler(self):
+    self.assertIsInstance(get_scheduler(), FairShareScheduler)
+    scheduler = get_scheduler({'type': 'fair_share', 'user_weights': {'a': 3}})
+    self.assertEqual(scheduler.get_weight('a'), 3)
+    self.assertIsInstance(get_scheduler({'type': 'fifo'}), FifoScheduler)
+    self.assertRaises(UsageError, get_scheduler, {'type': 'lottery'})
@@ -0,0 +1,216 @@
+import mock
+import threading
+import time
+import unittest
+
+from sqlalchemy import create_engine
+
+from codalab.common import State
+from codalab.model.bundle_model import BundleModel
+from codalab.model.tables import bundle_lease
+from codalab.objects.work_manager import Worker
+from mocks import make_run_bundle
+
+
+class MockMachine(object):
+  def __init__(self):
+    self.statuses = []
+    self.killed = []
+    self.finalized = []
+
+  def kill_bundle(self, bundle):
+    self.killed.append(bundle.uuid)
+    return True
+
+  def finalize_bundle(self, bundle):
+    self.finalized.append(bundle.uuid)
+    return True
+
+  def get_bundle_statuses(self, job_handles=None):
+    if self.statuses is None:
+      return None
+    return [dict(status) for status in self.statuses]
+
+
+class WorkerTest(unittest.TestCase):
+  def setUp(self):
+    self.model = BundleModel(create_engine('sqlite://', strategy='threadlocal'))
+    self.model.root_user_id = '0'
+    self.machine = MockMachine()
+    self.worker = Worker(None, self.model, self.machine, None)
+
+  def test_check_finished_bundles(self):
+    bundles = [make_run_bundle('run-%d' % i) for i in range(20)]
+    self.model.batch_save_bundles(bundles)
+    for (i, bundle) in enumerate(bundles):
+      state = State.RUNNING if i < 10 else State.READY
+      self.model.update_bundle(bundle, {'state': state, 'metadata': {'job_handle': str(i % 10)}})
+    # Jobs of running bundles, and one that isn't CodaLab's.
+    self.machine.statuses = [{'job_handle': str(i), 'exitcode': None, 'time': i} for i in range(11)]
+    updates = []
+    self.worker.update_running_bundle = updates.append
+    with self.model.query_log.command('check_finished_bundles') as stats:
+      self.worker.check_finished_bundles()
+    # Finding the bundles of the jobs takes one batch of queries, not one per job.
+    self.assertTrue(stats['num_queries'] <= 3, stats)
+    self.assertEqual(self.worker.num_running_jobs, 11)
+    self.assertEqual(
+      sorted((status['bundle'].uuid, status['time']) for status in updates),
+      sorted((bundle.uuid, i) for (i, bundle) in enumerate(bundles[:10])),
+    )
+
+  def test_check_taken_over_bundles(self):
+    worker = Worker(None, self.model, self.machine, None, worker_id='worker')
+    bundle = make_run_bundle('run')
+    self.model.save_bundle(bundle)
+    self.model.update_bundle(bundle, {'state': State.RUNNING, 'metadata': {'job_handle': '1'}})
+    worker.leased_uuids.add(bundle.uuid)
+    worker.taken_over_uuids.add(bundle.uuid)
+    # If the machine can't tell, the taken over bundle keeps running.
+    self.machine.statuses = None
+    worker.check_finished_bundles()
+    self.assertEqual(self.get_states([bundle]), [State.RUNNING])
+    self.assertEqual(worker.taken_over_uuids, set([bundle.uuid]))
+    # It is lost once the machine doesn't know about its job.
+    self.machine.statuses = []
+    worker.check_finished_bundles()
+    self.assertEqual(self.get_states([bundle]), [State.FAILED])
+    self.assertEqual(worker.taken_over_uuids, set())
+
+  def test_lost_leases(self):
+    worker = Worker(None, self.model, self.machine, None, worker_id='worker', lease_time=30)
+    bundles = [make_run_bundle('run-%d' % i) for i in range(2)]
+    self.model.batch_save_bundles(bundles)
+    self.model.batch_update_bundles(bundles, {'state': State.STAGED})
+    for (i, bundle) in enumerate(bundles):
+      self.assertTrue(self.model.claim_bundle(self.model.get_bundle(bundle.uuid), 'worker', 30))
+      self.model.update_bundle(bundle, {'metadata': {'job_handle': str(i)}})
+    worker.heartbeat()
+    self.assertEqual(worker.leased_uuids, set(bundle.uuid for bundle in bundles))
+    self.machine.statuses = [{'job_handle': str(i), 'exitcode': None, 'time': 1} for i in range(2)]
+    updates = []
+    worker.update_running_bundle = updates.append
+
+    # The worker was too slow to renew its lease on the second bundle, which
+    # another worker took over; it notices during its next (overdue) heartbeat.
+    with self.model.engine.begin() as connection:
+      connection.execute(bundle_lease.update().where(
+        bundle_lease.c.bundle_uuid == bundles[1].uuid
+      ).values({'worker_id': 'other'}))
+    worker.last_heartbeat = 0
+    worker.check_finished_bundles()
+    self.assertEqual(worker.leased_uuids, set([bundles[0].uuid]))
+    self.assertEqual((self.machine.killed, self.machine.finalized), ([bundles[1].uuid], [bundles[1].uuid]))
+    self.assertEqual([status['bundle'].uuid for status in updates], [bundles[0].uuid])
+
+  def get_states(self, bundles):
+    return [self.model.get_bundle(bundle.uuid).state for bundle in bundles]
+
+  def test_update_created_bundles(self):
+    parents = [make_run_bundle('parent-%d' % i) for i in range(3)]
+    children = [make_run_bundle('child-%d' % i, [parents[i]]) for i in range(3)]
+    orphan = make_run_bundle('orphan', [make_run_bundle('missing')])
+    self.model.batch_save_bundles(parents + children + [orphan])
+    self.assertTrue(self.worker.update_created_bundles())
+    self.assertEqual(self.get_states(parents + children), [State.STAGED] * 3 + [State.CREATED] * 3)
+
+    # Only the bundles that changed are read from now on.
+    self.model.update_bundle(parents[0], {'state': State.READY})
+    self.model.update_bundle(parents[1], {'state': State.FAILED})
+    grandchild = make_run_bundle('grandchild', [children[2]])
+    self.model.save_bundle(grandchild)
+    with mock.patch.object(self.model, 'batch_get_bundle_fields', wraps=self.model.batch_get_bundle_fields) as get_fields:
+      self.assertTrue(self.worker.update_created_bundles())
+    self.assertFalse(any('state' in kwargs for (args, kwargs) in get_fields.call_args_list))
+    self.assertEqual(self.get_states(children + [grandchild, orphan]), [
+      State.STAGED, State.FAILED, State.CREATED, State.CREATED, State.CREATED,
+    ])
+    self.assertEqual(self.model.get_bundle(children[1].uuid).metadata.failure_message,
+                     'Parent bundles failed: %s' % (parents[1].uuid,))
+    self.assertFalse(self.worker.update_created_bundles())
+
+    # A full scan finds the same bundles waiting.
+    self.model.update_bundle(parents[2], {'state': State.READY})
+    self.worker.last_full_scan = 0
+    self.assertTrue(self.worker.update_created_bundles())
+    self.assertEqual(self.get_states([children[2], grandchild, orphan]), [State.STAGED, State.CREATED, State.CREATED])
+    self.assertEqual(set(self.worker.unfinished_parents), set([grandchild.uuid, orphan.uuid]))
+
+  def test_update_staged_bundles(self):
+    bundles = [make_run_bundle('run-%d' % i) for i in range(4)]
+    for bundle in bundles[:3]:
+      bundle.metadata.request_queue = 'q'
+    self.model.batch_save_bundles(bundles)
+    self.model.batch_update_bundles(bundles, {'state': State.STAGED})
+    # Once a bundle fails to start, the others of its queue aren't tried.
+    started = []
+    self.worker.start_bundles = lambda bundles: [started.append(bundle.metadata.request_queue) for bundle in bundles]
+    self.assertFalse(self.worker.update_staged_bundles())
+    self.assertEqual(sorted(started), ['', 'q'])
+    self.assertEqual(self.get_states(bundles), [State.STAGED] * 4)
+
+  def test_reuse_run_results(self):
+    parent = make_run_bundle('parent')
+    source = make_run_bundle('source', [parent])
+    self.model.batch_save_bundles([parent, source])
+    self.model.update_bundle(parent, {'state': State.READY, 'data_hash': '0xparent'})
+    self.model.update_bundle(source, {'state': State.READY, 'data_hash': '0xsource', 'metadata': {'time': 5.0}})
+    self.model.add_run_keys({source.uuid: source.get_run_key({parent.uuid: '0xparent'})})
+
+    same = make_run_bundle('same', [parent])
+    no_reuse = make_run_bundle('no_reuse', [parent])
+    no_reuse.metadata.no_reuse = 1
+    other = make_run_bundle('other', [parent])
+    other.command = 'echo other'
+    bundles = [same, no_reuse, other]
+    self.model.batch_save_bundles(bundles)
+    self.model.batch_update_bundles(bundles, {'state': State.STAGED})
+    self.worker.reuse_runs = True
+    self.worker.start_bundles = lambda bundles: [False] * len(bundles)
+    self.assertTrue(self.worker.update_staged_bundles())
+    self.assertEqual(self.get_states(bundles), [State.READY, State.STAGED, State.STAGED])
+    same = self.model.get_bundle(same.uuid)
+    self.assertEqual(same.data_hash, '0xsource')
+    self.assertEqual((same.metadata.reused_from, same.metadata.time), (source.uuid, 5.0))
+
+  def test_finalize_bundles(self):
+    worker = Worker(None, self.model, self.machine, None, num_finalizers=1)
+    event = threading.Event()
+    def upload_bundle(bundle, parent_dict, temp_dir):
+      event.wait(5)
+      if bundle.metadata.name == 'fail':
+        raise IOError('upload failed')
+      return ('0x' + bundle.metadata.name, {'data_size': 5})
+    worker.upload_bundle = upload_bundle
+    bundles = [make_run_bundle(name) for name in ('ok', 'fail')]
+    self.model.batch_save_bundles(bundles)
+    self.model.batch_update_bundles(bundles, {'state': State.RUNNING})
+    try:
+      for bundle in bundles:
+        worker.update_running_bundle({'bundle': bundle, 'success': True, 'temp_dir': '/tmp/' + bundle.uuid, 'time': 3.0})
+      # The results are uploaded in the background.
+      self.assertEqual(self.get_states(bundles), [State.FINALIZING] * 2)
+      self.assertEqual(self.model.get_bundle(bundles[0].uuid).metadata.time, 3.0)
+      self.assertFalse(worker.check_finalized_bundles())
+      event.set()
+      for _ in range(500):
+        worker.check_finalized_bundles()
+        if not worker.finalizing:
+          break
+        time.sleep(0.01)
+    finally:
+      event.set()
+      worker.finalizer_pool.close()
+    self.assertEqual(self.get_states(bundles), [State.READY, State.FAILED])
+    ok = self.model.get_bundle(bundles[0].uuid)
+    self.assertEqual((ok.data_hash, ok.metadata.data_size), ('0xok', 5))
+    self.assertEqual(self.model.get_bundle(bundles[1].uuid).metadata.failure_message, 'upload failed')
+    self.assertEqual(sorted(self.machine.finalized), sorted(bundle.uuid for bundle in bundles))
+
+  def test_restart_finalizing_bundles(self):
+    bundles = [make_run_bundle('run-%d' % i) for i in range(2)]
+    self.model.batch_save_bundles(bundles)
+    self.model.batch_update_bundles(bundles, {'state': State.FINALIZING})
+    self.worker.finalizing[bundles[1].uuid] = (bundles[1], True)
+    self.worker.restart_finalizing_bundles()
+    self.assertEqual(self.get_states(bundles), [State.RUNNING, State.FINALIZING])